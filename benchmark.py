@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import builtins
+import tempfile
+import statistics
+import functions as f
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# USER INPUTS #
+
+# output files
+file_results = "benchmark_results.json"
+file_baseline = None
+
+# synthetic trees
+bench_path = None
+bench_seed = 0
+bench_files = 10000
+bench_depth = 4
+bench_fanout = 5
+bench_size_median_bytes = 4 * 1024
+bench_size_sigma = 2.0
+bench_size_max_bytes = 16 * (1024 ** 2)
+bench_fraction_changed = 0.05
+bench_fraction_deleted = 0.02
+bench_fraction_added = 0.02
+bench_fraction_hidden = 0.05
+bench_fraction_temp = 0.02
+bench_excluded_folders = 1
+
+# operational parameters
+bench_repeats = 3
+bench_workers = 8
+bench_tolerance = 0.10
+
+# AUTOMATIC INPUTS #
+
+# replace defaults with command-line parameters if given
+if len(sys.argv) > 0:
+    if sys.argv[0] == 'benchmark.py':
+        if len(sys.argv) > 1:
+            file_results = sys.argv[1]
+        if len(sys.argv) > 2:
+            file_baseline = sys.argv[2]
+
+# os functions counted as system calls (entries from os.scandir() cache their own stat results and are not counted)
+counted_calls = ('scandir', 'listdir', 'stat', 'lstat', 'open', 'read', 'write', 'close', 'mkdir', 'makedirs', 'rmdir',
+                 'remove', 'unlink', 'rename', 'replace', 'link', 'utime', 'chmod', 'fsync', 'sendfile',
+                 'copy_file_range')
+
+
+# FUNCTIONS #
+
+def generate_synthetic_trees(rootpath, seed=0, count_files=10000, depth=4, fanout=5, size_median=4096, size_sigma=2.0,
+                             size_max=16 * (1024 ** 2), fraction_changed=0.05, fraction_deleted=0.02,
+                             fraction_added=0.02, fraction_hidden=0.05, fraction_temp=0.02, excluded_folders=1):
+    """
+    Generate reproducible home and destination trees for benchmarking. Home gets a tree of folders with the given depth
+    and fan-out and files with log-normal sizes spread over them, some hidden and some temporary; destination starts
+    as an exact copy, then a fraction of home files are changed, deleted, or added, so a run has work of every kind.
+    :param rootpath: string, empty folder to build 'home' and 'dest' folders in
+    :param seed: integer, random seed, so the same parameters always give the same trees
+    :param count_files: integer, number of files in home before changes
+    :param depth: integer, number of folder levels below the scanned folder
+    :param fanout: integer, number of subfolders in each folder
+    :param size_median: integer, median file size in bytes
+    :param size_sigma: float, spread of file sizes (sigma of the log-normal distribution)
+    :param size_max: integer, largest file size in bytes
+    :param fraction_changed: float, fraction of files rewritten in home with a newer time modified
+    :param fraction_deleted: float, fraction of files removed from home (so they are removed from destination)
+    :param fraction_added: float, fraction of files added to home only (so they are copied to destination)
+    :param fraction_hidden: float, fraction of files with hidden names
+    :param fraction_temp: float, fraction of files with temporary names
+    :param excluded_folders: integer, number of top-level folders listed as excluded
+    :return: dictionary with 'path_home', 'path_dest', 'scan' (list of folders to back up), 'skip' (list of
+             exclusions), and 'count_bytes' (total size of home files)
+    """
+    rng = random.Random(seed)
+    block = bytes(rng.getrandbits(8) for _ in range(1024 * 1024))
+    path_home = f.standardize_path_names(os.path.join(rootpath, 'home'))
+    path_dest = f.standardize_path_names(os.path.join(rootpath, 'dest'))
+    path_data = path_home + '/data'
+    folders = [path_data]
+    level = [path_data]
+    for _ in range(depth):
+        level = [folder + '/dir' + str(index) for folder in level for index in range(fanout)]
+        folders.extend(level)
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+    time_base = int(time.time()) - 30 * 86400
+
+    def write_file(path, mtime):
+        size = min(int(rng.lognormvariate(0, size_sigma) * size_median), size_max)
+        offset = rng.randrange(len(block))
+        with open(path, 'wb') as handle:
+            remaining = size
+            while remaining > 0:
+                chunk = block[offset:offset + remaining]
+                handle.write(chunk)
+                remaining -= len(chunk)
+                offset = 0
+        os.utime(path, (mtime, mtime))
+        return size
+
+    files = []
+    for index in range(count_files):
+        draw = rng.random()
+        prefix = '.' if draw < fraction_hidden else '~' if draw < fraction_hidden + fraction_temp else ''
+        files.append(rng.choice(folders) + '/' + prefix + 'file' + str(index) + '.dat')
+    for index, path in enumerate(files):
+        write_file(path, time_base + index)
+    shutil.copytree(path_home, path_dest, copy_function=shutil.copy2)
+    rng.shuffle(files)
+    count_changed = int(len(files) * fraction_changed)
+    count_deleted = int(len(files) * fraction_deleted)
+    for path in files[:count_changed]:
+        write_file(path, time_base + 30 * 86400)
+    for path in files[count_changed:count_changed + count_deleted]:
+        os.remove(path)
+    for index in range(int(count_files * fraction_added)):
+        write_file(rng.choice(folders) + '/new' + str(index) + '.dat', time_base + 30 * 86400)
+    skip = [path_data + '/dir' + str(index) for index in range(min(excluded_folders, fanout if depth > 0 else 0))]
+    count_bytes = sum(os.path.getsize(os.path.join(folder, name))
+                      for folder, _, names in os.walk(path_home) for name in names)
+    return {'path_home': path_home, 'path_dest': path_dest, 'scan': [path_data], 'skip': skip + ['glob:*.tmp'],
+            'count_bytes': count_bytes}
+
+
+def install_call_counters(names):
+    """
+    Replace os functions (and the built-in open) with wrappers that count how often they are called, as a portable
+    stand-in for counting system calls. Wrappers are installed once and stay in place for the rest of the process.
+    :param names: list of strings, names of os functions to count (missing ones are ignored)
+    :return: dictionary of call counts keyed by function name, updated as functions are called
+    """
+    counts = {}
+
+    def wrap(module, name, label):
+        original = getattr(module, name)
+
+        def wrapper(*args, **kwargs):
+            counts[label] = counts.get(label, 0) + 1
+            return original(*args, **kwargs)
+        setattr(module, name, wrapper)
+
+    for name in names:
+        if hasattr(os, name):
+            wrap(os, name, 'os.' + name)
+    wrap(builtins, 'open', 'open')
+    return counts
+
+
+def measure_stage(counts, function, *args, **kwargs):
+    """
+    Run one stage and measure it.
+    :param counts: dictionary of call counts, output from install_call_counters()
+    :param function: function to run, with any arguments after it
+    :return: tuple of (function output, dictionary with 'seconds', 'calls' (calls made during this stage, by function),
+             'calls_total', 'peak_rss_kb' (peak memory of the process so far, not just this stage), and
+             'peak_rss_growth_kb' (how much that peak grew during this stage); memory is None if not available)
+    """
+    counts_before = dict(counts)
+    peak_rss_before = read_peak_rss_kb()
+    time_start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - time_start
+    calls = {name: count - counts_before.get(name, 0) for name, count in counts.items()
+             if count - counts_before.get(name, 0) > 0}
+    peak_rss_kb = read_peak_rss_kb()
+    peak_rss_growth_kb = peak_rss_kb - peak_rss_before if peak_rss_kb is not None else None
+    return output, {'seconds': seconds, 'calls': calls, 'calls_total': sum(calls.values()), 'peak_rss_kb': peak_rss_kb,
+                    'peak_rss_growth_kb': peak_rss_growth_kb}
+
+
+def read_peak_rss_kb():
+    """
+    Read the peak memory (resident set size) of the process since it started.
+    :return: integer, kilobytes, or None if not available
+    """
+    if resource is None:
+        return None
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss_kb = peak_rss_kb // 1024
+    return peak_rss_kb
+
+
+def run_benchmark_pipeline(trees, counts, workers=8):
+    """
+    Run the same steps as main.py on synthetic trees (without manifest, snapshots, or content comparison), measuring
+    each stage separately.
+    Uses functions: measure_stage, and (from functions.py) compile_exclude_filter, scan_directory_groups,
+    list_possible_files, build_directory_details, join_directory_details, detect_moved_files,
+    define_directory_commands, execute_directory_operations
+    :param trees: dictionary of synthetic trees, output from generate_synthetic_trees()
+    :param counts: dictionary of call counts, output from install_call_counters()
+    :param workers: integer, number of threads for scanning and copying
+    :return: dictionary of stage measurements (see measure_stage) keyed by stage name, in the order run
+    """
+    stages = {}
+    path_home, path_dest, skip = trees['path_home'], trees['path_dest'], trees['skip']
+    exclude = f.compile_exclude_filter(skip, path_home)
+    (records_home, records_dest), stages['scan_directory_records'] = measure_stage(
+        counts, f.scan_directory_groups, [(trees['scan'], None, path_home, exclude),
+                                          (path_dest, None, path_dest, exclude)], workers=workers)
+    records_all = {**records_home, **records_dest}
+    files_all, stages['list_possible_files'] = measure_stage(
+        counts, f.list_possible_files, list(records_home) + list(records_dest), path_home, path_dest, skip=skip,
+        drop_nonexistent=True, records=records_all)
+
+    def build_both():
+        return (f.build_directory_details(list(files_all.loc[files_all['in_home'], 'file_home']), path_home,
+                                          records=records_all),
+                f.build_directory_details(list(files_all.loc[files_all['in_dest'], 'file_dest']), path_dest,
+                                          records=records_all))
+    (details_home, details_dest), stages['build_directory_details'] = measure_stage(counts, build_both)
+    details_all, stages['join_directory_details'] = measure_stage(counts, f.join_directory_details,
+                                                                  details_home, details_dest)
+    (details_all, operations_moved), stages['detect_moved_files'] = measure_stage(
+        counts, f.detect_moved_files, details_all, records_all, verify=True, workers=workers)
+    commands_all, stages['define_directory_commands'] = measure_stage(counts, f.define_directory_commands,
+                                                                      details_all)
+    _, stages['execute_directory_operations'] = measure_stage(
+        counts, f.execute_directory_operations, operations_moved + commands_all['operations'], workers=workers)
+    stages['execute_directory_operations']['operations'] = len(operations_moved + commands_all['operations'])
+    return stages
+
+
+def summarize_benchmark_runs(runs, parameters):
+    """
+    Combine repeated runs into one result, using the median time of each stage.
+    :param runs: list of dictionaries of stage measurements, outputs from run_benchmark_pipeline()
+    :param parameters: dictionary of benchmark parameters, saved with the results
+    :return: dictionary with 'parameters', 'stages' (median 'seconds', all 'seconds_runs', calls and peak memory so
+             far from the last run, and the most the peak grew during the stage in any run), and 'total_seconds'
+    """
+    stages = {}
+    for name in runs[0]:
+        stages[name] = dict(runs[-1][name])
+        stages[name]['seconds_runs'] = [run[name]['seconds'] for run in runs]
+        stages[name]['seconds'] = statistics.median(stages[name]['seconds_runs'])
+        growth = [run[name]['peak_rss_growth_kb'] for run in runs if run[name]['peak_rss_growth_kb'] is not None]
+        stages[name]['peak_rss_growth_kb'] = max(growth) if len(growth) > 0 else None
+    return {'parameters': parameters, 'stages': stages,
+            'total_seconds': sum(stage['seconds'] for stage in stages.values())}
+
+
+def compare_benchmark_results(results, baseline, tolerance=0.10):
+    """
+    Compare benchmark results against a stored baseline.
+    :param results: dictionary of results, output from summarize_benchmark_runs()
+    :param baseline: dictionary of results from an earlier run, in the same format
+    :param tolerance: float, fraction a stage can be slower (or make more calls) before it is flagged
+    :return: dictionary with 'message' (list of lines comparing each stage) and 'warning_flag' (True if any stage is
+             slower or makes more calls than allowed)
+    """
+    message = ["Comparison to baseline:"]
+    warning_flag = False
+    if baseline.get('parameters') != results['parameters']:
+        message.append("NOTE: Baseline was run with different parameters.")
+    for name, stage in results['stages'].items():
+        if name not in baseline.get('stages', {}):
+            message.append(f"{name}: not in baseline.")
+            continue
+        stage_base = baseline['stages'][name]
+        ratio = stage['seconds'] / stage_base['seconds'] if stage_base['seconds'] > 0 else float('inf')
+        flags = []
+        if ratio > 1 + tolerance:
+            flags.append("SLOWER")
+        if stage['calls_total'] > stage_base['calls_total'] * (1 + tolerance):
+            flags.append("MORE CALLS")
+        warning_flag = warning_flag or len(flags) > 0
+        message.append(f"{name}: {stage['seconds']:.3f}s vs {stage_base['seconds']:.3f}s ({ratio:.2f}x), "
+                       f"{stage['calls_total']} vs {stage_base['calls_total']} calls. {' '.join(flags)}".rstrip())
+    return {'message': message, 'warning_flag': warning_flag}
+
+
+# RUN BENCHMARK #
+
+if __name__ == '__main__':
+    parameters = {
+        'seed': bench_seed, 'count_files': bench_files, 'depth': bench_depth, 'fanout': bench_fanout,
+        'size_median': bench_size_median_bytes, 'size_sigma': bench_size_sigma, 'size_max': bench_size_max_bytes,
+        'fraction_changed': bench_fraction_changed, 'fraction_deleted': bench_fraction_deleted,
+        'fraction_added': bench_fraction_added, 'fraction_hidden': bench_fraction_hidden,
+        'fraction_temp': bench_fraction_temp, 'excluded_folders': bench_excluded_folders}
+    counts = install_call_counters(counted_calls)
+    runs = []
+    for repeat in range(bench_repeats):
+        rootpath = tempfile.mkdtemp(prefix='self_backup_benchmark_', dir=bench_path)
+        try:
+            trees = generate_synthetic_trees(rootpath, **parameters)
+            runs.append(run_benchmark_pipeline(trees, counts, workers=bench_workers))
+        finally:
+            shutil.rmtree(rootpath, ignore_errors=True)
+        print(f"Run {repeat + 1} of {bench_repeats}: "
+              f"{sum(stage['seconds'] for stage in runs[-1].values()):.3f}s.")
+    parameters.update({'repeats': bench_repeats, 'workers': bench_workers, 'count_bytes': trees['count_bytes']})
+    results = summarize_benchmark_runs(runs, parameters)
+    for name, stage in results['stages'].items():
+        print(f"{name}: {stage['seconds']:.3f}s, {stage['calls_total']} calls, peak RSS grew "
+              f"{stage['peak_rss_growth_kb']} KB (process peak so far {stage['peak_rss_kb']} KB).")
+    with open(file_results, 'w') as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+    print(f"Saved results to {file_results}.")
+    if file_baseline is not None:
+        with open(file_baseline, 'r') as handle:
+            comparison = compare_benchmark_results(results, json.load(handle), tolerance=bench_tolerance)
+        print('\n'.join(comparison['message']))
+        sys.exit(1 if comparison['warning_flag'] else 0)
@@ -13,6 +13,9 @@ path_destination = None
 file_include = "to_include.txt"
 file_exclude = "to_exclude.txt"
 file_force = "to_force.txt"
+file_manifest = "~self_backup_manifest.db"
+file_journal = "~self_backup_journal.txt"
+folder_packs = "~self_backup_packs"
 
 # operational parameters
 filesize_limit_bytes = 10 * (1024 ** 3)
@@ -22,23 +25,68 @@ overwrite_older_and_newer = False
 stop_if_warned = True
 pause_for_confirmation = True
 create_executable_only = False
+use_scan_manifest = True
+use_journal = True
+scan_workers = 8
+copy_workers = 8
+compare_contents = False
+hash_algorithm = "blake2b"
+hash_workers = 4
+detect_moves = True
+verify_moves = True
+verify_copies = None
+verify_sample_percent = 5
+delta_threshold_bytes = 256 * (1024 ** 2)
+delta_block_bytes = 1024 ** 2
+use_snapshots = False
+snapshot_keep_daily = 7
+snapshot_keep_weekly = 4
+streaming_mode = False
+compression = None
+compression_level = None
+compression_workers = 4
+optimize_plan = True
+schedule_copies = "inode"
+large_file_bytes = 64 * (1024 ** 2)
+large_file_workers = 2
+device_limits = {}
+pack_files_bytes = None
+pack_segment_bytes = 256 * (1024 ** 2)
+durability = "end"
+sync_every_operations = 1000
+show_progress = False
+save_run_metrics = True
+watch_debounce_seconds = 2
+watch_max_delay_seconds = 30
+watch_reconcile_seconds = 6 * 3600
+quick_check = "files"
+quick_check_max_seconds = 24 * 3600
+restore_paths = []
+restore_overwrite = False
 
 # AUTOMATIC INPUTS #
 
 # replace defaults with command-line parameters if given
 if len(sys.argv) > 0:
-    if sys.argv[0] in ('main.py', 'config.py'):
+    if sys.argv[0] in ('main.py', 'config.py', 'watch.py'):
         if len(sys.argv) > 1:
             path_home = sys.argv[1]
-        if len(sys.argv) > 2:
+        if len(sys.argv) > 3:
+            path_destination = sys.argv[2:]
+        elif len(sys.argv) > 2:
             path_destination = sys.argv[2]
+    elif sys.argv[0] == 'restore.py':
+        restore_paths = sys.argv[1:]
 
 # reset parameters that only work with command line
 if len(sys.argv) == 0:
     pause_for_confirmation = False
-elif sys.argv[0] not in ('main.py', 'config.py'):
+elif sys.argv[0] not in ('main.py', 'config.py', 'watch.py', 'restore.py'):
     pause_for_confirmation = False
 
+# list destinations (path_destination can be one directory or a list of them)
+paths_destination = list(path_destination) if isinstance(path_destination, (list, tuple)) else [path_destination]
+
 # detect system commands (dos or bash)
 if re.search(r'^win', sys.platform) is not None:
     cmdtype = "dos"
@@ -49,18 +97,42 @@ else:
 
 # REPORTS #
 
-print(
-    '\n', f"Backing up files from {path_home} to {path_destination}",
-    '\n', f"Including files in {file_include}.",
-    f"Excluding files in {file_exclude}." if os.path.isfile(file_exclude) else "",
-    f"Always copying files in {file_force}." if os.path.isfile(file_force) else "",
-    '\n', f"Ignoring files over {filesize_limit_bytes} bytes." if filesize_limit_bytes is not None else "",
-    f"Keeping hidden files." if copy_hidden_files else f"Ignoring hidden files.",
-    f"Removing no files from destination." if prevent_file_removal else f"May remove files from destination.",
-    f"Copying any different files." if overwrite_older_and_newer else f"Copying only newer files.",
-    '\n', f"Will halt process if warnings detected." if stop_if_warned else "",
-    f"Will pause for confirmation before running final step." if pause_for_confirmation else "",
-    f"Will only create but not run executable." if create_executable_only else "",
-    '\n', f"Using {cmdtype}-style commands for deleting, copying, and overwriting.",
-    '\n'
-)
+
+def report_settings():
+    """
+    Print a summary of the settings for this run.
+    :return: None
+    """
+    print(
+        '\n', f"Backing up files from {path_home} to {', '.join(str(path) for path in paths_destination)}",
+        '\n', f"Including files in {file_include}.",
+        f"Excluding files in {file_exclude}." if os.path.isfile(file_exclude) else "",
+        f"Always copying files in {file_force}." if os.path.isfile(file_force) else "",
+        '\n', f"Ignoring files over {filesize_limit_bytes} bytes." if filesize_limit_bytes is not None else "",
+        f"Keeping hidden files." if copy_hidden_files else f"Ignoring hidden files.",
+        f"Keeping dated snapshots in destination." if use_snapshots else
+        f"Removing no files from destination." if prevent_file_removal else f"May remove files from destination.",
+        f"Copying files with different contents." if compare_contents else
+        f"Copying any different files." if overwrite_older_and_newer else f"Copying only newer files.",
+        f"Moving renamed files/folders within destination."
+        if detect_moves and not use_snapshots and not prevent_file_removal else "",
+        '\n', f"Will halt process if warnings detected." if stop_if_warned else "",
+        f"Will pause for confirmation before running final step." if pause_for_confirmation else "",
+        f"Will only create but not run executable." if create_executable_only else
+        f"Running commands with {copy_workers} threads.",
+        '\n', f"Using scan manifest {file_manifest} in destination to skip unchanged folders."
+        if use_scan_manifest else "",
+        f"Skipping runs where a quick check ({quick_check}) finds nothing changed."
+        if quick_check is not None and use_scan_manifest else "",
+        '\n', f"Ordering operations by {schedule_copies} and copying files over {large_file_bytes} bytes on "
+               f"{large_file_workers} separate threads."
+        if schedule_copies is not None and not create_executable_only else "",
+        f"Limiting devices: {', '.join(device_limits)}." if len(device_limits) > 0 else "",
+        '\n', f"Packing files under {pack_files_bytes} bytes into {folder_packs}."
+        if pack_files_bytes is not None else "",
+        '\n', f"Compressing copies with {compression}." if compression is not None else "",
+        '\n', f"Verifying copies ({verify_copies}) after running." if verify_copies is not None else "",
+        '\n', f"Using {cmdtype}-style commands for executable." if create_executable_only else "",
+        '\n'
+    )
+    return None
@@ -3,9 +3,60 @@
 
 import os
 import re
+import sys
+import errno
+import shutil
+import bisect
+import fnmatch
+import itertools
+import concurrent.futures
+import threading
+import stat
+import sqlite3
+import datetime
+import time
+import json
+import heapq
+import math
+import random
+import select
+import struct
+import ctypes
+import ctypes.util
+import gzip
+import lzma
+import tarfile
 import warnings
-import pandas as pd
-import numpy as np
+from collections import namedtuple
+import hashlib
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+FileRecord = namedtuple('FileRecord', ['path', 'is_dir', 'size', 'mtime', 'inode'])
+
+INOTIFY_FLAGS = {'IN_ATTRIB': 0x4, 'IN_CLOSE_WRITE': 0x8, 'IN_MOVED_FROM': 0x40, 'IN_MOVED_TO': 0x80,
+                 'IN_CREATE': 0x100, 'IN_DELETE': 0x200, 'IN_DELETE_SELF': 0x400, 'IN_MOVE_SELF': 0x800,
+                 'IN_Q_OVERFLOW': 0x4000, 'IN_IGNORED': 0x8000, 'IN_ONLYDIR': 0x1000000, 'IN_ISDIR': 0x40000000,
+                 'IN_NONBLOCK': 0o4000, 'IN_CLOEXEC': 0o2000000}
+
+COMPRESSED_EXTENSIONS = ('.7z', '.aac', '.apk', '.avi', '.bz2', '.cab', '.docx', '.epub', '.flac', '.gif', '.gz',
+                         '.heic', '.jar', '.jpeg', '.jpg', '.lz', '.lz4', '.m4a', '.m4v', '.mkv', '.mov', '.mp3',
+                         '.mp4', '.ogg', '.opus', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp', '.xlsx', '.xz',
+                         '.zip', '.zst')
+COMPRESSED_SIGNATURES = (b'\x1f\x8b', b'PK\x03\x04', b'\xfd7zXZ\x00', b'BZh', b'7z\xbc\xaf\x27\x1c', b'Rar!',
+                         b'\x28\xb5\x2f\xfd', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'OggS', b'fLaC', b'ID3',
+                         b'\x1a\x45\xdf\xa3')
 
 
 def import_filelist(filename):
@@ -22,8 +73,8 @@ def import_filelist(filename):
         filelist = [file for file in filelist if len(file) > 0]
     else:
         filelist = []
-    filelist = [re.sub(r'\\', '/', item) for item in filelist]
-    filelist = [re.sub(r'/$', '', item) for item in filelist]
+    filelist = [item if item.startswith('regex:') else re.sub(r'\\', '/', item) for item in filelist]
+    filelist = [item if item.startswith('regex:') else re.sub(r'/$', '', item) for item in filelist]
     return filelist
 
 
@@ -79,46 +130,611 @@ def sort_unique_items(items):
     return items_out
 
 
+def compile_exclude_filter(skip=None, rootpath=None, keep_hidden=True, sizelimit=None):
+    """
+    Compile files/folders to skip, along with the temporary/hidden/size rules, into a single check that is built once
+    and then used for every file/folder. Plain entries skip anything whose path (relative to rootpath) starts with
+    them. Entries starting with 'glob:' are shell-style patterns, matched against the name alone if they have no slash
+    and against the whole path otherwise. Entries starting with 'regex:' are regular expressions searched for in the
+    path relative to rootpath.
+    Uses functions: standardize_path_names, sort_unique_items
+    :param skip: (optional) list of strings, files/folders/patterns to skip
+    :param rootpath: (optional) string, root path for home directory, split off from skip entries and patterns
+    :param keep_hidden: boolean, whether to keep hidden files
+    :param sizelimit: filesize limit in bytes (optional, larger files are skipped)
+    :return: function taking a path ending (path relative to the root, starting with a slash) and optionally the
+             file size, returning True if the file/folder should be skipped
+    """
+    rootpath_fmt = standardize_path_names(rootpath) if rootpath is not None else ""
+    prefixes = []
+    name_patterns = []
+    path_patterns = []
+    for item in (skip if skip is not None else []):
+        if item.startswith('regex:'):
+            path_patterns.append(item[len('regex:'):])
+            continue
+        item_fmt = standardize_path_names(item[len('glob:'):] if item.startswith('glob:') else item)
+        if item.startswith('glob:') and '/' not in item_fmt:
+            name_patterns.append(fnmatch.translate(item_fmt))
+            continue
+        if item_fmt.startswith(rootpath_fmt):
+            item_fmt = item_fmt[len(rootpath_fmt):]
+        if item.startswith('glob:'):
+            path_patterns.append('^' + fnmatch.translate(item_fmt))
+        else:
+            prefixes.append(item_fmt)
+    prefixes_min = []
+    for prefix in sort_unique_items(prefixes):
+        if len(prefixes_min) == 0 or not prefix.startswith(prefixes_min[-1]):
+            prefixes_min.append(prefix)
+    name_regex = re.compile('|'.join(name_patterns)) if len(name_patterns) > 0 else None
+    path_regex = re.compile('|'.join('(?:' + item + ')' for item in path_patterns)) if len(path_patterns) > 0 else None
+
+    def is_skipped(ending, size=None):
+        if ending is None:
+            return False
+        index = bisect.bisect_right(prefixes_min, ending) - 1
+        if index >= 0 and ending.startswith(prefixes_min[index]):
+            return True
+        if '/~' in ending or (not keep_hidden and '/.' in ending):
+            return True
+        if sizelimit is not None and size is not None and size > sizelimit:
+            return True
+        if name_regex is not None and name_regex.match(ending.rpartition('/')[2]) is not None:
+            return True
+        if path_regex is not None and path_regex.search(ending) is not None:
+            return True
+        return False
+    return is_skipped
+
+
 def list_directory_files(scan):
     """
     Scan selected directory(s) for all files.
-    Uses functions: standardize_path_names, sort_unique_items
+    Uses functions: scan_directory_records
     :param scan: list of directory(s) to scan
     :return: list of files/folders found in scan directory
     """
+    return list(scan_directory_records(scan))
+
+
+def scan_directory_records(scan, previous=None, workers=1, rootpath=None, exclude=None, counts=None):
+    """
+    Scan selected directory(s) for all files and folders, collecting type, size, time modified, and inode as it goes.
+    Uses the results cached by os.scandir() where the platform provides them, so each entry is checked at most once and
+    later steps can use the records instead of checking the disk again. Folders whose time modified matches the
+    previous scan reuse their old listing instead of being read again (their contents are still checked, since
+    editing a file does not change the time modified of its folder).
+    Uses functions: scan_directory_groups
+    :param scan: string or list of directory(s) to scan
+    :param previous: (optional) dictionary of FileRecord entries keyed by path from a prior scan (see
+                     load_scan_manifest)
+    :param workers: integer, number of threads reading folders at the same time
+    :param rootpath: (optional) string, root path that exclude checks are relative to (required if exclude is given)
+    :param exclude: (optional) function from compile_exclude_filter(), files/folders it matches are left out and
+                    skipped folders are not read at all
+    :param counts: (optional) dictionary, updated with counts of folders read/reused and file system calls made
+    :return: dictionary of FileRecord entries for files/folders found, keyed by path and in sorted path order
+    """
+    return scan_directory_groups([(scan, previous, rootpath, exclude)], workers=workers, counts=counts)[0]
+
+
+def scan_directory_groups(groups, workers=1, counts=None):
+    """
+    Scan several groups of directory(s) at once (e.g., home and destination), sharing one pool of threads. Every folder
+    found is queued as its own task, so idle threads pick up subfolders of a large directory while others are busy
+    and no single root holds up the rest. Output does not depend on the order in which threads finish.
+    Uses functions: standardize_path_names, sort_unique_items, build_file_record, scan_folder_records
+    :param groups: list of (scan, previous, rootpath, exclude) tuples, with arguments as in scan_directory_records()
+    :param workers: integer, number of threads reading folders at the same time
+    :param counts: (optional) dictionary, updated with 'folders_read', 'folders_reused', and 'stat_calls' (number of
+                   folder listings and stat calls made)
+    :return: list of dictionaries of FileRecord entries keyed by path and in sorted path order, one per group
+    """
+    counts = counts if counts is not None else {}
+    records_groups = []
+    pending = []
+    for scan, previous, rootpath, exclude in groups:
+        scan_paths = standardize_path_names(scan)
+        if type(scan_paths) == str:
+            scan_paths = [scan_paths]
+        previous_children = {}
+        if previous is not None:
+            for path in previous:
+                previous_children.setdefault(path.rpartition('/')[0], []).append(path)
+        settings = (previous, previous_children, standardize_path_names(rootpath) if rootpath is not None else None,
+                    exclude)
+        records = {}
+        for scan_path in scan_paths:
+            try:
+                counts['stat_calls'] = counts.get('stat_calls', 0) + 1
+                scan_record = build_file_record(scan_path, os.stat(scan_path))
+            except OSError:
+                continue
+            if scan_record is None or is_record_excluded(scan_record, settings[2], exclude):
+                continue
+            records[scan_path] = scan_record
+            if scan_record.is_dir:
+                pending.append((scan_record, settings, records))
+        records_groups.append(records)
+    if workers is None or workers <= 1:
+        while len(pending) > 0:
+            folder, settings, records = pending.pop()
+            found, subfolders = scan_folder_records(folder, *settings, counts=counts)
+            records.update(found)
+            pending += [(subfolder, settings, records) for subfolder in subfolders]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for folder, settings, records in pending:
+                folder_counts = {}
+                futures[executor.submit(scan_folder_records, folder, *settings, counts=folder_counts)] = \
+                    (settings, records, folder_counts)
+            while len(futures) > 0:
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    settings, records, folder_counts = futures.pop(future)
+                    found, subfolders = future.result()
+                    records.update(found)
+                    for key, value in folder_counts.items():
+                        counts[key] = counts.get(key, 0) + value
+                    for subfolder in subfolders:
+                        folder_counts = {}
+                        futures[executor.submit(scan_folder_records, subfolder, *settings, counts=folder_counts)] = \
+                            (settings, records, folder_counts)
+    return [{path: records[path] for path in sort_unique_items(list(records))} for records in records_groups]
+
+
+def is_record_excluded(record, rootpath=None, exclude=None):
+    """
+    Check a file/folder against a compiled exclude filter.
+    :param record: FileRecord of the file/folder
+    :param rootpath: (optional) string, standardized root path the exclude filter is relative to
+    :param exclude: (optional) function from compile_exclude_filter()
+    :return: boolean, True if the file/folder should be left out
+    """
+    if exclude is None or rootpath is None or not record.path.startswith(rootpath):
+        return False
+    return exclude(record.path[len(rootpath):], record.size)
+
+
+def scan_folder_records(folder, previous=None, previous_children=None, rootpath=None, exclude=None, counts=None):
+    """
+    Read the contents of a single folder, reusing its previous listing if its time modified has not changed.
+    Uses functions: build_file_record, is_record_excluded
+    :param folder: FileRecord of the folder to read
+    :param previous: (optional) dictionary of FileRecord entries keyed by path from a prior scan
+    :param previous_children: (optional) dictionary of lists of paths from a prior scan, keyed by parent folder
+    :param rootpath: (optional) string, standardized root path the exclude filter is relative to
+    :param exclude: (optional) function from compile_exclude_filter(), matching files/folders are left out
+    :param counts: (optional) dictionary, updated with 'folders_read' or 'folders_reused', and 'stat_calls'
+    :return: tuple of (dictionary of FileRecord entries keyed by path, list of FileRecord for subfolders to read next)
+    """
+    records = {}
+    subfolders = []
+    calls = 0
+    folder_previous = previous.get(folder.path) if previous is not None else None
+    if folder_previous is not None and folder_previous.is_dir and folder_previous.mtime == folder.mtime:
+        folder_key = 'folders_reused'
+        for path in previous_children.get(folder.path, []):
+            try:
+                calls += 1
+                stat_result = os.lstat(path)
+                link_flag = stat.S_ISLNK(stat_result.st_mode)
+                calls += 1 if link_flag else 0
+                record = build_file_record(path, os.stat(path) if link_flag else stat_result)
+            except OSError:
+                continue
+            if record is not None and not is_record_excluded(record, rootpath, exclude):
+                records[path] = record
+                if record.is_dir and not link_flag:
+                    subfolders.append(record)
+    else:
+        folder_key = 'folders_read'
+        try:
+            calls += 1
+            entries = list(os.scandir(folder.path))
+        except OSError:
+            entries = []
+        for entry in entries:
+            path = folder.path + '/' + entry.name
+            try:
+                calls += 1
+                record = build_file_record(path, entry.stat())
+            except OSError:
+                continue
+            if record is not None and not is_record_excluded(record, rootpath, exclude):
+                records[path] = record
+                if record.is_dir and not entry.is_symlink():
+                    subfolders.append(record)
+    if counts is not None:
+        counts[folder_key] = counts.get(folder_key, 0) + 1
+        counts['stat_calls'] = counts.get('stat_calls', 0) + calls
+    return records, subfolders
+
+
+def build_file_record(path, stat_result):
+    """
+    Build a FileRecord from the results of os.stat().
+    :param path: string, standardized path of the file/folder
+    :param stat_result: os.stat_result for the file/folder
+    :return: FileRecord with path, directory flag, size (None for folders), time modified, and inode,
+             or None if path is neither a regular file nor a folder
+    """
+    if stat.S_ISDIR(stat_result.st_mode):
+        return FileRecord(path, True, None, stat_result.st_mtime, stat_result.st_ino)
+    elif stat.S_ISREG(stat_result.st_mode):
+        return FileRecord(path, False, stat_result.st_size, stat_result.st_mtime, stat_result.st_ino)
+    else:
+        return None
+
+
+def lookup_file_record(path, records):
+    """
+    Look up the record for a file/folder. Paths inside a folder covered by the records are treated as missing if not
+    found there, and only paths outside all of them are checked on disk.
+    :param path: string, standardized path of the file/folder
+    :param records: dictionary of FileRecord entries keyed by path, from scan_directory_records()
+    :return: FileRecord for path, or None if it does not exist
+    """
+    record = records.get(path)
+    if record is not None:
+        return record
+    parent = path.rpartition('/')[0]
+    while parent != '':
+        if parent in records:
+            return None
+        parent = parent.rpartition('/')[0]
+    try:
+        return build_file_record(path, os.stat(path))
+    except OSError:
+        return None
+
+
+def select_directory_records(records, scan):
+    """
+    Select records for directory(s) and everything inside them, scanning any directory not already covered by records.
+    Uses functions: standardize_path_names, sort_unique_items, scan_directory_records
+    :param records: dictionary of FileRecord entries keyed by path, from scan_directory_records()
+    :param scan: string or list of directory(s) to select
+    :return: dictionary of FileRecord entries for the directory(s) and their contents, keyed by path
+    """
     scan_paths = standardize_path_names(scan)
-    if type(scan_paths).__name__ == "str":
+    if type(scan_paths) == str:
         scan_paths = [scan_paths]
-    files_all = []
+    paths_sorted = sort_unique_items(list(records))
+    selected = {}
     for scan_path in scan_paths:
-        for root, directories, filenames in os.walk(scan_path):
-            for directory in directories:
-                files_all.append(os.path.join(root, directory))
-            for filename in filenames:
-                files_all.append(os.path.join(root, filename))
-        if os.path.isdir(scan_path) or os.path.isfile(scan_path):
-            files_all.append(scan_path)
-    files_all = standardize_path_names(files_all)
-    files_sel = sort_unique_items(files_all)
-    return files_sel
+        if scan_path in records:
+            start = bisect.bisect_left(paths_sorted, scan_path + '/')
+            end = bisect.bisect_left(paths_sorted, scan_path + '0')
+            selected[scan_path] = records[scan_path]
+            selected.update({path: records[path] for path in paths_sorted[start:end]})
+        else:
+            selected.update(scan_directory_records(scan_path))
+    return selected
+
+
+def load_scan_manifest(dbfile, settings=None, pending=False):
+    """
+    Load records of the home and destination directories saved by the last successful run.
+    :param dbfile: string, path of the SQLite manifest file
+    :param settings: (optional) string describing the scan settings (exclusions, size limit, etc.); records saved
+                     with different settings are ignored, since they may be missing files that are now included
+    :param pending: boolean, whether to load the records saved before the operations of an unfinished run instead
+    :return: dictionary with 'home' and 'dest' entries, each a dictionary of FileRecord entries keyed by path
+             (both empty if the manifest does not exist yet)
+    """
+    manifest = {'home': {}, 'dest': {}}
+    if dbfile is None or not os.path.isfile(dbfile):
+        return manifest
+    prefix = 'pending_' if pending else ''
+    connection = sqlite3.connect(dbfile)
+    try:
+        create_manifest_tables(connection)
+        saved = connection.execute("SELECT value FROM manifest_info WHERE key = ?", (prefix + 'settings',)).fetchone()
+        if settings is not None and (saved is None or saved[0] != settings):
+            return manifest
+        rows = connection.execute("SELECT side, path, is_dir, size, mtime, inode FROM manifest ORDER BY path")
+        for side, path, is_dir, size, mtime, inode in rows:
+            if side.startswith(prefix) and side[len(prefix):] in manifest:
+                manifest[side[len(prefix):]][path] = FileRecord(path, bool(is_dir), size, mtime, inode)
+    finally:
+        connection.close()
+    return manifest
+
+
+def save_scan_manifest(dbfile, records_home, records_dest, settings=None, pending=False):
+    """
+    Save records of the home and destination directories, replacing anything saved by earlier runs. Records can
+    instead be saved as pending before operations start, so an interrupted run can be resumed without scanning again;
+    these are kept apart from the last successful run's records, and are cleared by the next save that is not pending.
+    Either way, any mark left by save_clean_run() is cleared, since the records no longer come from that run.
+    :param dbfile: string, path of the SQLite manifest file
+    :param records_home: dictionary of FileRecord entries keyed by path for home directory
+    :param records_dest: dictionary of FileRecord entries keyed by path for destination directory
+    :param settings: (optional) string describing the scan settings, checked by load_scan_manifest()
+    :param pending: boolean, whether these are records from before the operations of a run that has not finished
+    :return: None
+    """
+    prefix = 'pending_' if pending else ''
+    connection = sqlite3.connect(dbfile)
+    try:
+        create_manifest_tables(connection)
+        with connection:
+            if pending:
+                connection.execute("DELETE FROM manifest WHERE side LIKE 'pending_%'")
+            else:
+                connection.execute("DELETE FROM manifest")
+                connection.execute("DELETE FROM manifest_info WHERE key = 'pending_settings'")
+            connection.execute("DELETE FROM manifest_info WHERE key = 'clean_run'")
+            connection.execute("INSERT OR REPLACE INTO manifest_info (key, value) VALUES (?, ?)",
+                                (prefix + 'settings', settings))
+            for side, records in ((prefix + 'home', records_home), (prefix + 'dest', records_dest)):
+                connection.executemany(
+                    "INSERT OR REPLACE INTO manifest (side, path, is_dir, size, mtime, inode) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(side, record.path, int(record.is_dir), record.size, record.mtime, record.inode)
+                     for record in records.values()]
+                )
+    finally:
+        connection.close()
+    return None
+
+
+def save_clean_run(dbfile, state):
+    """
+    Mark the records saved in the manifest as coming from a run that finished without any errors, so the next run can
+    skip everything if nothing has changed since (see check_unchanged_since_clean_run).
+    :param dbfile: string, path of the SQLite manifest file (records must already be saved, see save_scan_manifest)
+    :param state: string describing everything besides files/folders that decides what a run does (home path,
+                  included files/folders, scan settings, etc.)
+    :return: None
+    """
+    connection = sqlite3.connect(dbfile)
+    try:
+        create_manifest_tables(connection)
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO manifest_info (key, value) VALUES (?, ?)",
+                               ('clean_run', json.dumps({'time': time.time(), 'state': state})))
+    finally:
+        connection.close()
+    return None
+
+
+def check_unchanged_since_clean_run(dbfile, state, paths_include=None, mode="files", max_age=None,
+                                    settings_files=None, workers=8):
+    """
+    Check cheaply whether anything could have changed since the last run that finished without errors, so a run with
+    nothing to do can stop before scanning or planning. Every folder recorded in home must still have the same time
+    modified (adding, removing, or renaming anything inside a folder changes it). With mode "files", every file
+    recorded in home is also checked for the same size and time modified; with mode "folders", files edited in place
+    are not noticed until the next full run. The destination/backup directory is not checked, just as a full run uses
+    its records from the manifest instead of scanning it.
+    Uses functions: standardize_path_names, create_manifest_tables
+    :param dbfile: string, path of the SQLite manifest file
+    :param state: string, same as given to save_clean_run(); anything different means a full run is needed
+    :param paths_include: (optional) list of strings, files/folders included in home, checked to still exist (or
+                          still not exist) as they did
+    :param mode: string, "files" or "folders"
+    :param max_age: (optional) number, seconds after the last clean run when a full run is needed anyway
+    :param settings_files: (optional) list of strings, files (e.g., config.py, to_include.txt) that mean a full run is
+                           needed if they changed after the last clean run
+    :param workers: integer, number of threads checking files/folders at the same time
+    :return: boolean, True if nothing has changed since the last clean run
+    """
+    if mode not in ("files", "folders"):
+        raise ValueError(f"Unknown quick check mode {mode}.")
+    if dbfile is None or not os.path.isfile(dbfile):
+        return False
+    connection = sqlite3.connect(dbfile)
+    try:
+        create_manifest_tables(connection)
+        saved = connection.execute("SELECT value FROM manifest_info WHERE key = 'clean_run'").fetchone()
+        if saved is None:
+            return False
+        clean_run = json.loads(saved[0])
+        if clean_run['state'] != state or (max_age is not None and time.time() - clean_run['time'] > max_age):
+            return False
+        rows = connection.execute("SELECT path, is_dir, size, mtime FROM manifest WHERE side = 'home'" +
+                                  (" AND is_dir = 1" if mode == "folders" else "")).fetchall()
+        paths_include = standardize_path_names(paths_include or [])
+        paths_recorded = {path for path in paths_include if connection.execute(
+            "SELECT 1 FROM manifest WHERE side = 'home' AND path = ?", (path,)).fetchone() is not None}
+    finally:
+        connection.close()
+    for path in settings_files or []:
+        if os.path.isfile(path) and os.path.getmtime(path) >= clean_run['time']:
+            return False
+    for path in paths_include:
+        if (path in paths_recorded) != os.path.exists(path):
+            return False
+
+    def is_unchanged(row):
+        path, is_dir, size, mtime = row
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return False
+        if is_dir:
+            return stat.S_ISDIR(stat_result.st_mode) and stat_result.st_mtime == mtime
+        return stat.S_ISREG(stat_result.st_mode) and stat_result.st_mtime == mtime and stat_result.st_size == size
+
+    chunks = [rows[start:start + 1000] for start in range(0, len(rows), 1000)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return all(executor.map(lambda chunk: all(is_unchanged(row) for row in chunk), chunks))
+
 
+def create_manifest_tables(connection):
+    """
+    Create tables in the SQLite manifest file if they do not exist yet.
+    :param connection: open sqlite3 connection to the manifest file
+    :return: None
+    """
+    connection.execute("CREATE TABLE IF NOT EXISTS manifest ("
+                       "side TEXT, path TEXT, is_dir INTEGER, size INTEGER, mtime REAL, inode INTEGER, "
+                       "PRIMARY KEY (side, path))")
+    connection.execute("CREATE TABLE IF NOT EXISTS manifest_info (key TEXT PRIMARY KEY, value TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                       "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, algorithm TEXT, digest TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS signatures ("
+                       "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, block_size INTEGER, digests BLOB)")
+    connection.execute("CREATE TABLE IF NOT EXISTS compressed ("
+                       "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, stored_size INTEGER, codec TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS packed ("
+                       "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, segment TEXT, offset INTEGER)")
+    return None
 
-def list_possible_files(filelist, rootpath_home, rootpath_dest, skip=None, drop_nonexistent=True):
+
+def query_scan_manifest(dbfile, prefixes, side="dest"):
+    """
+    Load only the records whose paths start with any of the given prefixes, looking them up by the manifest's index
+    instead of reading every record (so a few folders can be found quickly in a very large backup).
+    :param dbfile: string, path of the SQLite manifest file
+    :param prefixes: list of strings, starts of paths to load (e.g., a folder path loads the folder, its contents,
+                     and any sibling whose name starts the same way)
+    :param side: string, "home" or "dest"
+    :return: dictionary of FileRecord entries keyed by path (empty if the manifest does not exist yet)
+    """
+    records = {}
+    if dbfile is None or not os.path.isfile(dbfile):
+        return records
+    connection = sqlite3.connect(dbfile)
+    try:
+        create_manifest_tables(connection)
+        for prefix in prefixes:
+            rows = connection.execute("SELECT path, is_dir, size, mtime, inode FROM manifest "
+                                      "WHERE side = ? AND path >= ? AND path < ?",
+                                      (side, prefix, prefix + chr(0x10ffff)))
+            for path, is_dir, size, mtime, inode in rows:
+                records[path] = FileRecord(path, bool(is_dir), size, mtime, inode)
+    finally:
+        connection.close()
+    return {path: records[path] for path in sort_unique_items(list(records))}
+
+
+def select_pattern_records(records, patterns):
+    """
+    Select records matching any of the given paths or patterns, along with everything inside folders that match.
+    :param records: dictionary of FileRecord entries keyed by path
+    :param patterns: list of strings, full paths, optionally with wildcards (*, ?, [...]) matched by fnmatch
+    :return: dictionary of FileRecord entries that match, keyed by path
+    """
+    matched = set()
+    for path in records:
+        if any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns):
+            matched.add(path)
+    selected = {}
+    for path, record in records.items():
+        parts = path.split('/')
+        if any('/'.join(parts[:depth]) in matched for depth in range(1, len(parts) + 1)):
+            selected[path] = record
+    return selected
+
+
+def find_path_range(paths_sorted, folder):
+    """
+    Find where the contents of a folder are in a sorted list of paths, without checking every path.
+    :param paths_sorted: list of strings, paths in sorted order
+    :param folder: string, path of folder
+    :return: (start, end) tuple, so that paths_sorted[start:end] holds everything inside folder (not folder itself)
+    """
+    return bisect.bisect_left(paths_sorted, folder + '/'), bisect.bisect_left(paths_sorted, folder + '0')
+
+
+def update_destination_records(records_dest, operations, records_home, rootpath=None):
+    """
+    Apply planned operations to the destination records, so the next run can use them instead of scanning. Folders
+    made along with a deeper folder, and everything copied with a whole folder, are recorded from home. Contents of
+    folders removed or moved are found in a sorted list of paths, which is only sorted again after new paths are added.
+    Uses functions: sort_unique_items, build_file_record, find_path_range
+    :param records_dest: dictionary of FileRecord entries keyed by path for destination directory before operations
+    :param operations: list of (action, source, target) tuples, output 'operations' from define_directory_commands(),
+                       define_snapshot_operations(), detect_moved_files(), or optimize_directory_operations()
+    :param records_home: dictionary of FileRecord entries keyed by path for home directory
+    :param rootpath: (optional) string, if given only records for this folder and its contents are kept (e.g., a new
+                     snapshot), and the folder itself is recorded from disk
+    :return: dictionary of FileRecord entries keyed by path for destination directory after operations
+    """
+    records_out = dict(records_dest)
+    paths_home = None
+    paths_sorted = None
+    for action, source, target in operations:
+        if action == 'cptree':
+            paths_home = sorted(records_home) if paths_home is None else paths_home
+            start, end = find_path_range(paths_home, source)
+            for path in paths_home[start:end]:
+                record = records_home[path]
+                records_out[target + path[len(source):]] = FileRecord(target + path[len(source):], record.is_dir,
+                                                                      record.size, record.mtime, None)
+            paths_sorted = None
+        elif action == 'mkdir' and source is not None:
+            parent_source, parent_target = source.rpartition('/')[0], target.rpartition('/')[0]
+            while parent_source in records_home and parent_target not in records_out \
+                    and source[len(parent_source):] == target[len(parent_target):]:
+                record = records_home[parent_source]
+                records_out[parent_target] = FileRecord(parent_target, True, record.size, record.mtime, None)
+                parent_source, parent_target = parent_source.rpartition('/')[0], parent_target.rpartition('/')[0]
+                paths_sorted = None
+        if action in ('rm', 'rmdir', 'mv'):
+            paths_sorted = sorted(records_out) if paths_sorted is None else paths_sorted
+            path_from = target if action in ('rm', 'rmdir') else source
+            start, end = find_path_range(paths_sorted, path_from)
+            paths_inside = paths_sorted[start:end] if action != 'rm' else []
+            del paths_sorted[start:start + len(paths_inside)]
+            is_recorded = path_from in records_out
+            if is_recorded:
+                del paths_sorted[bisect.bisect_left(paths_sorted, path_from)]
+            for path in ([path_from] if is_recorded else []) + paths_inside:
+                record = records_out.pop(path)
+                if action == 'mv':
+                    records_out[target + path[len(source):]] = record._replace(path=target + path[len(source):])
+            if action == 'mv':
+                start, end = find_path_range(paths_sorted, target)
+                paths_sorted[start:end] = sort_unique_items(paths_sorted[start:end] +
+                                                            [target + path[len(source):] for path in paths_inside])
+                index = bisect.bisect_left(paths_sorted, target)
+                if is_recorded and paths_sorted[index:index + 1] != [target]:
+                    paths_sorted.insert(index, target)
+        elif action == 'link' and source in records_dest:
+            record = records_dest[source]
+            records_out[target] = FileRecord(target, record.is_dir, record.size, record.mtime, record.inode)
+            paths_sorted = None
+        elif source in records_home:
+            record = records_home[source]
+            records_out[target] = FileRecord(target, record.is_dir, record.size, record.mtime, None)
+            paths_sorted = None
+    if rootpath is not None:
+        rootpath_fmt = standardize_path_names(rootpath)
+        records_out = {path: record for path, record in records_out.items()
+                       if path == rootpath_fmt or path.startswith(rootpath_fmt + '/')}
+        try:
+            records_out[rootpath_fmt] = build_file_record(rootpath_fmt, os.stat(rootpath_fmt))
+        except OSError:
+            pass
+    return {path: records_out[path] for path in sort_unique_items(list(records_out))}
+
+
+def list_possible_files(filelist, rootpath_home, rootpath_dest, skip=None, drop_nonexistent=True, records=None):
     """
     Build dataframe of all possible files/folders that could be in home or destination directories. This will define
     files/folders as if they were in either directory, and filter out anything in skip list (optional).
-    Uses functions: standardize_path_names, sort_unique_items
+    Uses functions: standardize_path_names, sort_unique_items, compile_exclude_filter, lookup_file_record
     :param filelist: list of strings, list of all possible files using full paths
     :param rootpath_home: string, root path for home directory, used to format filelist
     :param rootpath_dest: string, root path for destination directory, used to format filelist
-    :param skip: (optional) list of strings, list of files/folders to skip
+    :param skip: (optional) list of strings, list of files/folders/patterns to skip (see compile_exclude_filter)
     :param drop_nonexistent: boolean, whether to check for and drop files/folders that do not exist
+    :param records: (optional) dictionary of FileRecord entries keyed by path, from scan_directory_records(), used to
+                    check whether files/folders exist; anything not covered is checked on disk (see lookup_file_record)
     :return: data frame of files, with roots, endings, files as if they were in home or destination, and
              (if drop_nonexistent=True) flags for whether file/folder exists in home or destination
     """
+    import pandas as pd
     rootpath_home_fmt = standardize_path_names(rootpath_home)
     rootpath_dest_fmt = standardize_path_names(rootpath_dest)
     filelist_fmt = standardize_path_names(filelist)
+    skip_filter = compile_exclude_filter(skip, rootpath_home_fmt)
     filelist_endings = []
     for item in filelist_fmt:
         if item.startswith(rootpath_home_fmt) and item.startswith(rootpath_dest_fmt):
@@ -134,31 +750,15 @@ def list_possible_files(filelist, rootpath_home, rootpath_dest, skip=None, drop_
             ending = item[len(rootpath_dest_fmt):]
         else:
             ending = None
-        if skip is not None and ending is not None:
-            skip_ending = [skip_item[len(rootpath_home_fmt):] if skip_item.startswith(rootpath_home_fmt)
-                           else skip_item
-                           for skip_item in skip]
-            skip_flag = any([ending.startswith(skip_item) for skip_item in skip_ending])
-        else:
-            skip_flag = False
-        if ending is not None and not skip_flag:
+        if ending is not None and not skip_filter(ending):
             filelist_endings.append(ending)
     filelist_endings = sort_unique_items(filelist_endings)
     filelist_possible_home = [rootpath_home_fmt + item for item in filelist_endings]
     filelist_possible_dest = [rootpath_dest_fmt + item for item in filelist_endings]
     if drop_nonexistent:
-        flag_home_dir = []
-        flag_home_file = []
-        for file_home in filelist_possible_home:
-            flag_home_dir.append(os.path.isdir(file_home))
-            flag_home_file.append(os.path.isfile(file_home))
-        flag_dest_dir = []
-        flag_dest_file = []
-        for file_dest in filelist_possible_dest:
-            flag_dest_dir.append(os.path.isdir(file_dest))
-            flag_dest_file.append(os.path.isfile(file_dest))
-        flag_home = [(dir or file) for (dir, file) in zip(flag_home_dir, flag_home_file)]
-        flag_dest = [(dir or file) for (dir, file) in zip(flag_dest_dir, flag_dest_file)]
+        records_lookup = records if records is not None else {}
+        flag_home = [lookup_file_record(file_home, records_lookup) is not None for file_home in filelist_possible_home]
+        flag_dest = [lookup_file_record(file_dest, records_lookup) is not None for file_dest in filelist_possible_dest]
         flag_any = [(home or dest) for (home, dest) in zip(flag_home, flag_dest)]
     else:
         flag_home = [None] * len(filelist_endings)
@@ -178,7 +778,7 @@ def list_possible_files(filelist, rootpath_home, rootpath_dest, skip=None, drop_
     return df_out
 
 
-def build_directory_details(filelist, rootpath, sizelimit=None, keep_hidden=True):
+def build_directory_details(filelist, rootpath, sizelimit=None, keep_hidden=True, records=None):
     """
     Build dataframe of file details, including whether directory or file, size, and time modified.
     Uses functions: standardize_path_names, sort_unique_items
@@ -186,8 +786,13 @@ def build_directory_details(filelist, rootpath, sizelimit=None, keep_hidden=True
     :param rootpath: string with root path (will be split off from file name)
     :param sizelimit: filesize limit in bytes (optional, anything larger is dropped from list)
     :param keep_hidden: boolean, whether to keep hidden files
+    :param records: (optional) dictionary of FileRecord entries keyed by path, from scan_directory_records(), used for
+                    directory/file flags, size, and time modified; anything not covered is checked on disk
+                    (see lookup_file_record)
     :return: pandas dataframe with absolute path, root, filename, directory/file flags, size, time modified
     """
+    import numpy as np
+    import pandas as pd
     rootpath_fmt = standardize_path_names(rootpath)
     filelist_fmt = standardize_path_names(filelist)
     filelist_fmt = sort_unique_items(filelist_fmt)
@@ -195,14 +800,20 @@ def build_directory_details(filelist, rootpath, sizelimit=None, keep_hidden=True
     files_root = [rootpath_fmt] * len(files_full)
     files_ending = [file[len(rootpath_fmt):] for file in files_full]
     if len(files_full) > 0:
+        records_lookup = records if records is not None else {}
+        files_record = [lookup_file_record(file, records_lookup) for file in files_full]
+        dir_flag = [record is not None and record.is_dir for record in files_record]
+        file_flag = [record is not None and not record.is_dir for record in files_record]
+        size = [record.size if flag else np.nan for (record, flag) in zip(files_record, file_flag)]
+        time = [record.mtime if flag else np.nan for (record, flag) in zip(files_record, file_flag)]
         details = pd.DataFrame({
             'full': files_full,
             'root': files_root,
             'ending': files_ending,
-            'dir_flag': [os.path.isdir(file) for file in files_full],
-            'file_flag': [os.path.isfile(file) for file in files_full],
-            'size': [os.path.getsize(file) if os.path.isfile(file) else None for file in files_full],
-            'time': [os.path.getmtime(file) if os.path.isfile(file) else None for file in files_full]
+            'dir_flag': dir_flag,
+            'file_flag': file_flag,
+            'size': size,
+            'time': time
         })
         is_blank = [bool(file.strip(' /\\.') == '') for file in details['ending']]
         is_file_or_dir = details['dir_flag'] | details['file_flag']
@@ -237,6 +848,8 @@ def join_directory_details(details_home, details_dest):
                          required fields: full, root, ending, dir_flag, file_flag, time
     :return: dataframe of all files with root paths, filenames, and flags for later copying
     """
+    import numpy as np
+    import pandas as pd
     details_join = details_home.merge(details_dest, on='ending', how='outer', suffixes=('_home', '_dest'))
     details_join = details_join.loc[list(details_join['ending'] != ""), :]
     in_dest = details_join['full_dest'].notnull()
@@ -271,31 +884,401 @@ def join_directory_details(details_home, details_dest):
     return details
 
 
-def define_forced_details(paths, rootpath_home, rootpath_dest):
+def compare_directory_contents(details, records, cache=None, algorithm="blake2b", workers=4):
+    """
+    Decide which files in both home and destination need copying by their contents instead of time modified. Files
+    with the same size and time modified are treated as unchanged without being read, files with different sizes are
+    treated as changed, and only the rest are hashed (using cache where the file has not changed since it was last
+    hashed). Files whose contents differ are marked newer in home regardless of time modified, and all other files in
+    both are marked as neither newer nor older.
+    Uses functions: lookup_file_record, hash_file_records
+    :param details: dataframe of file details, output from join_directory_details()
+    :param records: dictionary of FileRecord entries keyed by path for home and destination, from
+                    scan_directory_records()
+    :param cache: (optional) dictionary of hashes from load_file_cache(), updated with any new hashes
+    :param algorithm: string, "blake2b" or "xxhash" (requires the xxhash package)
+    :param workers: integer, number of files hashed at the same time
+    :return: dataframe of file details, with is_newer and is_older updated
+    """
+    details_out = details.copy()
+    files_home = list(details_out['root_home'] + details_out['ending'])
+    files_dest = list(details_out['root_dest'] + details_out['ending'])
+    flag_both = list(details_out['is_file'] & details_out['in_home'] & details_out['in_dest'])
+    is_newer = list(details_out['is_newer'])
+    is_older = list(details_out['is_older'])
+    to_hash = []
+    for index, (file_home, file_dest, flag) in enumerate(zip(files_home, files_dest, flag_both)):
+        if not flag:
+            continue
+        record_home = lookup_file_record(file_home, records)
+        record_dest = lookup_file_record(file_dest, records)
+        if record_home is None or record_dest is None:
+            continue
+        if record_home.size != record_dest.size:
+            is_newer[index], is_older[index] = True, False
+        elif record_home.mtime == record_dest.mtime:
+            is_newer[index], is_older[index] = False, False
+        else:
+            to_hash.append((index, record_home, record_dest))
+    digests = hash_file_records([record for (_, record_home, record_dest) in to_hash
+                                 for record in (record_home, record_dest)],
+                                cache=cache, algorithm=algorithm, workers=workers)
+    for index, record_home, record_dest in to_hash:
+        is_changed = digests.get(record_home.path) is None or \
+                     digests.get(record_home.path) != digests.get(record_dest.path)
+        is_newer[index], is_older[index] = is_changed, False
+    details_out['is_newer'] = is_newer
+    details_out['is_older'] = is_older
+    return details_out
+
+
+def hash_file_records(records, cache=None, algorithm="blake2b", workers=4):
+    """
+    Hash files in parallel, reusing cached hashes for files whose size, time modified, and inode have not changed.
+    Uses functions: hash_file
+    :param records: list of FileRecord entries for files to hash
+    :param cache: (optional) dictionary of hashes from load_file_cache(), updated with any new hashes
+    :param algorithm: string, "blake2b" or "xxhash" (requires the xxhash package)
+    :param workers: integer, number of files hashed at the same time
+    :return: dictionary of hex digests keyed by path (files that could not be read are left out)
+    """
+    cache = cache if cache is not None else {}
+    digests = {}
+    to_hash = {}
+    for record in records:
+        key = (record.size, record.mtime, record.inode, algorithm)
+        cached = cache.get(record.path)
+        if cached is not None and cached[:4] == key:
+            digests[record.path] = cached[4]
+        else:
+            to_hash[record.path] = key
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(hash_file, path, algorithm): path for path in to_hash}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                digests[path] = future.result()
+            except OSError:
+                continue
+            cache[path] = to_hash[path] + (digests[path],)
+    return digests
+
+
+def hash_file(path, algorithm="blake2b", buffer_size=1024 * 1024, codec=None):
+    """
+    Hash the contents of a file, reading it in chunks so large files are never held in memory.
+    Uses functions: define_hasher, open_decompressed
+    :param path: string, path of file to hash
+    :param algorithm: string, "blake2b" or "xxhash" (requires the xxhash package)
+    :param buffer_size: integer, bytes read at a time
+    :param codec: (optional) string, codec the file was compressed with by compress_file(), to hash the original
+                  contents instead
+    :return: string, hex digest of file contents
+    """
+    hasher = define_hasher(algorithm)
+    with open(path, 'rb') as file_raw:
+        file = open_decompressed(file_raw, codec) if codec is not None else file_raw
+        while True:
+            buffer = file.read(buffer_size)
+            if not buffer:
+                break
+            hasher.update(buffer)
+    return hasher.hexdigest()
+
+
+def define_hasher(algorithm="blake2b"):
+    """
+    Define a new hash object for comparing contents.
+    :param algorithm: string, "blake2b" or "xxhash" (requires the xxhash package)
+    :return: hash object with update() and hexdigest() methods
+    """
+    if algorithm == "xxhash":
+        if xxhash is None:
+            raise ImportError("Hash algorithm xxhash requires the xxhash package.")
+        return xxhash.xxh3_128()
+    elif algorithm == "blake2b":
+        return hashlib.blake2b()
+    raise ValueError(f"Unknown hash algorithm {algorithm}.")
+
+
+def load_file_cache(dbfile, table):
+    """
+    Load per-file values (e.g., hashes) saved by earlier runs.
+    :param dbfile: string, path of the SQLite manifest file
+    :param table: string, "hashes" for content hashes, "signatures" for block signatures, "compressed" for the
+                  index of compressed files in the destination, or "packed" for the index of files packed into segments
+    :return: dictionary of tuples keyed by path, with the table's other columns in order (empty if the manifest does not
+             exist yet); for "hashes" this is (size, time modified, inode, algorithm, digest), for "signatures" it is
+             (size, time modified, block size, digests), for "compressed" it is (original size, time modified,
+             stored size, codec), and for "packed" it is (size, time modified, segment path, offset)
+    """
+    if table not in ('hashes', 'signatures', 'compressed', 'packed'):
+        raise ValueError(f"Unknown cache table {table}.")
+    cache = {}
+    if dbfile is None or not os.path.isfile(dbfile):
+        return cache
+    connection = sqlite3.connect(dbfile)
+    try:
+        create_manifest_tables(connection)
+        for row in connection.execute(f"SELECT * FROM {table}"):
+            cache[row[0]] = tuple(row[1:])
+    finally:
+        connection.close()
+    return cache
+
+
+def save_file_cache(dbfile, table, cache, records=None):
+    """
+    Save per-file values for the next run, replacing anything saved by earlier runs.
+    :param dbfile: string, path of the SQLite manifest file
+    :param table: string, "hashes", "signatures", "compressed", or "packed" (see load_file_cache)
+    :param cache: dictionary of tuples keyed by path, from load_file_cache() and updated since
+    :param records: (optional) dictionary of FileRecord entries keyed by path; if given, values for anything else
+                    (e.g., deleted files) are dropped
+    :return: None
+    """
+    if table not in ('hashes', 'signatures', 'compressed', 'packed'):
+        raise ValueError(f"Unknown cache table {table}.")
+    connection = sqlite3.connect(dbfile)
+    try:
+        create_manifest_tables(connection)
+        with connection:
+            connection.execute(f"DELETE FROM {table}")
+            rows = [(path,) + entry for path, entry in cache.items() if records is None or path in records]
+            if len(rows) > 0:
+                connection.executemany(f"INSERT INTO {table} VALUES ({', '.join(['?'] * len(rows[0]))})", rows)
+    finally:
+        connection.close()
+    return None
+
+
+def update_hash_cache(cache, operations, records_dest):
+    """
+    Copy cached hashes of files copied from home to their destination paths, and of files moved within the destination
+    to their new paths, so copies do not have to be read again.
+    Uses functions: find_path_range, sort_unique_items
+    :param cache: dictionary of hashes, from load_file_cache(), updated in place
+    :param operations: list of (action, source, target) tuples that were completed
+    :param records_dest: dictionary of FileRecord entries keyed by path for destination directory after operations
+    :return: None
+    """
+    paths_sorted = None
+    for action, source, target in operations:
+        if action in ('cp', 'cpover') and source in cache and target in records_dest:
+            record = records_dest[target]
+            size, mtime, _, algorithm, digest = cache[source]
+            if (size, mtime) == (record.size, record.mtime):
+                cache[target] = (record.size, record.mtime, record.inode, algorithm, digest)
+                paths_sorted = None
+        elif action == 'cptree':
+            paths_sorted = sorted(cache) if paths_sorted is None else paths_sorted
+            start, end = find_path_range(paths_sorted, source)
+            for path in paths_sorted[start:end]:
+                path_target = target + path[len(source):]
+                if path_target in records_dest and cache[path][:2] == (records_dest[path_target].size,
+                                                                       records_dest[path_target].mtime):
+                    cache[path_target] = (records_dest[path_target].size, records_dest[path_target].mtime,
+                                          records_dest[path_target].inode) + cache[path][3:]
+            paths_sorted = None
+        elif action == 'mv':
+            paths_sorted = sorted(cache) if paths_sorted is None else paths_sorted
+            start, end = find_path_range(paths_sorted, source)
+            paths_inside = paths_sorted[start:end]
+            del paths_sorted[start:end]
+            is_cached = source in cache
+            if is_cached:
+                del paths_sorted[bisect.bisect_left(paths_sorted, source)]
+            for path in ([source] if is_cached else []) + paths_inside:
+                cache[target + path[len(source):]] = cache.pop(path)
+            start, end = find_path_range(paths_sorted, target)
+            paths_sorted[start:end] = sort_unique_items(paths_sorted[start:end] +
+                                                        [target + path[len(source):] for path in paths_inside])
+            index = bisect.bisect_left(paths_sorted, target)
+            if is_cached and paths_sorted[index:index + 1] != [target]:
+                paths_sorted.insert(index, target)
+    return None
+
+
+def apply_compressed_sizes(records, compressed):
+    """
+    Replace the sizes of compressed files in the destination with their original sizes, so they compare correctly
+    against home. A file is only treated as compressed if its size and time modified still match the index.
+    :param records: dictionary of FileRecord entries keyed by path for destination directory
+    :param compressed: dictionary of (original size, time modified, stored size, codec) tuples keyed by path, from
+                       load_file_cache()
+    :return: dictionary of FileRecord entries keyed by path, with original sizes for compressed files
+    """
+    records_out = dict(records)
+    for path, (size, mtime, stored_size, _) in compressed.items():
+        record = records_out.get(path)
+        if record is not None and not record.is_dir and record.size == stored_size and record.mtime == mtime:
+            records_out[path] = record._replace(size=size)
+    return records_out
+
+
+def update_compressed_index(compressed, operations):
+    """
+    Update the index of compressed files for files/folders removed, moved, or linked in the destination (copies
+    update it as they are made, see compress_file).
+    :param compressed: dictionary of (original size, time modified, stored size, codec) tuples keyed by path, from
+                       load_file_cache(), updated in place
+    :param operations: list of (action, source, target) tuples that were completed
+    :return: None
+    """
+    for action, source, target in operations:
+        if action in ('rm', 'rmdir'):
+            for path in [path for path in compressed if path == target or path.startswith(target + '/')]:
+                del compressed[path]
+        elif action == 'mv':
+            for path in [path for path in compressed if path == source or path.startswith(source + '/')]:
+                compressed[target + path[len(source):]] = compressed.pop(path)
+        elif action == 'link' and source in compressed:
+            compressed[target] = compressed[source]
+    return None
+
+
+def detect_moved_files(details, records, verify=True, cache=None, algorithm="blake2b", workers=4):
+    """
+    Find files/folders that were moved or renamed in home, so they can be moved within the destination instead of
+    removed and copied again. A folder only in the destination is paired with a folder only in home if everything
+    inside them has the same names, sizes, and times modified, and is then moved as one. Remaining files only in the
+    destination are paired with files only in home by size and time modified (preferring the same name), and if verify
+    is True only if their contents also match. Empty files and folders are not paired.
+    Uses functions: lookup_file_record, hash_file_records
+    :param details: dataframe of file details, output from join_directory_details()
+    :param records: dictionary of FileRecord entries keyed by path for home and destination, from
+                    scan_directory_records()
+    :param verify: boolean, whether to compare contents of paired files before treating them as moved
+    :param cache: (optional) dictionary of hashes from load_file_cache(), updated with any new hashes
+    :param algorithm: string, "blake2b" or "xxhash" (requires the xxhash package)
+    :param workers: integer, number of files hashed at the same time
+    :return: tuple of (dataframe of file details updated so moved files/folders are neither removed nor copied, and
+             list of ('mv', source, target) operations with destination paths)
+    """
+    details_out = details.reset_index(drop=True).copy()
+    endings = list(details_out['ending'])
+    files_home = list(details_out['root_home'] + details_out['ending'])
+    files_dest = list(details_out['root_dest'] + details_out['ending'])
+    in_home = list(details_out['in_home'])
+    in_dest = list(details_out['in_dest'])
+    only_home = {}
+    only_dest = {}
+    for index, ending in enumerate(endings):
+        if in_home[index] and not in_dest[index]:
+            record = lookup_file_record(files_home[index], records)
+            if record is not None:
+                only_home[ending] = (index, record)
+        elif in_dest[index] and not in_home[index]:
+            record = lookup_file_record(files_dest[index], records)
+            if record is not None:
+                only_dest[ending] = (index, record)
+    endings_home = sorted(only_home)
+    endings_dest = sorted(only_dest)
+
+    def list_subtree(ending, endings_sorted):
+        start = bisect.bisect_left(endings_sorted, ending + '/')
+        end = bisect.bisect_left(endings_sorted, ending + '0')
+        return endings_sorted[start:end]
+
+    def describe_subtree(ending, endings_sorted, only):
+        return tuple((item[len(ending):], only[item][1].is_dir, only[item][1].size,
+                      None if only[item][1].is_dir else only[item][1].mtime)
+                     for item in list_subtree(ending, endings_sorted))
+
+    operations = []
+    moved_home = set()
+    moved_dest = set()
+    folders_home = {}
+    for ending in endings_home:
+        if only_home[ending][1].is_dir:
+            description = describe_subtree(ending, endings_home, only_home)
+            if len(description) > 0:
+                folders_home.setdefault(description, []).append(ending)
+    folders_dest = [item for item in endings_dest if only_dest[item][1].is_dir]
+    for ending in sorted(folders_dest, key=lambda item: item.count('/')):
+        if ending in moved_dest:
+            continue
+        candidates = [item for item in folders_home.get(describe_subtree(ending, endings_dest, only_dest), [])
+                      if item not in moved_home]
+        if len(candidates) == 0:
+            continue
+        candidates.sort(key=lambda item: item.rpartition('/')[2] != ending.rpartition('/')[2])
+        target = candidates[0]
+        moved_dest.update([ending] + list_subtree(ending, endings_dest))
+        moved_home.update([target] + list_subtree(target, endings_home))
+        operations.append(('mv', files_dest[only_dest[ending][0]], files_dest[only_home[target][0]]))
+    groups = {}
+    for side, only, moved in (('home', only_home, moved_home), ('dest', only_dest, moved_dest)):
+        for ending, (_, record) in only.items():
+            if ending not in moved and not record.is_dir and record.size is not None and record.size > 0:
+                groups.setdefault((record.size, record.mtime), {'home': [], 'dest': []})[side].append(ending)
+    groups = {key: group for key, group in groups.items() if len(group['home']) > 0 and len(group['dest']) > 0}
+    digests = {}
+    if verify:
+        digests = hash_file_records([only_home[ending][1] for group in groups.values() for ending in group['home']] +
+                                    [only_dest[ending][1] for group in groups.values() for ending in group['dest']],
+                                    cache=cache, algorithm=algorithm, workers=workers)
+    for key in sorted(groups):
+        candidates_home = sorted(groups[key]['home'])
+        candidates_dest = sorted(groups[key]['dest'])
+        if not verify and not (len(candidates_home) == 1 and len(candidates_dest) == 1):
+            candidates_home = [item for item in candidates_home
+                               if [other.rpartition('/')[2] for other in candidates_dest].count(
+                                   item.rpartition('/')[2]) == 1]
+        for ending_dest in candidates_dest:
+            digest_dest = digests.get(only_dest[ending_dest][1].path)
+            matches = [item for item in candidates_home if not verify or
+                       (digest_dest is not None and digests.get(only_home[item][1].path) == digest_dest)]
+            if not verify and len(candidates_dest) > 1:
+                matches = [item for item in matches if item.rpartition('/')[2] == ending_dest.rpartition('/')[2]]
+            if len(matches) == 0:
+                continue
+            matches.sort(key=lambda item: item.rpartition('/')[2] != ending_dest.rpartition('/')[2])
+            target = matches[0]
+            candidates_home.remove(target)
+            moved_dest.add(ending_dest)
+            moved_home.add(target)
+            operations.append(('mv', files_dest[only_dest[ending_dest][0]], files_dest[only_home[target][0]]))
+    index_dest = [only_dest[ending][0] for ending in moved_dest]
+    index_home = [only_home[ending][0] for ending in moved_home]
+    details_out.loc[index_dest, 'in_dest'] = False
+    details_out.loc[index_home, 'in_dest'] = True
+    details_out.loc[index_home, 'is_newer'] = False
+    details_out.loc[index_home, 'is_older'] = False
+    return details_out, operations
+
+
+def define_forced_details(paths, rootpath_home, rootpath_dest, records=None):
     """
     Build dataframe of file details for directories that will always be copied over from home to destination.
-    Uses functions: standardize_path_names, sort_unique_items, list_directory_files
+    Uses functions: standardize_path_names, sort_unique_items, select_directory_records, lookup_file_record
     :param paths: list of directories to scan, all files/subfolders here will be copied from home to destination
     :param rootpath_home: string, root path for home directory, used to format paths and file list
     :param rootpath_dest: string, root path for destination directory, used to format paths and file list
+    :param records: (optional) dictionary of FileRecord entries keyed by path, from scan_directory_records(), so
+                    directories already scanned are not scanned again
     :return: dataframe of all files with root paths, filenames, and flags for later copying
     """
+    import numpy as np
+    import pandas as pd
     rootpath_home_fmt = standardize_path_names(rootpath_home)
     rootpath_dest_fmt = standardize_path_names(rootpath_dest)
     paths_fmt = standardize_path_names(paths)
+    records_lookup = records if records is not None else {}
     scan_endings = [file[len(rootpath_home_fmt):] for file in paths_fmt if file.startswith(rootpath_home_fmt)]
-    filelist_home = list_directory_files([rootpath_home_fmt + ending for ending in scan_endings])
-    filelist_dest = list_directory_files([rootpath_dest_fmt + ending for ending in scan_endings])
-    endings_home = [file[len(rootpath_home_fmt):] for file in filelist_home if file.startswith(rootpath_home_fmt)]
-    endings_dest = [file[len(rootpath_dest_fmt):] for file in filelist_dest if file.startswith(rootpath_dest_fmt)]
+    records_home = select_directory_records(records_lookup, [rootpath_home_fmt + ending for ending in scan_endings])
+    records_dest = select_directory_records(records_lookup, [rootpath_dest_fmt + ending for ending in scan_endings])
+    records_forced = {**records_home, **records_dest}
+    endings_home = [file[len(rootpath_home_fmt):] for file in records_home if file.startswith(rootpath_home_fmt)]
+    endings_dest = [file[len(rootpath_dest_fmt):] for file in records_dest if file.startswith(rootpath_dest_fmt)]
     endings_all = sort_unique_items(endings_home + endings_dest)
     if len(endings_all) > 0:
-        file_home = [rootpath_home_fmt + ending for ending in endings_all]
-        file_dest = [rootpath_dest_fmt + ending for ending in endings_all]
-        is_home_dir = [os.path.isdir(file) for file in file_home]
-        is_home_file = [os.path.isfile(file) for file in file_home]
-        is_dest_dir = [os.path.isdir(file) for file in file_dest]
-        is_dest_file = [os.path.isfile(file) for file in file_dest]
+        record_home = [lookup_file_record(rootpath_home_fmt + ending, records_forced) for ending in endings_all]
+        record_dest = [lookup_file_record(rootpath_dest_fmt + ending, records_forced) for ending in endings_all]
+        is_home_dir = [record is not None and record.is_dir for record in record_home]
+        is_home_file = [record is not None and not record.is_dir for record in record_home]
+        is_dest_dir = [record is not None and record.is_dir for record in record_dest]
+        is_dest_file = [record is not None and not record.is_dir for record in record_dest]
         details = pd.DataFrame({
             'root_home': rootpath_home_fmt,
             'root_dest': rootpath_dest_fmt,
@@ -333,9 +1316,12 @@ def define_directory_commands(details, cmdtype="bash", remove_nothing=False, ove
     :param overwrite_anything: boolean, whether to overwrite older as well as newer files in the destination
     :return: dictionary with commands ('commands') and multiple diagnostic counts ('count_*').
              'commands' is a list of commands in order: remove file, remove dir, make dir, copy file, overwrite file.
+             'operations' is a list of the same steps as (action, source, target) tuples, where action is one of
+             'rm', 'rmdir', 'mkdir', 'cp', 'cpover' and source is None for removals.
              diagnostic counts include 'count_files', 'count_folders', 'count_older', 'count_newer',
              'count_creations', 'count_deletions', and 'count_overwrites'.
     """
+    import numpy as np
     list_input = standardize_path_names(details['root_home'] + details['ending'])
     list_output = standardize_path_names(details['root_dest'] + details['ending'])
     flag_mkdir = details['is_dir'] & details['in_home'] & np.logical_not(details['in_dest'])
@@ -352,33 +1338,21 @@ def define_directory_commands(details, cmdtype="bash", remove_nothing=False, ove
     else:
         flag_cpover = details['is_file'] & details['in_home'] & details['in_dest'] \
                       & details['is_newer']
-    if cmdtype == "bash":
-        list_input_bash = pd.Series(list_input)
-        list_output_bash = pd.Series(list_output)
-        cmd_rmdir = 'rm -rf "' + list_output_bash[flag_rmdir] + '"'
-        cmd_mkdir = 'mkdir -p "' + list_output_bash[flag_mkdir] + '"'
-        cmd_rm = 'rm -f "' + list_output_bash[flag_rm] + '"'
-        cmd_cp = 'cp -R "' + list_input_bash[flag_cp] + '" "' + list_output_bash[flag_cp] + '"'
-        cmd_cpover = 'cp -Rf "' + list_input_bash[flag_cpover] + '" "' + list_output_bash[flag_cpover] + '"'
-    elif cmdtype == "dos":
-        list_input_win = pd.Series([file.replace('/', '\\') for file in list_input])
-        list_output_win = pd.Series([file.replace('/', '\\') for file in list_output])
-        cmd_rmdir = 'rmdir /s /q "' + list_output_win[flag_rmdir] + '"'
-        cmd_mkdir = 'mkdir "' + list_output_win[flag_mkdir] + '"'
-        cmd_rm = 'del "' + list_output_win[flag_rm] + '"'
-        cmd_cp = 'xcopy /h /q "' + list_input_win[flag_cp] + '" "' + list_output_win[flag_cp] + '*"'
-        cmd_cpover = 'xcopy /h /q /y "' + list_input_win[flag_cpover] + '" "' + list_output_win[flag_cpover] + '"'
-    else:
-        cmd_rmdir, cmd_mkdir, cmd_rm, cmd_cp, cmd_cpover = ("", "", "", "", "")
-    commands = list(cmd_rm) + list(cmd_rmdir) + list(cmd_mkdir) + list(cmd_cp) + list(cmd_cpover)
+    operations = []
+    for action, flags in (('rm', flag_rm), ('rmdir', flag_rmdir), ('mkdir', flag_mkdir),
+                          ('cp', flag_cp), ('cpover', flag_cpover)):
+        operations += [(action, None if action in ('rm', 'rmdir') else source, target)
+                       for (source, target, flag) in zip(list_input, list_output, flags) if flag]
+    commands = format_directory_commands(operations, cmdtype=cmdtype)
     count_files = details['is_file'].sum()
     count_folders = details['is_dir'].sum()
     count_older = details['is_older'].sum()
     count_newer = details['is_newer'].sum()
-    count_creations = len(cmd_mkdir) + len(cmd_cp)
-    count_deletions = len(cmd_rmdir) + len(cmd_rm)
-    count_overwrites = len(cmd_cpover)
+    count_creations = len([operation for operation in operations if operation[0] in ('mkdir', 'cp')])
+    count_deletions = len([operation for operation in operations if operation[0] in ('rm', 'rmdir')])
+    count_overwrites = len([operation for operation in operations if operation[0] == 'cpover'])
     return {'commands': commands,
+            'operations': operations,
             'count_files': count_files,
             'count_folders': count_folders,
             'count_older': count_older,
@@ -388,14 +1362,222 @@ def define_directory_commands(details, cmdtype="bash", remove_nothing=False, ove
             'count_overwrites': count_overwrites}
 
 
+def format_directory_commands(operations, cmdtype="bash"):
+    """
+    Translate planned operations into shell commands, for writing to a script.
+    :param operations: list of (action, source, target) tuples, output 'operations' from define_directory_commands()
+                       (plus any moves from detect_moved_files())
+    :param cmdtype: string, "dos" for Windows DOS commands, "bash" for MacOS/Linux Bash commands
+    :return: list of commands, in the same order as operations (empty if cmdtype is not recognized)
+    """
+    templates = {
+        'bash': {'rm': 'rm -f "{target}"',
+                 'rmdir': 'rm -rf "{target}"',
+                 'mkdir': 'mkdir -p "{target}"',
+                 'cp': 'cp -R "{source}" "{target}"',
+                 'cpover': 'cp -Rf "{source}" "{target}"',
+                 'link': 'ln "{source}" "{target}"',
+                 'cptree': 'cp -R "{source}" "{target}"',
+                 'mv': 'mkdir -p "{parent}" && mv "{source}" "{target}"'},
+        'dos': {'rm': 'del "{target}"',
+                'rmdir': 'rmdir /s /q "{target}"',
+                'mkdir': 'mkdir "{target}"',
+                'cp': 'xcopy /h /q "{source}" "{target}*"',
+                'cpover': 'xcopy /h /q /y "{source}" "{target}"',
+                'link': 'mklink /H "{target}" "{source}"',
+                'cptree': 'xcopy /e /i /h /q "{source}" "{target}"',
+                'mv': '(if not exist "{parent}" mkdir "{parent}") & move "{source}" "{target}"'}
+    }
+    if cmdtype not in templates:
+        return []
+    commands = []
+    for action, source, target in operations:
+        if cmdtype == "dos":
+            source = source.replace('/', '\\') if source is not None else None
+            target = target.replace('/', '\\')
+        parent = target.rpartition('\\' if cmdtype == "dos" else '/')[0]
+        commands.append(templates[cmdtype][action].format(source=source, target=target, parent=parent))
+    return commands
+
+
+def optimize_directory_operations(operations, records=None, bulk=True):
+    """
+    Remove planned operations that other operations already cover, and combine whole new folders into single copies:
+    duplicate operations (e.g., from forced files already planned) are dropped, files and folders inside a folder being
+    removed are not removed separately, a folder is not made separately if a folder inside it is made, and a new
+    folder whose contents are all being copied becomes one 'cptree' operation. A folder is only combined if nothing in
+    it is skipped (e.g., excluded, hidden, or over the size limit), which is checked by listing it again.
+    Uses functions: is_complete_folder
+    :param operations: list of (action, source, target) tuples, output 'operations' from define_directory_commands()
+                       or define_snapshot_operations() (plus any moves from detect_moved_files())
+    :param records: (optional) dictionary of FileRecord entries keyed by path for home, needed to combine new folders
+    :param bulk: boolean, whether to combine new folders into 'cptree' operations
+    :return: list of (action, source, target) tuples, in the same order as operations
+    """
+    seen = set()
+    operations_out = []
+    for operation in operations:
+        key = ('cp' if operation[0] == 'cpover' else operation[0], operation[2])
+        if key not in seen:
+            seen.add(key)
+            operations_out.append(operation)
+
+    def has_ancestor(path, ancestors):
+        parent = path.rpartition('/')[0]
+        while parent != '':
+            if parent in ancestors:
+                return True
+            parent = parent.rpartition('/')[0]
+        return False
+
+    removed = {target for action, _, target in operations_out if action == 'rmdir'}
+    operations_out = [operation for operation in operations_out
+                      if operation[0] not in ('rm', 'rmdir') or not has_ancestor(operation[2], removed)]
+    if bulk and records is not None:
+        paths_home = sorted(records)
+        contents = sorted((target, source, action) for action, source, target in operations_out
+                          if action in ('mkdir', 'cp', 'cpover', 'link'))
+        targets = [target for target, _, _ in contents]
+        combined = set()
+        for action, source, target in operations_out:
+            if action != 'mkdir' or source is None or has_ancestor(target, combined):
+                continue
+            inside = contents[bisect.bisect_left(targets, target + '/'):bisect.bisect_left(targets, target + '/\uffff')]
+            if any(item_action not in ('mkdir', 'cp') or item_source is None
+                   or item_target[len(target):] != item_source[len(source):]
+                   for item_target, item_source, item_action in inside):
+                continue
+            inside_home = paths_home[bisect.bisect_left(paths_home, source + '/'):
+                                     bisect.bisect_left(paths_home, source + '/\uffff')]
+            if sorted(item_source for _, item_source, _ in inside) != inside_home \
+                    or not is_complete_folder(source, set(inside_home)):
+                continue
+            combined.add(target)
+        operations_out = [('cptree', operation[1], operation[2]) if operation[0] == 'mkdir'
+                          and operation[2] in combined else operation for operation in operations_out
+                          if not has_ancestor(operation[2], combined)]
+    made = set()
+    for action, _, target in operations_out:
+        if action == 'mkdir':
+            parent = target.rpartition('/')[0]
+            while parent != '' and parent not in made:
+                made.add(parent)
+                parent = parent.rpartition('/')[0]
+    return [operation for operation in operations_out if operation[0] != 'mkdir' or operation[2] not in made]
+
+
+def is_complete_folder(rootpath, paths):
+    """
+    Check whether everything in a folder (at any depth) is in a set of paths, i.e., nothing in it was skipped.
+    :param rootpath: string, path of folder
+    :param paths: set of strings, paths of files/folders expected inside folder
+    :return: boolean, whether the folder holds exactly the paths given
+    """
+    count = 0
+    for folder, names_folder, names_file in os.walk(rootpath):
+        folder = folder.replace('\\', '/')
+        for name in names_folder + names_file:
+            if folder + '/' + name not in paths:
+                return False
+            count += 1
+    return count == len(paths)
+
+
+def define_snapshot_operations(details, rootpath_snapshot, overwrite_anything=False):
+    """
+    Translate conditions into operations that build a new snapshot folder from home and the previous snapshot. Every
+    folder in home is created in the new snapshot, new and changed files are copied from home, and unchanged files are
+    hard-linked from the previous snapshot so they take no extra space. Anything not in home is simply left out.
+    Uses functions: standardize_path_names
+    :param details: dataframe of file details comparing home to the previous snapshot (or to the new snapshot folder if
+                    there is none yet), output from join_directory_details()
+    :param rootpath_snapshot: string, path of the new snapshot folder
+    :param overwrite_anything: boolean, whether to copy files that are older in home as well as newer ones
+    :return: list of (action, source, target) tuples, where action is one of 'mkdir', 'link', 'cp'
+    """
+    rootpath_snapshot_fmt = standardize_path_names(rootpath_snapshot)
+    list_input = standardize_path_names(details['root_home'] + details['ending'])
+    list_previous = standardize_path_names(details['root_dest'] + details['ending'])
+    operations = [('mkdir', None, rootpath_snapshot_fmt)]
+    rows = zip(list_input, list_previous, details['ending'], details['in_home'], details['in_dest'],
+               details['is_dir'], details['is_file'], details['is_newer'], details['is_older'])
+    for source, previous, ending, in_home, in_dest, is_dir, is_file, is_newer, is_older in rows:
+        if not in_home:
+            continue
+        target = rootpath_snapshot_fmt + ending
+        if is_dir:
+            operations.append(('mkdir', source, target))
+        elif is_file and in_dest and not (is_newer or (overwrite_anything and is_older)):
+            operations.append(('link', previous, target))
+        elif is_file:
+            operations.append(('cp', source, target))
+    return operations
+
+
+def list_snapshots(rootpath):
+    """
+    List snapshot folders (named by date and time, e.g., '2018-10-07-120000') in the destination directory.
+    Uses functions: standardize_path_names, sort_unique_items
+    :param rootpath: string, destination directory holding the snapshots
+    :return: list of snapshot folder paths, oldest first
+    """
+    rootpath_fmt = standardize_path_names(rootpath)
+    try:
+        names = [entry.name for entry in os.scandir(rootpath_fmt) if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        names = []
+    names = [name for name in names if re.search(r'^\d{4}-\d{2}-\d{2}-\d{6}$', name) is not None]
+    return [rootpath_fmt + "/" + name for name in sort_unique_items(names)]
+
+
+def define_snapshot_path(rootpath):
+    """
+    Define the path of a new snapshot folder, named by the current date and time.
+    Uses functions: standardize_path_names
+    :param rootpath: string, destination directory holding the snapshots
+    :return: string, path of the new snapshot folder (not created yet)
+    """
+    return standardize_path_names(rootpath) + "/" + datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+
+
+def prune_snapshots(rootpath, keep_daily=7, keep_weekly=4, workers=8):
+    """
+    Remove old snapshot folders, keeping the newest snapshot overall, the newest snapshot on each of the last
+    keep_daily days with a snapshot, and the newest snapshot in each of the last keep_weekly weeks with a snapshot.
+    Uses functions: list_snapshots, execute_directory_operations
+    :param rootpath: string, destination directory holding the snapshots
+    :param keep_daily: integer, number of days to keep a snapshot for
+    :param keep_weekly: integer, number of weeks to keep a snapshot for
+    :param workers: integer, number of snapshots removed at the same time
+    :return: list of snapshot folder paths that were removed
+    """
+    snapshots = list_snapshots(rootpath)
+    keep = set(snapshots[-1:])
+    days = {}
+    weeks = {}
+    for snapshot in snapshots:
+        stamp = datetime.datetime.strptime(snapshot.rpartition('/')[2], "%Y-%m-%d-%H%M%S")
+        days[stamp.date()] = snapshot
+        weeks[stamp.isocalendar()[:2]] = snapshot
+    keep.update([days[day] for day in sorted(days)[-keep_daily:]] if keep_daily > 0 else [])
+    keep.update([weeks[week] for week in sorted(weeks)[-keep_weekly:]] if keep_weekly > 0 else [])
+    operations = [('rmdir', None, snapshot) for snapshot in snapshots if snapshot not in keep]
+    results = execute_directory_operations(operations, workers=workers)
+    return [target for (_, _, target) in results['completed']]
+
+
 def check_directory_commands(commands_all):
     """
     Scan commands dictionary and results to report what they will do and generate warning messages if problems found.
-    :param commands_all: dictionary of commands and diagnostic checks, output from define_directory_commands()
+    :param commands_all: dictionary of commands and diagnostic checks, output from define_directory_commands() or
+                         stream_directory_backup()
     :return: dictionary with two entries, 'message' with general message and summary of commands, and
              'warning_flag' indicating whether a warning was raised (True or False).
     """
-    count_commands = len(commands_all['commands'])
+    if 'count_commands' in commands_all:
+        count_commands = commands_all['count_commands']
+    else:
+        count_commands = len(commands_all['commands'])
     count_files = commands_all['count_files']
     count_folders = commands_all['count_folders']
     count_older = commands_all['count_older']
@@ -403,13 +1585,14 @@ def check_directory_commands(commands_all):
     count_creations = commands_all['count_creations']
     count_deletions = commands_all['count_deletions']
     count_overwrites = commands_all['count_overwrites']
+    count_moves = commands_all.get('count_moves', 0)
     notes_misc = []
     if count_files + count_folders == count_creations:
         notes_misc.append("All contents of source will be copied to destination, meaning that this is the first time "
                           "this program has been run and the destination directory does not yet exist. If that is not "
                           "true, then cancel the program now.")
     warning_flag = False
-    if (count_deletions / count_files) > 0.5:
+    if count_files > 0 and (count_deletions / count_files) > 0.5:
         warnings.warn("Commands will delete a large portion of files in destination. "
                       "Make sure the home and destination directories are not mixed up.",
                       Warning)
@@ -423,8 +1606,10 @@ def check_directory_commands(commands_all):
         "Summary of commands:",
         f"{count_files} files and {count_folders} folders detected between home and destination.",
         f"{count_newer} newer files in home, {count_older} newer files in destination.",
-        f"{count_commands} total commands.",
-        f"{count_creations} creations, {count_deletions} deletions, {count_overwrites} overwrites.",
+        f"{count_commands} total commands." if 'count_unoptimized' not in commands_all else
+        f"{count_commands} total commands ({commands_all['count_unoptimized']} before combining overlapping ones).",
+        f"{count_creations} creations, {count_deletions} deletions, {count_overwrites} overwrites, "
+        f"{count_moves} moves.",
         ""
     ]
     if len(notes_misc) > 0:
@@ -474,23 +1659,2230 @@ def run_directory_commands(commands, cmdtype="bash", tmpfile="~temp_backup",
     return None
 
 
-def drop_datetime_log(outpath, contents=None):
+def walk_directory_sorted(rootpath, scan=None, exclude=None, prune=None):
+    """
+    Walk directory(s) one folder at a time in a fixed order (each folder followed by its contents, with names sorted),
+    so two directories walked this way can be compared entry by entry. Only the folders on the current path are held
+    in memory, so memory grows with the depth of the directory rather than the number of files.
+    Uses functions: standardize_path_names, sort_unique_items, build_file_record, is_record_excluded,
+                    scan_folder_records
+    :param rootpath: string, root path that endings are relative to
+    :param scan: (optional) string or list of directory(s) inside rootpath to walk (default is rootpath itself)
+    :param exclude: (optional) function from compile_exclude_filter(), matching files/folders are left out
+    :param prune: (optional) set of folder paths; a folder added to it before the next entry is requested is not read
+    :return: generator of (ending, FileRecord) tuples, where ending is the path relative to rootpath
+    """
+    rootpath_fmt = standardize_path_names(rootpath)
+    scan_paths = standardize_path_names(scan if scan is not None else rootpath)
+    if type(scan_paths) == str:
+        scan_paths = [scan_paths]
+    scan_paths = [path for path in scan_paths if path.startswith(rootpath_fmt)]
+    scan_paths.sort(key=lambda path: path[len(rootpath_fmt):].split('/'))
+    scan_roots = []
+    for path in scan_paths:
+        if len(scan_roots) == 0 or not (path == scan_roots[-1] or path.startswith(scan_roots[-1] + '/')):
+            scan_roots.append(path)
+    for scan_path in scan_roots:
+        try:
+            scan_record = build_file_record(scan_path, os.stat(scan_path))
+        except OSError:
+            continue
+        if scan_record is None or is_record_excluded(scan_record, rootpath_fmt, exclude):
+            continue
+        stack = [iter([(scan_record, scan_record.is_dir)])]
+        while len(stack) > 0:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+            record, descend = entry
+            ending = record.path[len(rootpath_fmt):]
+            if ending != "":
+                yield ending, record
+            if descend and (prune is None or record.path not in prune):
+                found, subfolders = scan_folder_records(record, rootpath=rootpath_fmt, exclude=exclude)
+                subfolder_paths = set([subfolder.path for subfolder in subfolders])
+                stack.append(iter([(found[path], path in subfolder_paths) for path in sorted(found)]))
+
+
+def diff_directory_streams(stream_home, stream_dest, rootpath_home, rootpath_dest, scan_home=None,
+                           remove_nothing=False, overwrite_anything=False, force_copy=False,
+                           prune=None, counts=None, stop_if_warned=False, check_after=1000):
+    """
+    Compare two directories walked by walk_directory_sorted() one entry at a time, yielding operations as soon as
+    they are known. Follows the same rules as join_directory_details() and define_directory_commands(). A folder only
+    in the destination is removed as a whole and not read. Destination entries outside the scanned home folders are
+    checked on disk, as with lookup_file_record(). Removals are held back until check_after files have been compared,
+    and if more than half of the files compared so far would be removed, a warning is raised and (if stop_if_warned)
+    nothing more is yielded. With check_after=None removals are not held back or checked (e.g., when only a few paths
+    known to have changed are compared).
+    Uses functions: standardize_path_names, build_file_record
+    :param stream_home: generator of (ending, FileRecord) tuples for home, from walk_directory_sorted()
+    :param stream_dest: generator of (ending, FileRecord) tuples for destination, from walk_directory_sorted()
+    :param rootpath_home: string, root path for home directory
+    :param rootpath_dest: string, root path for destination directory
+    :param scan_home: (optional) list of directory(s) walked in home (default is all of home)
+    :param remove_nothing: boolean, whether to avoid removing anything from the destination
+    :param overwrite_anything: boolean, whether to overwrite older as well as newer files in the destination
+    :param force_copy: boolean, whether to copy every file in home regardless of time modified (see to_force.txt)
+    :param prune: (optional) set shared with the destination walk_directory_sorted(), folders being removed are
+                  added so they are not read
+    :param counts: (optional) dictionary updated with counts like those from define_directory_commands() and a
+                   'warning_flag' entry
+    :param stop_if_warned: boolean, whether to stop yielding operations if a warning is raised
+    :param check_after: (optional) integer, number of files to compare before removals are allowed through
+    :return: generator of (action, source, target) tuples, see define_directory_commands()
+    """
+    rootpath_home_fmt = standardize_path_names(rootpath_home)
+    rootpath_dest_fmt = standardize_path_names(rootpath_dest)
+    scan_endings = None
+    if scan_home is not None:
+        scan_endings = [path[len(rootpath_home_fmt):] for path in standardize_path_names(scan_home)
+                        if path.startswith(rootpath_home_fmt)]
+    counts = counts if counts is not None else {}
+    for name in ('count_files', 'count_folders', 'count_older', 'count_newer',
+                 'count_creations', 'count_deletions', 'count_overwrites'):
+        counts.setdefault(name, 0)
+    counts.setdefault('warning_flag', False)
+    held = []
+    entry_home = next(stream_home, None)
+    entry_dest = next(stream_dest, None)
+    while entry_home is not None or entry_dest is not None:
+        key_home = entry_home[0].split('/') if entry_home is not None else None
+        key_dest = entry_dest[0].split('/') if entry_dest is not None else None
+        if entry_dest is None or (entry_home is not None and key_home < key_dest):
+            ending, record_home, record_dest = entry_home[0], entry_home[1], None
+            entry_home = next(stream_home, None)
+        elif entry_home is None or key_dest < key_home:
+            ending, record_home, record_dest = entry_dest[0], None, entry_dest[1]
+            if scan_endings is not None and not any(ending == item or ending.startswith(item + '/')
+                                                    for item in scan_endings):
+                try:
+                    record_home = build_file_record(rootpath_home_fmt + ending, os.stat(rootpath_home_fmt + ending))
+                except OSError:
+                    record_home = None
+            if record_home is None and record_dest.is_dir and not remove_nothing and not force_copy \
+                    and prune is not None:
+                prune.add(record_dest.path)
+            entry_dest = next(stream_dest, None)
+        else:
+            ending, record_home, record_dest = entry_home[0], entry_home[1], entry_dest[1]
+            entry_home = next(stream_home, None)
+            entry_dest = next(stream_dest, None)
+        operation = None
+        is_dir = (record_home is not None and record_home.is_dir) or (record_dest is not None and record_dest.is_dir)
+        is_file = (record_home is not None and not record_home.is_dir) or \
+                  (record_dest is not None and not record_dest.is_dir)
+        counts['count_folders'] += int(is_dir)
+        counts['count_files'] += int(is_file)
+        if record_home is not None and record_dest is None:
+            operation = ('mkdir' if record_home.is_dir else 'cp', record_home.path, rootpath_dest_fmt + ending)
+            counts['count_creations'] += 1
+            counts['count_newer'] += int(force_copy and is_file)
+        elif record_home is None and record_dest is not None:
+            if not remove_nothing and not force_copy:
+                operation = ('rmdir' if record_dest.is_dir else 'rm', None, record_dest.path)
+                counts['count_deletions'] += 1
+        elif record_home.is_dir or record_dest.is_dir:
+            pass
+        else:
+            is_newer = force_copy or record_home.mtime > record_dest.mtime
+            is_older = not force_copy and record_home.mtime < record_dest.mtime
+            counts['count_newer'] += int(is_newer)
+            counts['count_older'] += int(is_older)
+            if is_newer or (overwrite_anything and is_older):
+                operation = ('cpover', record_home.path, record_dest.path)
+                counts['count_overwrites'] += 1
+        if check_after is not None and counts['count_files'] >= check_after \
+                and counts['count_deletions'] / counts['count_files'] > 0.5 and not counts['warning_flag']:
+            warnings.warn("Commands will delete a large portion of files in destination. "
+                          "Make sure the home and destination directories are not mixed up.",
+                          Warning)
+            counts['warning_flag'] = True
+        if counts['warning_flag'] and stop_if_warned:
+            return
+        if operation is not None and operation[0] in ('rm', 'rmdir') and check_after is not None \
+                and counts['count_files'] < check_after:
+            held.append(operation)
+        elif operation is not None:
+            yield from held
+            held = []
+            yield operation
+    if check_after is not None and counts['count_files'] > 0 \
+            and counts['count_deletions'] / counts['count_files'] > 0.5 and not counts['warning_flag']:
+        warnings.warn("Commands will delete a large portion of files in destination. "
+                      "Make sure the home and destination directories are not mixed up.",
+                      Warning)
+        counts['warning_flag'] = True
+    if not (counts['warning_flag'] and stop_if_warned):
+        yield from held
+
+
+def stream_directory_backup(scan, rootpath_home, rootpath_dest, skip=None, force=None, keep_hidden=True,
+                            sizelimit=None, remove_nothing=False, overwrite_anything=False, stop_if_warned=True,
+                            workers=8, wait_to_run=False, script_file=None, cmdtype="bash", **copy_options):
+    """
+    Back up home to destination in one pass without building lists or dataframes of every file: both directories are
+    walked in the same order, compared one entry at a time, and each operation is applied (or written to a script) as
+    soon as it is known. Memory grows with the depth of the directories rather than the number of files.
+    Uses functions: compile_exclude_filter, walk_directory_sorted, diff_directory_streams, execute_operation_stream,
+                    format_directory_commands, standardize_path_names
+    :param scan: list of directory(s) in home to back up
+    :param rootpath_home: string, root path for home directory
+    :param rootpath_dest: string, root path for destination directory
+    :param skip: (optional) list of files/folders/patterns to skip (see compile_exclude_filter)
+    :param force: (optional) list of files/folders to always copy (see define_forced_details)
+    :param keep_hidden: boolean, whether to keep hidden files
+    :param sizelimit: filesize limit in bytes (optional, larger files are skipped)
+    :param remove_nothing: boolean, whether to avoid removing anything from the destination
+    :param overwrite_anything: boolean, whether to overwrite older as well as newer files in the destination
+    :param stop_if_warned: boolean, whether to stop if the comparison looks like home and destination are mixed up
+    :param workers: integer, number of operations run at the same time
+    :param wait_to_run: boolean, whether to pause for confirmation from user before starting
+    :param script_file: (optional) string, if given operations are written to this script instead of run
+    :param cmdtype: string, "dos" or "bash", style of commands written to script_file
+    :param copy_options: (optional) other arguments passed to execute_operation_stream() (e.g., delta_threshold)
+    :return: dictionary with counts like define_directory_commands(), 'count_commands', 'warning_flag', and
+             results like execute_operation_stream()
+    """
+    rootpath_home_fmt = standardize_path_names(rootpath_home)
+    rootpath_dest_fmt = standardize_path_names(rootpath_dest)
+    force_fmt = standardize_path_names(force) if force is not None else []
+    exclude = compile_exclude_filter((skip if skip is not None else []) + force_fmt, rootpath_home_fmt,
+                                     keep_hidden=keep_hidden, sizelimit=sizelimit)
+    counts = {}
+    prune = set()
+    operations = diff_directory_streams(
+        walk_directory_sorted(rootpath_home_fmt, scan, exclude=exclude),
+        walk_directory_sorted(rootpath_dest_fmt, exclude=exclude, prune=prune),
+        rootpath_home_fmt, rootpath_dest_fmt, scan_home=scan, remove_nothing=remove_nothing,
+        overwrite_anything=overwrite_anything, prune=prune, counts=counts, stop_if_warned=stop_if_warned
+    )
+    if len(force_fmt) > 0:
+        force_endings = [path[len(rootpath_home_fmt):] for path in force_fmt if path.startswith(rootpath_home_fmt)]
+        operations = itertools.chain(operations, diff_directory_streams(
+            walk_directory_sorted(rootpath_home_fmt, [rootpath_home_fmt + ending for ending in force_endings]),
+            walk_directory_sorted(rootpath_dest_fmt, [rootpath_dest_fmt + ending for ending in force_endings]),
+            rootpath_home_fmt, rootpath_dest_fmt, force_copy=True, counts=counts
+        ))
+    if wait_to_run:
+        input("Press enter to continue...")
+    if script_file is not None:
+        count_commands = 0
+        with open(script_file, "w", encoding="utf8") as file:
+            for operation in operations:
+                file.write("%s\n" % format_directory_commands([operation], cmdtype=cmdtype)[0])
+                count_commands += 1
+        results = {'count_completed': 0, 'errors': [], 'bytes_copied': 0, 'seconds': 0.0, 'slowest': []}
+    else:
+        results = execute_operation_stream(operations, workers=workers, **copy_options)
+        count_commands = results['count_completed'] + len(results['errors'])
+    return {**counts, **results, 'count_commands': count_commands}
+
+
+def execute_operation_stream(operations, workers=8, max_pending=None, progress=False, completed=None,
+                             **copy_options):
+    """
+    Apply operations as they are produced by a generator, keeping a limited number queued at once. A copy into a
+    folder that has not been created yet creates it first, so operations do not have to wait for each other.
+    Uses functions: apply_timed_operation, track_slowest_operations, show_operation_progress
+    :param operations: iterable of (action, source, target) tuples, e.g., from diff_directory_streams()
+    :param workers: integer, number of operations run at the same time
+    :param max_pending: (optional) integer, most operations queued at once (default is four per worker)
+    :param progress: boolean, whether to show progress while running
+    :param completed: (optional) list, operations that succeed are appended to it (e.g., to update records)
+    :param copy_options: (optional) other arguments passed to apply_directory_operation() (e.g., delta_threshold)
+    :return: dictionary with 'count_completed' (number of operations that succeeded), 'errors' (list of
+             (operation, message) tuples for operations that failed), 'bytes_copied' (total bytes copied), 'seconds'
+             (time taken), and 'slowest' (list of (seconds, operation) tuples for the slowest operations)
+    """
+    max_pending = max_pending if max_pending is not None else 4 * max(1, workers)
+    results = {'count_completed': 0, 'errors': [], 'bytes_copied': 0, 'slowest': [], 'time_shown': 0.0}
+    pending = {}
+    time_start = time.perf_counter()
+
+    def collect(futures):
+        for future in futures:
+            operation = pending.pop(future)
+            try:
+                size, seconds = future.result()
+                results['bytes_copied'] += size
+                results['count_completed'] += 1
+                track_slowest_operations(results['slowest'], operation, seconds)
+                if completed is not None:
+                    completed.append(operation)
+            except Exception as error:
+                results['errors'].append((operation, str(error)))
+            if progress:
+                results['time_shown'] = show_operation_progress(results['count_completed'] + len(results['errors']),
+                                                                None, results['bytes_copied'], time_start,
+                                                                results['time_shown'])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for operation in operations:
+            if len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(apply_timed_operation, operation, **copy_options)] = operation
+        collect(list(concurrent.futures.as_completed(list(pending))))
+    if progress:
+        show_operation_progress(results['count_completed'] + len(results['errors']), None, results['bytes_copied'],
+                                time_start, final=True)
+    del results['time_shown']
+    results['seconds'] = time.perf_counter() - time_start
+    results['slowest'] = sorted(results['slowest'], reverse=True)
+    return results
+
+
+def open_inotify():
+    """
+    Open an inotify instance through the C library (Linux only), for watching folders for changes.
+    :return: tuple of (C library handle, inotify file descriptor)
+    """
+    if not sys.platform.startswith('linux'):
+        raise OSError("Watching for changes needs inotify, which is only available on Linux.")
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    fd = libc.inotify_init1(INOTIFY_FLAGS['IN_NONBLOCK'] | INOTIFY_FLAGS['IN_CLOEXEC'])
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, f"Could not start inotify: {os.strerror(error)}")
+    return libc, fd
+
+
+def add_inotify_watches(inotify, scan, watches, rootpath=None, exclude=None):
+    """
+    Watch selected folder(s) and every folder inside them for changes. Folders already watched are updated in place.
+    Uses functions: walk_directory_sorted
+    :param inotify: tuple of (C library handle, inotify file descriptor), output from open_inotify()
+    :param scan: string or list of folder(s) to watch
+    :param watches: dictionary of folder paths keyed by watch descriptor, updated in place
+    :param rootpath: (optional) string, root path that exclude checks are relative to (required if exclude is given)
+    :param exclude: (optional) function from compile_exclude_filter(), matching folders are not watched
+    :return: None
+    """
+    libc, fd = inotify
+    mask = INOTIFY_FLAGS['IN_ONLYDIR']
+    for name in ('IN_ATTRIB', 'IN_CLOSE_WRITE', 'IN_MOVED_FROM', 'IN_MOVED_TO', 'IN_CREATE', 'IN_DELETE',
+                 'IN_DELETE_SELF', 'IN_MOVE_SELF'):
+        mask |= INOTIFY_FLAGS[name]
+    scan_paths = standardize_path_names(scan)
+    if type(scan_paths) == str:
+        scan_paths = [scan_paths]
+    for scan_path in scan_paths:
+        folders = [scan_path] if os.path.isdir(scan_path) else []
+        folders += [record.path for _, record in walk_directory_sorted(rootpath if rootpath is not None else scan_path,
+                                                                       [scan_path], exclude=exclude)
+                    if record.is_dir and record.path != scan_path]
+        for folder in folders:
+            wd = libc.inotify_add_watch(fd, folder.encode(), ctypes.c_uint32(mask))
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "Too many folders to watch; raise fs.inotify.max_user_watches.")
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, f"Could not watch {folder}: {os.strerror(error)}")
+            watches[wd] = folder
+    return None
+
+
+def read_inotify_events(inotify, watches, timeout=None):
+    """
+    Wait for and read pending inotify events. Watches of folders that were removed or moved away are dropped.
+    :param inotify: tuple of (C library handle, inotify file descriptor), output from open_inotify()
+    :param watches: dictionary of folder paths keyed by watch descriptor, updated in place
+    :param timeout: (optional) float, most seconds to wait for events (None waits until there is one)
+    :return: tuple of (list of (path, mask) tuples for files/folders that changed, boolean for whether the event queue
+             overflowed so some changes were missed)
+    """
+    libc, fd = inotify
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if len(readable) == 0:
+        return [], False
+    try:
+        buffer = os.read(fd, 1024 * 1024)
+    except BlockingIOError:
+        return [], False
+    events = []
+    overflow = False
+    offset = 0
+    while offset + 16 <= len(buffer):
+        wd, mask, _, length = struct.unpack_from('iIII', buffer, offset)
+        name = buffer[offset + 16:offset + 16 + length].split(b'\0', 1)[0].decode(errors='surrogateescape')
+        offset += 16 + length
+        if mask & INOTIFY_FLAGS['IN_Q_OVERFLOW']:
+            overflow = True
+            continue
+        folder = watches.get(wd)
+        if folder is None:
+            continue
+        if mask & INOTIFY_FLAGS['IN_IGNORED']:
+            del watches[wd]
+            continue
+        if mask & INOTIFY_FLAGS['IN_MOVE_SELF']:
+            libc.inotify_rm_watch(fd, wd)
+            continue
+        if mask & INOTIFY_FLAGS['IN_DELETE_SELF']:
+            continue
+        events.append((folder + '/' + name if name != '' else folder, mask))
+    return events, overflow
+
+
+def sync_dirty_paths(paths, rootpath_home, rootpath_dest, exclude=None, force=None, remove_nothing=False,
+                     overwrite_anything=False, workers=8, **copy_options):
+    """
+    Back up only the files/folders that are known to have changed, following the same rules as a full backup (see
+    diff_directory_streams). Paths inside another changed folder are covered by it, and paths in force are always
+    copied.
+    Uses functions: standardize_path_names, sort_unique_items, walk_directory_sorted, diff_directory_streams,
+                    execute_operation_stream
+    :param paths: list of paths in home that changed (they may no longer exist)
+    :param rootpath_home: string, root path for home directory
+    :param rootpath_dest: string, root path for destination directory
+    :param exclude: (optional) function from compile_exclude_filter(), matching files/folders are left out
+    :param force: (optional) list of files/folders to always copy (see define_forced_details)
+    :param remove_nothing: boolean, whether to avoid removing anything from the destination
+    :param overwrite_anything: boolean, whether to overwrite older as well as newer files in the destination
+    :param workers: integer, number of operations run at the same time
+    :param copy_options: (optional) other arguments passed to execute_operation_stream() (e.g., delta_threshold)
+    :return: dictionary with counts like define_directory_commands(), 'count_commands', and results like
+             execute_operation_stream()
+    """
+    rootpath_home_fmt = standardize_path_names(rootpath_home)
+    rootpath_dest_fmt = standardize_path_names(rootpath_dest)
+    force_fmt = standardize_path_names(force) if force is not None else []
+    roots = []
+    for path in sorted(sort_unique_items(standardize_path_names(paths)), key=lambda item: item.split('/')):
+        if path.startswith(rootpath_home_fmt + '/') and \
+                not (len(roots) > 0 and (path == roots[-1] or path.startswith(roots[-1] + '/'))):
+            roots.append(path)
+    counts = {}
+    streams = []
+    for path in roots:
+        ending = path[len(rootpath_home_fmt):]
+        force_copy = any(path == item or path.startswith(item + '/') for item in force_fmt)
+        prune = set()
+        streams.append(diff_directory_streams(
+            walk_directory_sorted(rootpath_home_fmt, [path], exclude=None if force_copy else exclude),
+            walk_directory_sorted(rootpath_dest_fmt, [rootpath_dest_fmt + ending],
+                                  exclude=None if force_copy else exclude, prune=prune),
+            rootpath_home_fmt, rootpath_dest_fmt, scan_home=[path], remove_nothing=remove_nothing,
+            overwrite_anything=overwrite_anything, force_copy=force_copy, prune=prune, counts=counts,
+            check_after=None))
+    results = execute_operation_stream(itertools.chain(*streams), workers=workers, **copy_options)
+    return {**counts, **results, 'count_commands': results['count_completed'] + len(results['errors'])}
+
+
+def watch_directory_backup(scan, rootpath_home, rootpath_dest, skip=None, force=None, keep_hidden=True,
+                           sizelimit=None, remove_nothing=False, overwrite_anything=False, stop_if_warned=True,
+                           workers=8, debounce=2.0, max_delay=30.0, reconcile_every=6 * 3600, run_for=None,
+                           dbfile=None, settings=None, **copy_options):
+    """
+    Keep destination in step with home continuously (Linux only). Every folder being backed up is watched with
+    inotify, and changed paths are collected until no more changes have come in for debounce seconds (or the oldest
+    has waited max_delay seconds), then only those paths are backed up. A full backup runs at the start, every
+    reconcile_every seconds, and whenever the event queue overflows, to catch anything missed. Nothing is backed up
+    while a folder being backed up is missing, so a removed drive does not empty the destination. If a scan manifest
+    was saved by a full run, it is kept up to date with every backup (see update_watched_manifest).
+    Uses functions: compile_exclude_filter, open_inotify, add_inotify_watches, read_inotify_events,
+                    sync_dirty_paths, stream_directory_backup, check_directory_commands, summarize_operation_results,
+                    drop_datetime_log, load_scan_manifest, update_watched_manifest
+    :param scan: list of directory(s) in home to back up
+    :param rootpath_home: string, root path for home directory
+    :param rootpath_dest: string, root path for destination directory
+    :param skip: (optional) list of files/folders/patterns to skip (see compile_exclude_filter)
+    :param force: (optional) list of files/folders to always copy (see define_forced_details)
+    :param keep_hidden: boolean, whether to keep hidden files
+    :param sizelimit: filesize limit in bytes (optional, larger files are skipped)
+    :param remove_nothing: boolean, whether to avoid removing anything from the destination
+    :param overwrite_anything: boolean, whether to overwrite older as well as newer files in the destination
+    :param stop_if_warned: boolean, whether a full backup stops if it looks like home and destination are mixed up
+    :param workers: integer, number of operations run at the same time
+    :param debounce: float, seconds without new changes before changed paths are backed up
+    :param max_delay: float, most seconds a changed path waits before it is backed up
+    :param reconcile_every: float, seconds between full backups
+    :param run_for: (optional) float, seconds to keep watching (default is until interrupted)
+    :param dbfile: (optional) string, path of the SQLite manifest file in destination (see save_scan_manifest)
+    :param settings: (optional) string describing the scan settings, checked by load_scan_manifest()
+    :param copy_options: (optional) other arguments passed to execute_operation_stream() (e.g., delta_threshold)
+    :return: None
+    """
+    rootpath_home_fmt = standardize_path_names(rootpath_home)
+    scan_paths = standardize_path_names(scan)
+    scan_paths = [scan_paths] if type(scan_paths) == str else scan_paths
+    force_fmt = standardize_path_names(force) if force is not None else []
+    exclude = compile_exclude_filter((skip if skip is not None else []) + force_fmt, rootpath_home_fmt,
+                                     keep_hidden=keep_hidden, sizelimit=sizelimit)
+    exclude_dirty = compile_exclude_filter(skip, rootpath_home_fmt, keep_hidden=keep_hidden)
+    manifest = load_scan_manifest(dbfile, settings=settings)
+    inotify = open_inotify()
+    watches = {}
+    time_end = time.monotonic() + run_for if run_for is not None else None
+    time_reconcile = None
+    dirty = {}
+    time_event = 0.0
+    missing_flag = False
+    try:
+        while time_end is None or time.monotonic() < time_end:
+            time_now = time.monotonic()
+            if not all(os.path.isdir(path) for path in scan_paths):
+                if not missing_flag:
+                    print("A folder being backed up is missing; waiting for it to come back.")
+                    missing_flag = True
+                read_inotify_events(inotify, watches, timeout=min([max_delay] + ([time_end - time_now]
+                                                                                 if time_end is not None else [])))
+                time_reconcile = None
+                dirty = {}
+                continue
+            missing_flag = False
+            if time_reconcile is None or time_now - time_reconcile >= reconcile_every:
+                add_inotify_watches(inotify, scan_paths, watches, rootpath=rootpath_home_fmt, exclude=exclude_dirty)
+                completed = []
+                results = stream_directory_backup(scan_paths, rootpath_home_fmt, rootpath_dest, skip=skip, force=force,
+                                                  keep_hidden=keep_hidden, sizelimit=sizelimit,
+                                                  remove_nothing=remove_nothing,
+                                                  overwrite_anything=overwrite_anything,
+                                                  stop_if_warned=stop_if_warned, workers=workers,
+                                                  completed=completed, **copy_options)
+                update_watched_manifest(dbfile, manifest, completed, settings=settings)
+                message = check_directory_commands(results)['message'] + summarize_operation_results(results)
+                print('\n'.join(message))
+                if not (stop_if_warned and results['warning_flag']):
+                    drop_datetime_log(rootpath_dest, contents=message)
+                time_reconcile = time.monotonic()
+                dirty = {}
+                continue
+            timeouts = [time_reconcile + reconcile_every - time_now]
+            if len(dirty) > 0:
+                timeouts += [time_event + debounce - time_now, min(dirty.values()) + max_delay - time_now]
+            if time_end is not None:
+                timeouts.append(time_end - time_now)
+            events, overflow = read_inotify_events(inotify, watches, timeout=max(0.0, min(timeouts)))
+            time_now = time.monotonic()
+            for path, mask in events:
+                if not path.startswith(rootpath_home_fmt + '/') or exclude_dirty(path[len(rootpath_home_fmt):]):
+                    continue
+                dirty.setdefault(path, time_now)
+                time_event = time_now
+                if mask & INOTIFY_FLAGS['IN_ISDIR'] and mask & (INOTIFY_FLAGS['IN_CREATE'] |
+                                                                INOTIFY_FLAGS['IN_MOVED_TO']):
+                    add_inotify_watches(inotify, [path], watches, rootpath=rootpath_home_fmt, exclude=exclude_dirty)
+            if overflow:
+                print("Missed some changes (too many at once); running a full backup.")
+                time_reconcile = None
+            elif len(dirty) > 0 and (time_now - time_event >= debounce or
+                                     time_now - min(dirty.values()) >= max_delay):
+                completed = []
+                results = sync_dirty_paths(list(dirty), rootpath_home_fmt, rootpath_dest, exclude=exclude,
+                                           force=force_fmt, remove_nothing=remove_nothing,
+                                           overwrite_anything=overwrite_anything, workers=workers,
+                                           completed=completed, **copy_options)
+                update_watched_manifest(dbfile, manifest, completed, settings=settings)
+                print(f"{datetime.datetime.now().isoformat(timespec='seconds')} Backed up {len(dirty)} changed "
+                      f"paths: {results['count_creations']} creations, {results['count_deletions']} deletions, "
+                      f"{results['count_overwrites']} overwrites, {len(results['errors'])} failed.")
+                if len(results['errors']) > 0:
+                    print('\n'.join(summarize_operation_results(results)))
+                dirty = {}
+    finally:
+        os.close(inotify[1])
+    return None
+
+
+def update_watched_manifest(dbfile, manifest, operations, settings=None):
+    """
+    Apply operations made while watching for changes to the records of a scan manifest, and save them, so the next full
+    run starts from records that match the destination. Home records of the files/folders copied are checked on disk.
+    Nothing is saved if there is no manifest from a full run to update, since records of only the paths that changed
+    would look like a complete scan.
+    Uses functions: build_file_record, update_destination_records, save_scan_manifest
+    :param dbfile: (optional) string, path of the SQLite manifest file
+    :param manifest: dictionary with 'home' and 'dest' records, output from load_scan_manifest(), updated in place
+    :param operations: list of (action, source, target) tuples that were completed
+    :param settings: (optional) string describing the scan settings, saved with the records
+    :return: None
+    """
+    if dbfile is None or len(manifest['dest']) == 0 or len(operations) == 0:
+        return None
+    records_home = {}
+    for action, source, _ in operations:
+        if action in ('mkdir', 'cp', 'cpover') and source is not None:
+            try:
+                records_home[source] = build_file_record(source, os.stat(source))
+            except OSError:
+                pass
+    manifest['home'].update(records_home)
+    manifest['dest'] = update_destination_records(manifest['dest'], operations, records_home)
+    save_scan_manifest(dbfile, manifest['home'], manifest['dest'], settings=settings)
+    return None
+
+
+def schedule_directory_operations(operations, records=None, order="inode"):
+    """
+    Order operations so files are read (and removed) in the order they are laid out on disk, which cuts down on seeks
+    on spinning disks. Operations are grouped by step as in execute_directory_operations(); folders keep their path
+    order, so parents are still created before their contents.
+    Uses functions: first_extent_offset
+    :param operations: list of (action, source, target) tuples, output 'operations' from define_directory_commands()
+    :param records: (optional) dictionary of FileRecord entries keyed by path for home and destination, from
+                    scan_directory_records(), used for inodes (anything missing keeps its place at the end)
+    :param order: string, "inode" to order by inode number, "extent" to order by physical location of each file's first
+                  block on disk (Linux only, falls back to inode), or None to keep the planned order
+    :return: list of (action, source, target) tuples in the new order
+    """
+    if order is None:
+        return list(operations)
+    records_lookup = records if records is not None else {}
+    steps = (('mv',), ('rm',), ('rmdir',), ('mkdir',), ('cp', 'cpover', 'link', 'cptree'))
+    operations_out = []
+    for actions in steps:
+        selected = [operation for operation in operations if operation[0] in actions]
+        if actions == ('mkdir',):
+            operations_out += selected
+            continue
+        keys = []
+        for index, (action, source, target) in enumerate(selected):
+            path = source if action in ('cp', 'cpover', 'cptree') else target
+            record = records_lookup.get(path)
+            offset = first_extent_offset(path) if order == "extent" and action in ('cp', 'cpover') else None
+            if offset is not None:
+                keys.append((0, offset, index))
+            elif record is not None and record.inode is not None:
+                keys.append((1, record.inode, index))
+            else:
+                keys.append((2, 0, index))
+        operations_out += [selected[index] for _, _, index in sorted(keys)]
+    return operations_out
+
+
+def first_extent_offset(path):
+    """
+    Find where a file's first block is physically stored on disk, using the FIEMAP ioctl (Linux only).
+    :param path: string, path of file
+    :return: integer, physical byte offset of the file's first extent, or None if not available
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return None
+    request = struct.pack('QQIIII', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(56)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        result = fcntl.ioctl(fd, 0xC020660B, request)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    if struct.unpack_from('I', result, 20)[0] == 0:
+        return None
+    return struct.unpack_from('Q', result, 32 + 8)[0]
+
+
+def compile_device_limits(device_limits):
+    """
+    Compile limits on operations running at once and on bytes copied per second for each device, identified by the
+    path it is mounted at (or any folder on it).
+    :param device_limits: dictionary keyed by path, of dictionaries with optional 'workers' (most operations at once
+                          that read or write under path) and 'bytes_per_second' (most bytes copied per second)
+    :return: list of (path, semaphore or None, throttle function or None) tuples, in path order
+    """
+    limits = []
+    for path in sorted(device_limits if device_limits is not None else {}):
+        limit = device_limits[path]
+        semaphore = threading.Semaphore(limit['workers']) if limit.get('workers') is not None else None
+        throttle = define_bandwidth_throttle(limit['bytes_per_second']) \
+            if limit.get('bytes_per_second') is not None else None
+        limits.append((standardize_path_names(path), semaphore, throttle))
+    return limits
+
+
+def define_bandwidth_throttle(bytes_per_second):
+    """
+    Define a throttle shared by threads copying to or from one device. Each call reports bytes just copied, and waits
+    as long as needed to keep the average at or under bytes_per_second.
+    :param bytes_per_second: number, most bytes copied per second
+    :return: function taking a number of bytes
+    """
+    lock = threading.Lock()
+    state = {'next': time.monotonic()}
+
+    def throttle(count):
+        with lock:
+            now = time.monotonic()
+            state['next'] = max(state['next'], now) + count / bytes_per_second
+            wait = state['next'] - now
+        if wait > 0:
+            time.sleep(wait)
+    return throttle
+
+
+def apply_limited_operation(operation, limits=None, **copy_options):
+    """
+    Apply a single planned operation within the limits of the devices it reads from or writes to.
+    Uses functions: apply_timed_operation
+    :param operation: (action, source, target) tuple, see define_directory_commands(), or a grouped copy from
+                      group_fanout_operations()
+    :param limits: (optional) list of device limits, output from compile_device_limits()
+    :param copy_options: (optional) other arguments passed to apply_directory_operation()
+    :return: tuple of (number of bytes copied, seconds taken)
+    """
+    _, source, target = operation
+    paths = (source,) + (target if isinstance(target, tuple) else (target,))
+    matched = [(semaphore, throttle) for path, semaphore, throttle in (limits if limits is not None else [])
+               if any(item is not None and (item == path or item.startswith(path + '/')) for item in paths)]
+    if len(matched) == 0:
+        return apply_timed_operation(operation, **copy_options)
+    throttles = [throttle for _, throttle in matched if throttle is not None]
+    if len(throttles) > 0:
+        copy_options['throttle'] = lambda count: [throttle(count) for throttle in throttles]
+    semaphores = [semaphore for semaphore, _ in matched if semaphore is not None]
+    for semaphore in semaphores:
+        semaphore.acquire()
+    try:
+        return apply_timed_operation(operation, **copy_options)
+    finally:
+        for semaphore in reversed(semaphores):
+            semaphore.release()
+
+
+def execute_directory_operations(operations, workers=8, wait_to_run=False,
+                                 delta_threshold=None, delta_block_size=1024 * 1024, signatures=None, progress=False,
+                                 journal=None, records=None, large_threshold=None, large_workers=2, limits=None,
+                                 fanout=False, durability=None, sync_every=1000, **compress_options):
+    """
+    Apply planned operations directly from Python, without writing or running a script. Operations run on a pool of
+    threads in five steps (move, remove files, remove folders, make folders, copy/overwrite/link files), so nothing is
+    copied into a folder before it exists and nothing moved is removed first. Within each step operations start in
+    the order given (see schedule_directory_operations). Large files can be copied on a separate pool of threads, so
+    a few big copies do not hold up many small ones. With fanout, copies of the same file to several places (e.g.,
+    to more than one destination) read the file once and write all copies at the same time. A failed operation is
+    recorded and the rest continue.
+    With durability "file", every copy is flushed to disk before it replaces its target, and the folders changed are
+    flushed before the operation counts as done. With "batch", files and folders changed are flushed every sync_every
+    operations (and at the end of each step), and operations are only marked done in the journal once flushed.
+    Uses functions: group_fanout_operations, apply_limited_operation, list_synced_paths, sync_path,
+    track_slowest_operations, show_operation_progress, write_journal_entry
+    :param operations: list of (action, source, target) tuples, output 'operations' from define_directory_commands()
+    :param workers: integer, number of operations run at the same time
+    :param wait_to_run: boolean, whether to pause for confirmation from user before running operations
+    :param delta_threshold: (optional) integer, files at least this many bytes are overwritten with delta_copy_file()
+    :param delta_block_size: integer, size in bytes of blocks compared by delta_copy_file()
+    :param signatures: (optional) dictionary of block signatures from load_file_cache(), updated with new signatures
+    :param progress: boolean, whether to show progress while running
+    :param journal: (optional) file handle from start_operation_journal(), each operation is marked done in it as
+                    soon as it succeeds; or a dictionary of file handles keyed by destination path, each operation
+                    being marked in the journal of the destination its target is in
+    :param records: (optional) dictionary of FileRecord entries keyed by path for home, used for file sizes
+    :param large_threshold: (optional) integer, files at least this many bytes (according to records) are copied on a
+                            separate pool of threads
+    :param large_workers: integer, number of large files copied at the same time
+    :param limits: (optional) list of device limits, output from compile_device_limits()
+    :param fanout: boolean, whether to copy a file to all of its targets at once (see group_fanout_operations)
+    :param durability: (optional) string, "file" or "batch" to flush changes to disk as described above (anything
+                       else leaves flushing to the operating system, e.g., sync_filesystem() once finished)
+    :param sync_every: integer, number of operations between flushes with durability "batch"
+    :param compress_options: (optional) compression arguments passed to apply_directory_operation() (e.g.,
+                             compression, compressed)
+    :return: dictionary with 'completed' (list of operations that succeeded, in planned order), 'count_completed'
+             (number of operations that succeeded), 'errors' (list of (operation, message) tuples for operations that
+             failed), 'bytes_copied' (total bytes copied), 'seconds' (time taken), and 'slowest' (list of
+             (seconds, operation) tuples for the slowest operations)
+    """
+    if wait_to_run:
+        input("Press enter to continue...")
+    steps = (('mv',), ('rm',), ('rmdir',), ('mkdir',), ('cp', 'cpover', 'link', 'cptree'))
+    completed = {}
+    errors = []
+    slowest = []
+    bytes_copied = 0
+    time_start = time.perf_counter()
+    time_shown = 0.0
+    records_lookup = records if records is not None else {}
+
+    journals = journal if isinstance(journal, dict) else {None: journal} if journal is not None else {}
+
+    def is_large(operation):
+        record = records_lookup.get(operation[1]) if operation[0] in ('cp', 'cpover', 'fanout') else None
+        return large_threshold is not None and record is not None and record.size is not None \
+            and record.size >= large_threshold
+
+    def find_journal(operation):
+        for path, handle in journals.items():
+            if path is None or operation[2] == path or operation[2].startswith(path + '/'):
+                return handle
+        return None
+
+    def run_task(task):
+        result = apply_limited_operation(task, limits=limits, delta_threshold=delta_threshold,
+                                         delta_block_size=delta_block_size, signatures=signatures,
+                                         tree_workers=workers, fsync=durability == "file", **compress_options)
+        if durability == "file":
+            for path in list_synced_paths(task):
+                sync_path(path)
+        return result
+
+    def mark_done(members):
+        for _, operation in members:
+            if find_journal(operation) is not None:
+                write_journal_entry(find_journal(operation), ['done'] + list(operation))
+
+    def sync_done(unsynced):
+        paths = dict.fromkeys(path for task, _ in unsynced for path in list_synced_paths(task))
+        list(executor_sync.map(sync_path, paths))
+        for _, members in unsynced:
+            mark_done(members)
+        unsynced.clear()
+
+    unsynced = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max(1, large_workers)) as executor_large, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor_sync:
+        for actions in steps:
+            selected = [(index, operation) for index, operation in enumerate(operations) if operation[0] in actions]
+            if fanout and 'cp' in actions:
+                tasks = group_fanout_operations(selected, records=records, delta_threshold=delta_threshold,
+                                                compression=compress_options.get('compression'))
+            else:
+                tasks = [(operation, [(index, operation)]) for index, operation in selected]
+            futures = {(executor_large if is_large(task) else executor).submit(run_task, task): (task, members)
+                       for task, members in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                task, members = futures[future]
+                try:
+                    size, seconds = future.result()
+                    bytes_copied += size
+                    track_slowest_operations(slowest, task, seconds)
+                    for index, operation in members:
+                        completed[index] = operation
+                    if durability == "batch":
+                        unsynced.append((task, members))
+                    else:
+                        mark_done(members)
+                except Exception as error:
+                    errors += [(operation, str(error)) for _, operation in members]
+                if len(unsynced) >= sync_every:
+                    sync_done(unsynced)
+                if progress:
+                    time_shown = show_operation_progress(len(completed) + len(errors), len(operations), bytes_copied,
+                                                         time_start, time_shown)
+            if len(unsynced) > 0:
+                sync_done(unsynced)
+    if progress:
+        show_operation_progress(len(completed) + len(errors), len(operations), bytes_copied, time_start, final=True)
+    return {'completed': [completed[index] for index in sorted(completed)],
+            'count_completed': len(completed),
+            'errors': errors,
+            'bytes_copied': bytes_copied,
+            'seconds': time.perf_counter() - time_start,
+            'slowest': sorted(slowest, reverse=True)}
+
+
+def list_synced_paths(operation):
+    """
+    List the files and folders an operation changed, which have to be flushed to disk for it to survive a crash: the
+    files/folders made and the folders holding anything made, removed, or moved (everything inside a folder copied as
+    one).
+    :param operation: (action, source, target) tuple, see define_directory_commands(), or a grouped copy from
+                      group_fanout_operations()
+    :return: list of paths, files before folders
+    """
+    action, source, target = operation
+    targets = target if isinstance(target, tuple) else (target,)
+    paths = []
+    folders = []
+    for path in targets:
+        if action == 'cptree':
+            for folder, _, names_file in os.walk(path):
+                folder = folder.replace('\\', '/')
+                paths += [folder + '/' + name for name in names_file]
+                folders.append(folder)
+        elif action == 'mkdir':
+            folders.append(path)
+        elif action not in ('rm', 'rmdir'):
+            paths.append(path)
+        folders.append(path.rpartition('/')[0])
+    if action == 'mv':
+        folders.append(source.rpartition('/')[0])
+    return paths + list(dict.fromkeys(folders))
+
+
+def sync_path(path):
+    """
+    Flush a file or folder to disk. Anything that cannot be opened or flushed (e.g., folders on Windows, or anything
+    already removed) is skipped.
+    :param path: string, path of file or folder
+    :return: boolean, whether it was flushed
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.fsync(fd)
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def sync_filesystem(path):
+    """
+    Flush everything written to the filesystem holding path to disk, with syncfs on Linux (or sync elsewhere).
+    :param path: string, path of any file or folder on the filesystem
+    :return: boolean, whether the filesystem was flushed
+    """
+    if sys.platform.startswith('linux'):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            return libc.syncfs(fd) == 0
+        finally:
+            os.close(fd)
+    if hasattr(os, 'sync'):
+        os.sync()
+        return True
+    return False
+
+
+def group_fanout_operations(operations, records=None, delta_threshold=None, compression=None):
+    """
+    Group copies of the same file to several places, so the file can be read once and written to every place at the
+    same time. Copies that are compressed, or that may be updated in place (see delta_copy_file), are left alone.
+    :param operations: list of (index, (action, source, target)) tuples for operations run in the same step
+    :param records: (optional) dictionary of FileRecord entries keyed by path for home, used for file sizes
+    :param delta_threshold: (optional) integer, overwrites of files at least this many bytes (or of unknown size) are
+                            left alone
+    :param compression: (optional) string, codec copies are compressed with (nothing is grouped if given)
+    :return: list of (task, members) tuples, where task is the operation to run (('fanout', source, (target, ...))
+             for grouped copies) and members is the list of (index, operation) tuples it covers
+    """
+    records_lookup = records if records is not None else {}
+    groups = {}
+    tasks = []
+    for index, operation in operations:
+        action, source, _ = operation
+        record = records_lookup.get(source)
+        if compression is None and action in ('cp', 'cpover') and (
+                action == 'cp' or delta_threshold is None
+                or (record is not None and record.size is not None and record.size < delta_threshold)):
+            if source not in groups:
+                groups[source] = []
+                tasks.append((source, groups[source]))
+            groups[source].append((index, operation))
+        else:
+            tasks.append((operation, [(index, operation)]))
+    output = []
+    for task, members in tasks:
+        if len(members) == 1:
+            output.append((members[0][1], members))
+        else:
+            output.append((('fanout', task, tuple(operation[2] for _, operation in members)), members))
+    return output
+
+
+def apply_timed_operation(operation, **copy_options):
+    """
+    Apply a single planned operation and time it.
+    Uses functions: apply_directory_operation
+    :param operation: (action, source, target) tuple, see define_directory_commands()
+    :param copy_options: (optional) other arguments passed to apply_directory_operation()
+    :return: tuple of (number of bytes copied, seconds taken)
+    """
+    time_start = time.perf_counter()
+    size = apply_directory_operation(operation, **copy_options)
+    return size, time.perf_counter() - time_start
+
+
+def track_slowest_operations(slowest, operation, seconds, count=10):
+    """
+    Keep a running list of the slowest operations.
+    :param slowest: list of (seconds, operation) tuples kept as a heap, updated in place
+    :param operation: (action, source, target) tuple that finished
+    :param seconds: float, time the operation took
+    :param count: integer, number of operations to keep
+    :return: None
+    """
+    if len(slowest) < count:
+        heapq.heappush(slowest, (seconds, operation))
+    elif seconds > slowest[0][0]:
+        heapq.heapreplace(slowest, (seconds, operation))
+    return None
+
+
+def show_operation_progress(count_done, count_total, bytes_copied, time_start, time_shown=0.0, final=False,
+                            interval=0.5):
+    """
+    Show a single progress line that is rewritten in place, at most every interval seconds.
+    :param count_done: integer, operations finished so far
+    :param count_total: (optional) integer, operations planned (None if not known in advance)
+    :param bytes_copied: integer, bytes copied so far
+    :param time_start: float, time.perf_counter() when operations started
+    :param time_shown: float, time.perf_counter() when progress was last shown (output from the last call)
+    :param final: boolean, whether this is the last update (always shown, and ends the line)
+    :param interval: float, minimum seconds between updates
+    :return: float, time.perf_counter() when progress was last shown
+    """
+    now = time.perf_counter()
+    if not final and now - time_shown < interval:
+        return time_shown
+    seconds = max(now - time_start, 1e-9)
+    total = f"/{count_total}" if count_total is not None else ""
+    sys.stderr.write(f"\r{count_done}{total} operations, {bytes_copied / 1024 ** 2:.1f} MB copied "
+                     f"({bytes_copied / 1024 ** 2 / seconds:.1f} MB/s)" + ("\n" if final else ""))
+    sys.stderr.flush()
+    return now
+
+
+def apply_directory_operation(operation, delta_threshold=None, delta_block_size=1024 * 1024, signatures=None,
+                              compression=None, compression_level=None, compression_workers=1, compressed=None,
+                              throttle=None, tree_workers=1, fsync=False):
+    """
+    Apply a single planned operation. Removing something that is already gone, or repeating a move or link that was
+    already made (e.g., when resuming an interrupted run), is not an error.
+    Uses functions: copy_file, copy_file_multiple, delta_copy_file, compress_file, is_compressed_content
+    :param operation: (action, source, target) tuple, see define_directory_commands(), or ('fanout', source,
+                      (target, ...)) to copy one file to several places (see group_fanout_operations)
+    :param delta_threshold: (optional) integer, files at least this many bytes are overwritten with delta_copy_file()
+                            (not used with compression)
+    :param delta_block_size: integer, size in bytes of blocks compared by delta_copy_file()
+    :param signatures: (optional) dictionary of block signatures from load_file_cache(), updated with new signatures
+    :param compression: (optional) string, "gzip", "lzma", or "zstd" to compress copies (see compress_file), except
+                        files that are already compressed (see is_compressed_content)
+    :param compression_level: (optional) integer, compression level (default depends on codec)
+    :param compression_workers: integer, number of parts of a large file compressed at the same time
+    :param compressed: (optional) dictionary, index of compressed files from load_file_cache(), updated with copies
+    :param throttle: (optional) function called with the number of bytes after each part of a copy is written, which
+                     may wait to limit bandwidth (see define_bandwidth_throttle)
+    :param tree_workers: integer, number of files copied at the same time when copying a whole folder ('cptree')
+    :param fsync: boolean, whether to flush copies to disk before they replace their targets (folders are not
+                  flushed, see list_synced_paths)
+    :return: integer, number of bytes copied (0 for anything other than copies)
+    """
+    action, source, target = operation
+    if action in ('cp', 'cpover') and compressed is not None:
+        compressed.pop(target, None)
+    if action in ('cp', 'cpover') and compression is not None and not is_compressed_content(source):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        return compress_file(source, target, compression, level=compression_level, workers=compression_workers,
+                             compressed=compressed, throttle=throttle, fsync=fsync)
+    if action == 'rm':
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+    elif action == 'rmdir':
+        if os.path.lexists(target):
+            shutil.rmtree(target)
+    elif action == 'mkdir':
+        os.makedirs(target, exist_ok=True)
+    elif action == 'cpover' and delta_threshold is not None and os.path.isfile(target) \
+            and os.path.getsize(source) >= delta_threshold:
+        return delta_copy_file(source, target, block_size=delta_block_size, signatures=signatures, throttle=throttle,
+                               fsync=fsync)
+    elif action in ('cp', 'cpover'):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        return copy_file(source, target, throttle=throttle, fsync=fsync)
+    elif action == 'cptree':
+        operations_tree = []
+        for folder, _, names_file in os.walk(source):
+            folder = folder.replace('\\', '/')
+            os.makedirs(target + folder[len(source):], exist_ok=True)
+            operations_tree += [('cp', folder + '/' + name, target + folder[len(source):] + '/' + name)
+                                for name in names_file]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, tree_workers)) as executor:
+            return sum(executor.map(lambda operation_tree: apply_directory_operation(
+                operation_tree, compression=compression, compression_level=compression_level,
+                compression_workers=compression_workers, compressed=compressed, throttle=throttle, fsync=fsync),
+                operations_tree))
+    elif action == 'fanout':
+        for path in target:
+            if compressed is not None:
+                compressed.pop(path, None)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return copy_file_multiple(source, target, throttle=throttle, fsync=fsync)
+    elif action == 'link':
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            if not os.path.samefile(source, target):
+                raise
+    elif action == 'mv':
+        if not os.path.lexists(source) and os.path.lexists(target):
+            return 0
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(source, target)
+    else:
+        raise ValueError(f"Unknown operation {action}.")
+    return 0
+
+
+def copy_file(source, target, buffer_size=1024 * 1024, throttle=None, fsync=False):
+    """
+    Copy a file with its permissions and time modified (so the next comparison sees them as the same age). The copy
+    is written to a temporary file next to target and renamed over it once complete, so an interrupted copy never
+    leaves a partial file at target.
+    Uses functions: copy_file_contents, define_partial_path
+    :param source: string, path of file to copy
+    :param target: string, path to copy file to (overwritten if it exists)
+    :param buffer_size: integer, bytes read at a time if the file has to be copied through Python
+    :param throttle: (optional) function called with the number of bytes after each part is copied
+    :param fsync: boolean, whether to flush the copy to disk before it is renamed to target
+    :return: integer, number of bytes copied
+    """
+    target_partial = define_partial_path(target)
+    try:
+        with open(source, 'rb') as file_in, open(target_partial, 'wb') as file_out:
+            stat_source = os.fstat(file_in.fileno())
+            bytes_copied = copy_file_contents(file_in, file_out, buffer_size=buffer_size, throttle=throttle)
+            if fsync:
+                os.fsync(file_out.fileno())
+        os.chmod(target_partial, stat.S_IMODE(stat_source.st_mode))
+        os.utime(target_partial, ns=(stat_source.st_atime_ns, stat_source.st_mtime_ns))
+        os.replace(target_partial, target)
+    except BaseException:
+        if os.path.lexists(target_partial):
+            os.remove(target_partial)
+        raise
+    return bytes_copied
+
+
+def copy_file_multiple(source, targets, buffer_size=1024 * 1024, throttle=None, fsync=False):
+    """
+    Copy a file to several places while reading it only once, with its permissions and time modified. Each part read
+    is written to all copies in parallel, and the next part is only read once every copy has written it, so copying
+    goes at the pace of the slowest destination. Each copy is written to a temporary file and renamed once complete,
+    as in copy_file().
+    Uses functions: define_partial_path
+    :param source: string, path of file to copy
+    :param targets: list of strings, paths to copy file to (overwritten if they exist)
+    :param buffer_size: integer, bytes read at a time
+    :param throttle: (optional) function called with the number of bytes after each part is copied
+    :param fsync: boolean, whether to flush the copies to disk before they are renamed to targets
+    :return: integer, number of bytes written (size of file times number of copies)
+    """
+    targets_partial = [define_partial_path(target) for target in targets]
+    files_out = []
+    bytes_read = 0
+    try:
+        with open(source, 'rb') as file_in, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            stat_source = os.fstat(file_in.fileno())
+            for target_partial in targets_partial:
+                files_out.append(open(target_partial, 'wb'))
+            while True:
+                buffer = file_in.read(buffer_size)
+                if len(buffer) == 0:
+                    break
+                for future in [executor.submit(file_out.write, buffer) for file_out in files_out]:
+                    future.result()
+                bytes_read += len(buffer)
+                if throttle is not None:
+                    throttle(len(buffer))
+        while len(files_out) > 0:
+            if fsync:
+                os.fsync(files_out[-1].fileno())
+            files_out.pop().close()
+        for target_partial, target in zip(targets_partial, targets):
+            os.chmod(target_partial, stat.S_IMODE(stat_source.st_mode))
+            os.utime(target_partial, ns=(stat_source.st_atime_ns, stat_source.st_mtime_ns))
+            os.replace(target_partial, target)
+    except BaseException:
+        for file_out in files_out:
+            file_out.close()
+        for target_partial in targets_partial:
+            if os.path.lexists(target_partial):
+                os.remove(target_partial)
+        raise
+    return bytes_read * len(targets)
+
+
+def define_partial_path(target):
+    """
+    Define the temporary path a file is copied to before it is renamed to target. The name starts with '~', so scans
+    treat it as temporary and skip it.
+    :param target: string, path the file is being copied to
+    :return: string, temporary path in the same folder as target
+    """
+    folder, _, name = target.replace('\\', '/').rpartition('/')
+    return folder + '/~' + name + '.self_backup_partial'
+
+
+def remove_partial_files(operations):
+    """
+    Remove temporary files that an interrupted run left next to the targets of its operations (see
+    define_partial_path), including inside folders being copied whole.
+    Uses functions: define_partial_path
+    :param operations: list of (action, source, target) tuples, e.g., the unfinished operations of a journal
+    :return: integer, number of files removed
+    """
+    removed = 0
+    for action, _, target in operations:
+        paths_partial = [define_partial_path(path) for path in (target if isinstance(target, tuple) else (target,))]
+        if action == 'cptree' and os.path.isdir(target):
+            paths_partial += [folder + '/' + name for folder, _, names_file in os.walk(target) for name in names_file
+                              if name.startswith('~') and name.endswith('.self_backup_partial')]
+        for path_partial in paths_partial:
+            if os.path.isfile(path_partial):
+                os.remove(path_partial)
+                removed += 1
+    return removed
+
+
+def start_operation_journal(journalfile, operations, header=None):
+    """
+    Start an append-only journal for a run: a header describing the run, then every planned operation. Operations
+    are marked done as they finish (see write_journal_entry), so an interrupted run can be resumed where it stopped.
+    Uses functions: write_journal_entry
+    :param journalfile: string, path of the journal file (replaced if it exists)
+    :param operations: list of (action, source, target) tuples that will be run
+    :param header: (optional) dictionary describing the run (settings, paths, etc.), checked before resuming
+    :return: file handle of the open journal, passed to execute_directory_operations()
+    """
+    journal = open(journalfile, "w", encoding="utf8")
+    write_journal_entry(journal, ['header', header if header is not None else {}])
+    for operation in operations:
+        journal.write(json.dumps(['plan'] + list(operation)) + '\n')
+    journal.flush()
+    return journal
+
+
+def write_journal_entry(journal, entry):
+    """
+    Append one entry to a journal, passing it to the operating system straight away so it survives the program being
+    stopped.
+    :param journal: file handle, output from start_operation_journal()
+    :param entry: list that can be saved as JSON (e.g., ['done', action, source, target])
+    :return: None
+    """
+    journal.write(json.dumps(entry) + '\n')
+    journal.flush()
+    return None
+
+
+def load_operation_journal(journalfile):
+    """
+    Load the journal left by a run that did not finish.
+    :param journalfile: string, path of the journal file
+    :return: dictionary with 'header' (dictionary describing the run), 'operations' (list of planned operations, in
+             order), and 'done' (set of operations marked done), or None if there is no journal; a partly written last
+             line is ignored
+    """
+    if not os.path.isfile(journalfile):
+        return None
+    journal = {'header': None, 'operations': [], 'done': set()}
+    with open(journalfile, "r", encoding="utf8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry[0] == 'header':
+                journal['header'] = entry[1]
+            elif entry[0] == 'plan':
+                journal['operations'].append(tuple(entry[1:]))
+            elif entry[0] == 'done':
+                journal['done'].add(tuple(entry[1:]))
+    return journal if journal['header'] is not None else None
+
+
+def finish_operation_journal(journal, journalfile, dbfile=None):
+    """
+    Close and remove the journal of a run that finished, and clear records saved as pending for it.
+    :param journal: file handle, output from start_operation_journal() (or None if already closed)
+    :param journalfile: string, path of the journal file
+    :param dbfile: (optional) string, path of the SQLite manifest file holding pending records
+    :return: None
+    """
+    if journal is not None:
+        journal.close()
+    if os.path.isfile(journalfile):
+        os.remove(journalfile)
+    if dbfile is not None and os.path.isfile(dbfile):
+        connection = sqlite3.connect(dbfile)
+        try:
+            create_manifest_tables(connection)
+            with connection:
+                connection.execute("DELETE FROM manifest WHERE side LIKE 'pending_%'")
+                connection.execute("DELETE FROM manifest_info WHERE key = 'pending_settings'")
+        finally:
+            connection.close()
+    return None
+
+
+def delta_copy_file(source, target, block_size=1024 * 1024, signatures=None, throttle=None, fsync=False):
+    """
+    Overwrite a large file, rewriting only the fixed-size blocks that differ from source. Sources that can be cloned or
+    that have holes are copied whole instead (see copy_file_contents), since a clone writes nothing and a block update
+    would fill the holes. Blocks are compared by hash, and the target's block hashes are taken from signatures if it has
+    not changed since they were saved, so the target only has to be read when no signature is cached. Where the
+    filesystem supports reflink clones, the target is cloned to a temporary file, the changed blocks are written there,
+    and it is renamed over target, so an interrupted update leaves target as it was. Otherwise target is updated in
+    place (copying it whole would defeat the point); if that fails, its time modified is set to 1970 so the next
+    comparison copies it again, but a run that is killed can leave it partly updated until the journal repeats the
+    update (see start_operation_journal).
+    Uses functions: copy_file, file_block_digests, clone_file_contents, define_partial_path
+    :param source: string, path of file to copy
+    :param target: string, path of existing file to update
+    :param block_size: integer, size in bytes of blocks compared
+    :param signatures: (optional) dictionary of (size, time modified, block size, digests) tuples keyed by path, from
+                       load_file_cache(), updated with the target's new signature
+    :param throttle: (optional) function called with the number of bytes after each changed block is written
+    :param fsync: boolean, whether to flush the changes to disk before returning
+    :return: integer, number of bytes written
+    """
+    signatures = signatures if signatures is not None else {}
+    stat_source = os.stat(source)
+    if hasattr(os, 'SEEK_DATA') and getattr(stat_source, 'st_blocks', None) is not None \
+            and stat_source.st_blocks * 512 < stat_source.st_size:
+        signatures.pop(target, None)
+        return copy_file(source, target, throttle=throttle, fsync=fsync)
+    target_partial = define_partial_path(target)
+    with open(source, 'rb') as file_in, open(target_partial, 'wb') as file_partial:
+        cloned_source = clone_file_contents(file_in.fileno(), file_partial.fileno())
+        if cloned_source and fsync:
+            os.fsync(file_partial.fileno())
+    if cloned_source:
+        os.chmod(target_partial, stat.S_IMODE(stat_source.st_mode))
+        os.utime(target_partial, ns=(stat_source.st_atime_ns, stat_source.st_mtime_ns))
+        os.replace(target_partial, target)
+        signatures.pop(target, None)
+        return stat_source.st_size
+    stat_target = os.stat(target)
+    cached = signatures.get(target)
+    if cached is not None and tuple(cached[:3]) == (stat_target.st_size, stat_target.st_mtime, block_size):
+        digests_target = cached[3]
+    else:
+        digests_target = file_block_digests(target, block_size)
+    with open(target, 'rb') as file_target, open(target_partial, 'wb') as file_partial:
+        cloned = clone_file_contents(file_target.fileno(), file_partial.fileno())
+    if not cloned:
+        os.remove(target_partial)
+    path_out = target_partial if cloned else target
+    digest_size = 16
+    digests_source = []
+    written = 0
+    try:
+        with open(source, 'rb') as file_in, open(path_out, 'r+b') as file_out:
+            stat_source = os.fstat(file_in.fileno())
+            index = 0
+            while True:
+                block = file_in.read(block_size)
+                if not block:
+                    break
+                digest = hashlib.blake2b(block, digest_size=digest_size).digest()
+                digests_source.append(digest)
+                if digests_target[index * digest_size:(index + 1) * digest_size] != digest:
+                    file_out.seek(index * block_size)
+                    file_out.write(block)
+                    written += len(block)
+                    if throttle is not None:
+                        throttle(len(block))
+                index += 1
+            file_out.truncate(file_in.tell())
+            if fsync:
+                file_out.flush()
+                os.fsync(file_out.fileno())
+        os.chmod(path_out, stat.S_IMODE(stat_source.st_mode))
+        os.utime(path_out, ns=(stat_source.st_atime_ns, stat_source.st_mtime_ns))
+        if cloned:
+            os.replace(target_partial, target)
+    except BaseException:
+        if cloned:
+            if os.path.lexists(target_partial):
+                os.remove(target_partial)
+        elif os.path.lexists(target):
+            os.utime(target, ns=(0, 0))
+        signatures.pop(target, None)
+        raise
+    stat_target = os.stat(target)
+    signatures[target] = (stat_target.st_size, stat_target.st_mtime, block_size, b''.join(digests_source))
+    return written
+
+
+def is_compressed_content(path):
+    """
+    Check whether a file is already compressed (media, archives, etc.), by its extension or its first few bytes, so
+    no time is spent compressing it again.
+    :param path: string, path of file
+    :return: boolean, True if the file looks compressed already
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    try:
+        with open(path, 'rb') as file:
+            head = file.read(16)
+    except OSError:
+        return False
+    return any(head.startswith(signature) for signature in COMPRESSED_SIGNATURES) or head[4:8] == b'ftyp'
+
+
+def compress_data(data, codec, level=None):
+    """
+    Compress a block of data as a complete stream, so compressed blocks can simply be joined one after another.
+    :param data: bytes to compress
+    :param codec: string, "gzip", "lzma", or "zstd" (requires the zstandard package)
+    :param level: (optional) integer, compression level (default is 6 for gzip and lzma, 3 for zstd)
+    :return: bytes, compressed data
+    """
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=level if level is not None else 6, mtime=0)
+    elif codec == "lzma":
+        return lzma.compress(data, preset=level if level is not None else 6)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise ImportError("Compressing with zstd requires the zstandard package.")
+        return zstandard.ZstdCompressor(level=level if level is not None else 3).compress(data)
+    raise ValueError(f"Unknown compression {codec}.")
+
+
+def compress_file(source, target, codec, level=None, workers=1, chunk_size=8 * 1024 * 1024, compressed=None,
+                  throttle=None, fsync=False):
+    """
+    Copy a file, compressing it on the way, with its permissions and time modified. Large files are compressed in
+    chunks of chunk_size on several threads at once (each chunk is a complete stream, and standard tools read joined
+    streams as one file). Files that do not get smaller are copied as they are (larger files are copied again with
+    copy_file() as soon as the compressed copy reaches their size). The copy is written to a temporary file and
+    renamed to target once complete.
+    Uses functions: compress_data, define_partial_path, copy_file
+    :param source: string, path of file to copy
+    :param target: string, path to copy file to (overwritten if it exists, and not renamed, so it compares to source)
+    :param codec: string, "gzip", "lzma", or "zstd" (requires the zstandard package)
+    :param level: (optional) integer, compression level (see compress_data)
+    :param workers: integer, number of chunks compressed at the same time
+    :param chunk_size: integer, size in bytes of chunks compressed separately
+    :param compressed: (optional) dictionary, index of compressed files from load_file_cache(), updated with target's
+                       (original size, time modified, stored size, codec), or with target removed if stored as is
+    :param throttle: (optional) function called with the number of bytes after each chunk is written
+    :param fsync: boolean, whether to flush the copy to disk before it is renamed to target
+    :return: integer, number of bytes written
+    """
+    target_partial = define_partial_path(target)
+    bytes_written = 0
+    try:
+        with open(source, 'rb') as file_in, open(target_partial, 'wb') as file_out:
+            stat_source = os.fstat(file_in.fileno())
+            chunk = file_in.read(chunk_size)
+            data = compress_data(chunk, codec, level)
+            if len(chunk) < chunk_size and len(data) >= len(chunk):
+                data, codec = chunk, None
+            file_out.write(data)
+            bytes_written += len(data)
+            if throttle is not None:
+                throttle(len(data))
+            if len(chunk) == chunk_size:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                    pending = []
+                    while True:
+                        while len(pending) < 2 * max(1, workers):
+                            chunk = file_in.read(chunk_size)
+                            if len(chunk) == 0:
+                                break
+                            pending.append(executor.submit(compress_data, chunk, codec, level))
+                        if len(pending) == 0:
+                            break
+                        data = pending.pop(0).result()
+                        file_out.write(data)
+                        bytes_written += len(data)
+                        if throttle is not None:
+                            throttle(len(data))
+                        if bytes_written >= stat_source.st_size:
+                            break
+            is_larger = codec is not None and bytes_written >= stat_source.st_size
+            if fsync and not is_larger:
+                file_out.flush()
+                os.fsync(file_out.fileno())
+        if is_larger:
+            os.remove(target_partial)
+            bytes_written, codec = copy_file(source, target, throttle=throttle, fsync=fsync), None
+        else:
+            os.chmod(target_partial, stat.S_IMODE(stat_source.st_mode))
+            os.utime(target_partial, ns=(stat_source.st_atime_ns, stat_source.st_mtime_ns))
+            os.replace(target_partial, target)
+    except BaseException:
+        if os.path.lexists(target_partial):
+            os.remove(target_partial)
+        raise
+    if compressed is not None:
+        if codec is None:
+            compressed.pop(target, None)
+        else:
+            compressed[target] = (stat_source.st_size, stat_source.st_mtime, bytes_written, codec)
+    return bytes_written
+
+
+def decompress_file(source, target, codec):
+    """
+    Restore a file compressed by compress_file(), with its permissions and time modified.
+    Uses functions: define_partial_path, open_decompressed
+    :param source: string, path of compressed file
+    :param target: string, path to write the original file to (overwritten if it exists)
+    :param codec: string, "gzip", "lzma", or "zstd" (requires the zstandard package)
+    :return: integer, number of bytes written
+    """
+    target_partial = define_partial_path(target)
+    stat_source = os.stat(source)
+    try:
+        with open(source, 'rb') as file_raw, open(target_partial, 'wb') as file_out:
+            file_in = open_decompressed(file_raw, codec)
+            bytes_written = 0
+            while True:
+                data = file_in.read(1024 * 1024)
+                if len(data) == 0:
+                    break
+                file_out.write(data)
+                bytes_written += len(data)
+        os.chmod(target_partial, stat.S_IMODE(stat_source.st_mode))
+        os.utime(target_partial, ns=(stat_source.st_atime_ns, stat_source.st_mtime_ns))
+        os.replace(target_partial, target)
+    except BaseException:
+        if os.path.lexists(target_partial):
+            os.remove(target_partial)
+        raise
+    return bytes_written
+
+
+def open_decompressed(file_raw, codec):
+    """
+    Open a reader that decompresses a file compressed by compress_file() as it is read.
+    :param file_raw: file object opened for binary reading
+    :param codec: string, "gzip", "lzma", or "zstd" (requires the zstandard package)
+    :return: file-like object with a read() method returning the original contents
+    """
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=file_raw, mode='rb')
+    elif codec == "lzma":
+        return lzma.LZMAFile(file_raw, mode='rb')
+    elif codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(file_raw, read_across_frames=True)
+    raise ValueError(f"Cannot decompress {codec}.")
+
+
+def apply_packed_records(records, packed):
+    """
+    Add files packed into segments (see pack_directory_operations) to destination records, so they compare with home
+    as if they had been copied as they are, without reading the segments.
+    Uses functions: sort_unique_items
+    :param records: dictionary of FileRecord entries keyed by path for destination directory
+    :param packed: dictionary of (size, time modified, segment path, offset) tuples keyed by path, from
+                   load_file_cache()
+    :return: dictionary of FileRecord entries keyed by path for destination directory, including packed files
+    """
+    records_out = dict(records)
+    for path, (size, mtime, _, _) in packed.items():
+        records_out[path] = FileRecord(path, False, size, mtime, None)
+    return {path: records_out[path] for path in sort_unique_items(list(records_out))}
+
+
+def pack_directory_operations(operations, records_home, packed, rootpath, folder_packs, threshold,
+                              segment_size=256 * 1024 ** 2, fsync=False):
+    """
+    Pack new files smaller than threshold into segment files in the destination instead of copying each one, and apply
+    removals and moves of packed files to the index of packed files. Segments are tar archives (so they can also be
+    read with standard tools), named by date and time, and written to a temporary file and renamed once complete, so
+    the index only ever points to complete segments. Packed files that are removed or replaced stay in their segments
+    until nothing in a segment is still used (see prune_packed_segments).
+    Uses functions: standardize_path_names, define_partial_path
+    :param operations: list of (action, source, target) tuples, output 'operations' from define_directory_commands()
+                       (plus any moves from detect_moved_files())
+    :param records_home: dictionary of FileRecord entries keyed by path for home directory, used for file sizes
+    :param packed: dictionary of (size, time modified, segment path, offset) tuples keyed by path, from
+                   load_file_cache(), updated in place
+    :param rootpath: string, destination directory (names in segments are relative to it)
+    :param folder_packs: string, folder in destination directory to write segments to
+    :param threshold: integer, files smaller than this many bytes are packed
+    :param segment_size: integer, a new segment is started once one reaches this many bytes
+    :param fsync: boolean, whether to flush each segment to disk before it is renamed
+    :return: dictionary with 'operations' (list of operations left to run, in planned order), 'completed' (list of
+             operations done here), 'errors' (list of (operation, message) tuples for files that could not be
+             packed), and 'bytes_copied' (total bytes packed)
+    """
+    rootpath_fmt = standardize_path_names(rootpath)
+    operations_left = []
+    completed = []
+    errors = []
+    to_pack = []
+    for operation in operations:
+        action, source, target = operation
+        record = records_home.get(source) if source is not None else None
+        if action == 'rm' and target in packed:
+            del packed[target]
+            completed.append(operation)
+        elif action == 'mv' and source in packed:
+            packed[target] = packed.pop(source)
+            completed.append(operation)
+        elif action in ('cp', 'cpover') and (action == 'cp' or target in packed) and record is not None \
+                and record.size is not None and record.size < threshold:
+            to_pack.append(operation)
+        else:
+            if action == 'mv':
+                for path in [path for path in packed if path.startswith(source + '/')]:
+                    packed[target + path[len(source):]] = packed.pop(path)
+            elif action == 'rmdir':
+                for path in [path for path in packed if path.startswith(target + '/')]:
+                    del packed[path]
+            elif action == 'cpover':
+                packed.pop(target, None)
+            operations_left.append(operation)
+    bytes_copied = 0
+    index = 0
+    while index < len(to_pack):
+        os.makedirs(folder_packs, exist_ok=True)
+        name = f"segment-{datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S')}"
+        count = 0
+        while os.path.lexists(f"{folder_packs}/{name}-{count:04d}.tar"):
+            count += 1
+        segment = f"{folder_packs}/{name}-{count:04d}.tar"
+        segment_partial = define_partial_path(segment)
+        entries = {}
+        operations_packed = []
+        try:
+            with open(segment_partial, 'wb') as file_out:
+                with tarfile.open(fileobj=file_out, mode='w', format=tarfile.PAX_FORMAT) as archive:
+                    while index < len(to_pack) and file_out.tell() < segment_size:
+                        operation = to_pack[index]
+                        _, source, target = operation
+                        index += 1
+                        try:
+                            with open(source, 'rb') as file_in:
+                                stat_source = os.fstat(file_in.fileno())
+                                info = archive.gettarinfo(arcname=target[len(rootpath_fmt) + 1:], fileobj=file_in)
+                                offset = archive.offset + len(info.tobuf(archive.format, archive.encoding,
+                                                                         archive.errors))
+                                archive.addfile(info, file_in)
+                        except OSError as error:
+                            errors.append((operation, str(error)))
+                            continue
+                        entries[target] = (info.size, stat_source.st_mtime, segment, offset)
+                        operations_packed.append(operation)
+                        bytes_copied += info.size
+                if fsync:
+                    file_out.flush()
+                    os.fsync(file_out.fileno())
+            os.replace(segment_partial, segment)
+        except BaseException:
+            if os.path.lexists(segment_partial):
+                os.remove(segment_partial)
+            raise
+        packed.update(entries)
+        completed += operations_packed
+    return {'operations': operations_left, 'completed': completed, 'errors': errors, 'bytes_copied': bytes_copied}
+
+
+def read_packed_file(packed, path):
+    """
+    Read the contents of a file packed into a segment.
+    :param packed: dictionary of (size, time modified, segment path, offset) tuples keyed by path, from
+                   load_file_cache()
+    :param path: string, path of the file in the destination directory
+    :return: bytes, contents of file
+    """
+    size, _, segment, offset = packed[path]
+    with open(segment, 'rb') as file:
+        file.seek(offset)
+        return file.read(size)
+
+
+def unpack_file(packed, path, target, modes=None):
+    """
+    Restore a file packed into a segment, with its permissions (from its tar member) and time modified.
+    Uses functions: read_packed_file, read_packed_modes, define_partial_path
+    :param packed: dictionary of (size, time modified, segment path, offset) tuples keyed by path, from
+                   load_file_cache()
+    :param path: string, path of the file in the destination directory
+    :param target: string, path to write the file to (overwritten if it exists)
+    :param modes: (optional) dictionary of outputs from read_packed_modes() keyed by segment path, filled in as
+                  segments are read, so restoring many files from one segment reads its headers once
+    :return: integer, number of bytes written
+    """
+    _, mtime, segment, offset = packed[path]
+    modes = modes if modes is not None else {}
+    if segment not in modes:
+        modes[segment] = read_packed_modes(segment)
+    target_partial = define_partial_path(target)
+    try:
+        contents = read_packed_file(packed, path)
+        with open(target_partial, 'wb') as file_out:
+            file_out.write(contents)
+        if offset in modes[segment]:
+            os.chmod(target_partial, modes[segment][offset])
+        os.utime(target_partial, (time.time(), mtime))
+        os.replace(target_partial, target)
+    except BaseException:
+        if os.path.lexists(target_partial):
+            os.remove(target_partial)
+        raise
+    return len(contents)
+
+
+def read_packed_modes(segment):
+    """
+    Read the permissions of every file packed into a segment from its tar headers, without reading the files.
+    :param segment: string, path of segment
+    :return: dictionary of permissions keyed by offset of each file's contents in the segment
+    """
+    with tarfile.open(segment, 'r:') as archive:
+        return {info.offset_data: stat.S_IMODE(info.mode) for info in archive if info.isfile()}
+
+
+def prune_packed_segments(packed, folder_packs):
+    """
+    Remove segments that no packed file is still in, along with any left unfinished by an interrupted run.
+    :param packed: dictionary of (size, time modified, segment path, offset) tuples keyed by path, from
+                   load_file_cache()
+    :param folder_packs: string, folder in destination directory holding segments
+    :return: list of paths of segments removed
+    """
+    used = {segment for _, _, segment, _ in packed.values()}
+    try:
+        names = sorted(os.listdir(folder_packs))
+    except OSError:
+        return []
+    removed = []
+    for name in names:
+        path = folder_packs + '/' + name
+        if path not in used and os.path.isfile(path):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def file_block_digests(path, block_size=1024 * 1024):
+    """
+    Hash each fixed-size block of a file.
+    :param path: string, path of file to read
+    :param block_size: integer, size in bytes of blocks
+    :return: bytes, 16-byte BLAKE2b digests of each block, concatenated in order
+    """
+    digests = []
+    with open(path, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            digests.append(hashlib.blake2b(block, digest_size=16).digest())
+    return b''.join(digests)
+
+
+def copy_file_contents(file_in, file_out, buffer_size=1024 * 1024, throttle=None):
+    """
+    Copy the contents of one open file to another. Where the filesystem supports it (e.g., btrfs or XFS) and both files
+    are on the same volume, the copy is a reflink clone that shares blocks with the original until either changes.
+    Sparse files are copied one block of data at a time so their holes are kept. Otherwise the kernel moves the data
+    where the platform supports it (os.copy_file_range, then os.sendfile on Linux), or it is read/written through
+    Python.
+    Uses functions: clone_file_contents, copy_sparse_contents
+    :param file_in: file object opened for binary reading, at position 0
+    :param file_out: file object opened for binary writing, at position 0
+    :param buffer_size: integer, bytes read at a time if the file has to be copied through Python
+    :param throttle: (optional) function called with the number of bytes after each part is copied (parts are smaller
+                     when a throttle is given, so waits are spread out)
+    :return: integer, number of bytes copied (size of file for a clone, bytes of data for a sparse file)
+    """
+    fd_in = file_in.fileno()
+    chunk_size = (4 if throttle is not None else 64) * buffer_size
+    fd_out = file_out.fileno()
+    stat_in = os.fstat(fd_in)
+    if clone_file_contents(fd_in, fd_out):
+        return stat_in.st_size
+    if hasattr(os, 'SEEK_DATA') and getattr(stat_in, 'st_blocks', None) is not None \
+            and stat_in.st_blocks * 512 < stat_in.st_size:
+        return copy_sparse_contents(fd_in, fd_out, stat_in.st_size, chunk_size=chunk_size, throttle=throttle)
+    copied = 0
+    fallback_errors = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.EPERM)
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method) or (method == 'sendfile' and not sys.platform.startswith('linux')):
+            continue
+        try:
+            while True:
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(fd_in, fd_out, chunk_size)
+                else:
+                    sent = os.sendfile(fd_out, fd_in, copied, chunk_size)
+                if sent == 0:
+                    return copied
+                copied += sent
+                if throttle is not None:
+                    throttle(sent)
+        except OSError as error:
+            if copied > 0 or error.errno not in fallback_errors:
+                raise
+    file_in.seek(copied)
+    file_out.seek(copied)
+    while True:
+        buffer = file_in.read(buffer_size)
+        if not buffer:
+            return copied
+        file_out.write(buffer)
+        copied += len(buffer)
+        if throttle is not None:
+            throttle(len(buffer))
+
+
+def clone_file_contents(fd_in, fd_out):
+    """
+    Make one file a reflink clone of another with the FICLONE ioctl (Linux only), so no data is copied.
+    :param fd_in: integer, file descriptor of file to clone, opened for reading
+    :param fd_out: integer, file descriptor of empty file to clone into, opened for writing
+    :return: boolean, whether the clone was made (False if the filesystem does not support it, or the files are on
+             different volumes)
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(fd_out, 0x40049409, fd_in)
+    except OSError as error:
+        if error.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EPERM,
+                           errno.EBADF):
+            return False
+        raise
+    return True
+
+
+def copy_sparse_contents(fd_in, fd_out, size, chunk_size=64 * 1024 * 1024, throttle=None):
+    """
+    Copy a sparse file, skipping its holes (found with SEEK_DATA/SEEK_HOLE) so they stay holes in the copy.
+    :param fd_in: integer, file descriptor of file to copy, opened for reading
+    :param fd_out: integer, file descriptor of empty file to copy to, opened for writing
+    :param size: integer, size of file to copy
+    :param chunk_size: integer, most bytes copied at a time
+    :param throttle: (optional) function called with the number of bytes after each part is copied
+    :return: integer, number of bytes of data copied
+    """
+    copied = 0
+    position = 0
+    while position < size:
+        try:
+            start = os.lseek(fd_in, position, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                break
+            raise
+        end = os.lseek(fd_in, start, os.SEEK_HOLE)
+        position = start
+        while position < end:
+            count = min(chunk_size, end - position)
+            try:
+                sent = os.copy_file_range(fd_in, fd_out, count, position, position)
+            except (AttributeError, OSError):
+                buffer = os.pread(fd_in, count, position)
+                sent = os.pwrite(fd_out, buffer, position) if len(buffer) > 0 else 0
+            if sent == 0:
+                break
+            position += sent
+            copied += sent
+            if throttle is not None:
+                throttle(sent)
+        position = max(position, end)
+    os.ftruncate(fd_out, size)
+    return copied
+
+
+def define_restore_operations(records, rootpath_backup, rootpath_home, overwrite=False):
+    """
+    Define operations to restore files/folders from the destination/backup directory to home. Nothing in home is
+    ever removed: missing files/folders are copied, files with the same size and time modified are left alone, and
+    files that differ are only overwritten if overwrite is set.
+    Uses functions: standardize_path_names
+    :param records: dictionary of FileRecord entries to restore, keyed by path in the destination/backup directory
+    :param rootpath_backup: string, root path of the destination/backup directory (or snapshot) to restore from
+    :param rootpath_home: string, root path of home directory to restore to
+    :param overwrite: boolean, whether to overwrite files in home that differ from the backup
+    :return: dictionary with 'operations' (list of (action, source, target) tuples), 'kept' (list of paths in home
+             left alone because they differ), and 'count_unchanged'
+    """
+    rootpath_backup_fmt = standardize_path_names(rootpath_backup)
+    rootpath_home_fmt = standardize_path_names(rootpath_home)
+    operations = []
+    kept = []
+    count_unchanged = 0
+    for path, record in records.items():
+        if path != rootpath_backup_fmt and not path.startswith(rootpath_backup_fmt + '/'):
+            continue
+        target = rootpath_home_fmt + path[len(rootpath_backup_fmt):]
+        try:
+            stat_target = os.stat(target)
+        except OSError:
+            stat_target = None
+        if record.is_dir:
+            if stat_target is None:
+                operations.append(('mkdir', path, target))
+            elif not stat.S_ISDIR(stat_target.st_mode):
+                kept.append(target)
+        elif stat_target is None:
+            operations.append(('cp', path, target))
+        elif stat_target.st_size == record.size and stat_target.st_mtime == record.mtime:
+            count_unchanged += 1
+        elif overwrite and not stat.S_ISDIR(stat_target.st_mode):
+            operations.append(('cpover', path, target))
+        else:
+            kept.append(target)
+    return {'operations': operations, 'kept': kept, 'count_unchanged': count_unchanged}
+
+
+def restore_directory_files(operations, records=None, workers=8, packed=None, compressed=None, progress=False):
+    """
+    Restore files/folders defined by define_restore_operations(), copying files on a pool of threads. Folders are made
+    first, files keep their time modified, and folders made are given their time modified once their contents are
+    restored. Packed files are read from their segments and compressed files are decompressed. A failed operation is
+    recorded and the rest continue.
+    Uses functions: copy_file, unpack_file, decompress_file, show_operation_progress
+    :param operations: list of (action, source, target) tuples, from define_restore_operations()
+    :param records: (optional) dictionary of FileRecord entries keyed by path in the destination/backup directory,
+                    used for the time modified of folders made
+    :param workers: integer, number of files copied at the same time
+    :param packed: (optional) dictionary of packed files from load_file_cache()
+    :param compressed: (optional) dictionary of compressed files from load_file_cache()
+    :param progress: boolean, whether to show a progress line while files are copied
+    :return: dictionary with 'completed', 'errors', 'count_completed', and 'bytes_copied' (as from
+             execute_directory_operations)
+    """
+    packed = packed if packed is not None else {}
+    compressed = compressed if compressed is not None else {}
+    modes = {}
+    completed = []
+    errors = []
+    bytes_copied = 0
+    folders = [operation for operation in operations if operation[0] == 'mkdir']
+    for operation in folders:
+        try:
+            os.makedirs(operation[2], exist_ok=True)
+            completed.append(operation)
+        except OSError as error:
+            errors.append((operation, str(error)))
+
+    def restore_file(source, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if source in packed:
+            return unpack_file(packed, source, target, modes=modes)
+        elif source in compressed:
+            return decompress_file(source, target, compressed[source][3])
+        return copy_file(source, target)
+
+    files = [operation for operation in operations if operation[0] in ('cp', 'cpover')]
+    time_start = time.perf_counter()
+    time_shown = 0.0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(restore_file, source, target): (action, source, target)
+                   for action, source, target in files}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                bytes_copied += future.result()
+                completed.append(futures[future])
+            except OSError as error:
+                errors.append((futures[future], str(error)))
+            if progress:
+                time_shown = show_operation_progress(len(completed) + len(errors), len(operations), bytes_copied,
+                                                     time_start, time_shown)
+    if progress:
+        show_operation_progress(len(completed) + len(errors), len(operations), bytes_copied, time_start, final=True)
+    for _, source, target in sorted(folders, key=lambda operation: operation[2], reverse=True):
+        if records is not None and source in records and os.path.isdir(target):
+            os.utime(target, (time.time(), records[source].mtime))
+    return {'completed': completed, 'errors': errors, 'count_completed': len(completed), 'bytes_copied': bytes_copied}
+
+
+def summarize_operation_results(results):
+    """
+    Summarize results of execute_directory_operations() or execute_operation_stream() as messages, listing every
+    operation that failed.
+    :param results: dictionary, output from execute_directory_operations() or execute_operation_stream()
+    :return: list of strings, messages to print or log
+    """
+    message = [
+        "Summary of operations:",
+        f"{results['count_completed']} operations completed, {len(results['errors'])} failed.",
+        f"{results['bytes_copied']} bytes copied.",
+        ""
+    ]
+    if len(results['errors']) > 0:
+        message = message + ["ERRORS FOUND:"] + \
+                  [f"{action} {target}: {error}" if source is None else f"{action} {source} {target}: {error}"
+                   for (action, source, target), error in results['errors']] + [""]
+    return message
+
+
+def verify_directory_copies(operations, mode="metadata", sample_percent=5, records=None, cache=None,
+                            algorithm="blake2b", workers=4, compressed=None, packed=None, seed=None):
+    """
+    Check that completed operations left the destination matching home, using several readers at once. Every copy
+    is checked for size and time modified against its source, and every removal is checked to be gone. With
+    mode "sample", the contents of sample_percent of copied files (picked at random, weighted by size) are also
+    compared by hash, and with mode "full" the contents of every copied file are. Source hashes are reused from the
+    hash cache where the source has not changed since it was hashed; copies are always read back.
+    Uses functions: hash_file, define_hasher, read_packed_file
+    :param operations: list of (action, source, target) tuples that completed, from execute_directory_operations()
+    :param mode: string, "metadata", "sample", or "full"
+    :param sample_percent: number, percent of copied files whose contents are compared with mode "sample"
+    :param records: (optional) dictionary of FileRecord entries for home, used to list files copied by cptree and to
+                    weight the sample (the source folder is walked instead if not given)
+    :param cache: (optional) dictionary of hashes from load_file_cache(), updated with any new source hashes
+    :param algorithm: string, "blake2b" or "xxhash" (requires the xxhash package)
+    :param workers: integer, number of files checked at the same time
+    :param compressed: (optional) dictionary of compressed files from load_file_cache(), so compressed copies are
+                       checked against their original contents
+    :param packed: (optional) dictionary of packed files from load_file_cache(), so packed copies are read from
+                   their segments
+    :param seed: (optional) integer, seed for picking the sample
+    :return: dictionary with 'mode', 'count_checked', 'count_hashed', 'bytes_hashed', 'mismatches' (list of
+             (operation, message) pairs), 'passed' (boolean), and 'seconds'
+    """
+    if mode not in ("metadata", "sample", "full"):
+        raise ValueError(f"Unknown verification mode {mode}.")
+    time_start = time.perf_counter()
+    cache = cache if cache is not None else {}
+    compressed = compressed if compressed is not None else {}
+    packed = packed if packed is not None else {}
+    checks = []
+    for operation in operations:
+        action, source, target = operation
+        if action == 'cptree':
+            if records is not None:
+                contents = [(record.path, record.is_dir) for path, record in records.items()
+                            if path.startswith(source + "/")]
+            else:
+                contents = []
+                for root, dirs, files in os.walk(source):
+                    root = root.replace("\\", "/")
+                    contents += [(root + "/" + name, True) for name in dirs]
+                    contents += [(root + "/" + name, False) for name in files]
+            checks.append(('mkdir', None, target))
+            for path, is_dir in contents:
+                path_target = target + path[len(source):]
+                checks.append(('mkdir', None, path_target) if is_dir else ('cp', path, path_target))
+        elif action in ('cp', 'cpover', 'link', 'mv', 'mkdir', 'rm', 'rmdir'):
+            checks.append(operation)
+    copies = [index for index, (action, _, _) in enumerate(checks) if action in ('cp', 'cpover')]
+    if mode == "full":
+        to_hash = set(copies)
+    elif mode == "sample" and len(copies) > 0:
+        randomizer = random.Random(seed)
+        count_sample = min(len(copies), math.ceil(len(copies) * sample_percent / 100))
+        weights = {}
+        for index in copies:
+            record = records.get(checks[index][1]) if records is not None else None
+            weights[index] = max(1, record.size if record is not None else 1)
+        to_hash = set(heapq.nlargest(count_sample, copies,
+                                     key=lambda index: randomizer.random() ** (1 / weights[index])))
+    else:
+        to_hash = set()
+
+    def hash_source(path, stat_source):
+        key = (stat_source.st_size, stat_source.st_mtime, stat_source.st_ino, algorithm)
+        cached = cache.get(path)
+        if cached is not None and cached[:4] == key:
+            return cached[4], 0
+        digest = hash_file(path, algorithm)
+        cache[path] = key + (digest,)
+        return digest, stat_source.st_size
+
+    def hash_target(path):
+        if path in packed:
+            hasher = define_hasher(algorithm)
+            contents = read_packed_file(packed, path)
+            hasher.update(contents)
+            return hasher.hexdigest(), len(contents)
+        codec = compressed[path][3] if path in compressed else None
+        return hash_file(path, algorithm, codec=codec), os.path.getsize(path)
+
+    def check(index):
+        action, source, target = checks[index]
+        if action in ('rm', 'rmdir'):
+            if target in packed or os.path.lexists(target):
+                return "still exists", 0
+            return None, 0
+        if action == 'mkdir':
+            return (None if os.path.isdir(target) else "folder missing"), 0
+        if action == 'mv':
+            return (None if target in packed or os.path.lexists(target) else "missing"), 0
+        stat_source = os.stat(source)
+        if target in packed:
+            size_target, mtime_target, segment, _ = packed[target]
+            if not os.path.isfile(segment):
+                return "segment missing", 0
+        elif not os.path.isfile(target):
+            return "missing", 0
+        else:
+            stat_target = os.stat(target)
+            size_target, mtime_target = stat_target.st_size, stat_target.st_mtime
+            if target in compressed:
+                if compressed[target][2] != size_target:
+                    return "compressed size differs", 0
+                size_target = compressed[target][0]
+        if size_target != stat_source.st_size:
+            return f"size differs ({size_target} vs {stat_source.st_size} bytes)", 0
+        if mtime_target != stat_source.st_mtime:
+            return "time modified differs", 0
+        if index not in to_hash:
+            return None, 0
+        digest_source, bytes_source = hash_source(source, stat_source)
+        digest_target, bytes_target = hash_target(target)
+        if digest_source != digest_target:
+            return "contents differ", bytes_source + bytes_target
+        return None, bytes_source + bytes_target
+
+    mismatches = []
+    bytes_hashed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(check, index): index for index in range(len(checks))}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                message, bytes_read = future.result()
+            except OSError as error:
+                message, bytes_read = str(error), 0
+            bytes_hashed += bytes_read
+            if message is not None:
+                mismatches.append((checks[futures[future]], message))
+    return {
+        'mode': mode,
+        'count_checked': len(checks),
+        'count_hashed': len(to_hash),
+        'bytes_hashed': bytes_hashed,
+        'mismatches': sorted(mismatches),
+        'passed': len(mismatches) == 0,
+        'seconds': time.perf_counter() - time_start
+    }
+
+
+def summarize_verification_results(verification):
+    """
+    Summarize results of verify_directory_copies() as messages, listing every mismatch.
+    :param verification: dictionary, output from verify_directory_copies()
+    :return: list of strings, messages to print or log
+    """
+    message = [
+        f"Verification ({verification['mode']}):",
+        f"{verification['count_checked']} operations checked, {verification['count_hashed']} compared by contents, "
+        f"{len(verification['mismatches'])} mismatched.",
+        f"{verification['bytes_hashed']} bytes read in {verification['seconds']:.1f} seconds.",
+        ""
+    ]
+    if not verification['passed']:
+        message = message + ["VERIFICATION FAILED:"] + \
+                  [f"{action} {target}: {error}" if source is None else f"{action} {source} {target}: {error}"
+                   for (action, source, target), error in verification['mismatches']] + [""]
+    return message
+
+
+def apply_verification_mismatches(records, mismatches, packed=None):
+    """
+    Update destination records after verification so the next run repeats any operation that did not check out:
+    copies that mismatched are dropped, and anything that should have been removed is recorded again.
+    Uses functions: build_file_record
+    :param records: dictionary of FileRecord entries for the destination, from update_destination_records()
+    :param mismatches: list of (operation, message) pairs, from verify_directory_copies()
+    :param packed: (optional) dictionary of packed files from load_file_cache(), updated in place
+    :return: dictionary of FileRecord entries with mismatches applied
+    """
+    records_out = dict(records)
+    for (action, _, target), _ in mismatches:
+        if action in ('rm', 'rmdir'):
+            if os.path.lexists(target):
+                records_out[target] = build_file_record(target, os.stat(target))
+        elif action in ('cp', 'cpover', 'link', 'mv', 'mkdir'):
+            records_out.pop(target, None)
+            if packed is not None:
+                packed.pop(target, None)
+    return records_out
+
+
+def start_run_metrics():
+    """
+    Start collecting metrics for a run.
+    :return: dictionary of run metrics, passed to mark_run_stage() as each stage finishes
+    """
+    time_now = time.perf_counter()
+    return {'started': datetime.datetime.now().isoformat(), 'time_start': time_now, 'time_mark': time_now,
+            'stages': []}
+
+
+def mark_run_stage(metrics, stage, **counts):
+    """
+    Record a stage of the run as finished, timing it from the end of the previous stage. Any counts given are saved
+    with the stage, along with how many of each were handled per second.
+    :param metrics: dictionary of run metrics, from start_run_metrics(), updated in place
+    :param stage: string, name of the stage
+    :param counts: (optional) integers counted during the stage (e.g., files=1000)
+    :return: None
+    """
+    time_now = time.perf_counter()
+    seconds = time_now - metrics['time_mark']
+    metrics['time_mark'] = time_now
+    entry = {'stage': stage, 'seconds': seconds}
+    for key, value in counts.items():
+        entry[key] = value
+        entry[key + '_per_second'] = value / seconds if seconds > 0 else None
+    metrics['stages'].append(entry)
+    return None
+
+
+def finish_run_metrics(metrics, results=None, records_home=None):
+    """
+    Finish run metrics, adding details of operations applied.
+    :param metrics: dictionary of run metrics, from start_run_metrics() and mark_run_stage()
+    :param results: (optional) dictionary, output from execute_directory_operations() or execute_operation_stream()
+    :param records_home: (optional) dictionary of FileRecord entries keyed by path for home directory, used to count
+                         bytes read by copies, counting each file copied once however many places it was copied
+                         to (otherwise bytes read are taken to be the same as bytes written)
+    :return: dictionary of run metrics ready to save as JSON
+    """
+    output = {'started': metrics['started'], 'finished': datetime.datetime.now().isoformat(),
+              'seconds': time.perf_counter() - metrics['time_start'], 'stages': metrics['stages']}
+    if results is not None:
+        bytes_read = results['bytes_copied']
+        if records_home is not None and 'completed' in results:
+            bytes_read = sum(records_home[source].size for source in {source for action, source, _
+                                                                      in results['completed']
+                                                                      if action in ('cp', 'cpover')}
+                             if source in records_home and records_home[source].size is not None)
+        seconds = results.get('seconds', 0.0)
+        actions = {}
+        for action, _, _ in results.get('completed', []):
+            actions[action] = actions.get(action, 0) + 1
+        output['operations'] = {
+            'count_completed': results['count_completed'],
+            'count_by_action': actions,
+            'count_errors': len(results['errors']),
+            'errors': [{'action': action, 'source': source, 'target': target, 'error': error}
+                       for (action, source, target), error in results['errors']],
+            'seconds': seconds,
+            'bytes_read': bytes_read,
+            'bytes_written': results['bytes_copied'],
+            'bytes_written_per_second': results['bytes_copied'] / seconds if seconds > 0 else None,
+            'slowest': [{'seconds': seconds_operation, 'action': action, 'source': source, 'target': target}
+                        for seconds_operation, (action, source, target) in results.get('slowest', [])]}
+    return output
+
+
+def drop_datetime_log(outpath, contents=None, metrics=None, prefix="Updated"):
     """
-    Leave a log text file indicating the current time.
+    Leave a log text file indicating the current time, and optionally a JSON file of run metrics next to it.
     Uses functions: standardize_path_names
     :param outpath: string, the path to drop the log file
     :param contents: (optional) string or list of strings, contents to write to file
-    :return: None, but outputs log file named 'Updated-[DATETIME].txt'
+    :param metrics: (optional) dictionary of run metrics, output from finish_run_metrics()
+    :param prefix: string, start of log file name, e.g. "Failed" for a run that did not pass verification
+    :return: None, but outputs log file named '[PREFIX]-[DATETIME].txt' (and '[PREFIX]-[DATETIME].json' with metrics)
     """
     outpath_fmt = standardize_path_names(outpath)
-    logfile = outpath_fmt + "/" + "Updated-" + pd.datetime.now().strftime("%Y-%m-%d-%H%M%S") + ".txt"
+    time_now = datetime.datetime.now()
+    logfile = outpath_fmt + "/" + prefix + "-" + time_now.strftime("%Y-%m-%d-%H%M%S") + ".txt"
     if contents is None:
         contents_list = [""]
     elif type(contents) == str:
         contents_list = [contents]
     else:
         contents_list = list(contents)
-    logtext = [pd.datetime.now().isoformat()] + contents_list
+    logtext = [time_now.isoformat()] + contents_list
     with open(logfile, "w", encoding="utf8") as file:
         file.write('\n'.join(logtext))
+    if metrics is not None:
+        with open(logfile[:-len(".txt")] + ".json", "w", encoding="utf8") as file:
+            json.dump(metrics, file, indent=2)
 
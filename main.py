@@ -1,53 +1,363 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import config as c
 import functions as f
 
+c.report_settings()
+
 # LOAD FILES #
 
+metrics = f.start_run_metrics()
 list_directories = f.import_filelist(c.file_include)
 list_exceptions = f.import_filelist(c.file_exclude)
 list_always_copy = f.import_filelist(c.file_force)
+destinations = [{'path': f.standardize_path_names(path),
+                 'file_manifest': f.standardize_path_names(path) + "/" + c.file_manifest,
+                 'file_journal': f.standardize_path_names(path) + "/" + c.file_journal,
+                 'folder_packs': f.standardize_path_names(path) + "/" + c.folder_packs}
+                for path in c.paths_destination]
+if c.compression is not None and c.compare_contents:
+    raise ValueError("Compression cannot be combined with compare_contents.")
+if c.pack_files_bytes is not None and (c.streaming_mode or c.use_snapshots or c.compare_contents):
+    raise ValueError("Packing small files cannot be combined with streaming_mode, use_snapshots, or compare_contents.")
+for destination in destinations:
+    destination['packed'] = f.load_file_cache(destination['file_manifest'], 'packed')
+compressed_index = {}
+for destination in destinations:
+    compressed_index.update(f.load_file_cache(destination['file_manifest'], 'compressed'))
+compress_options = {'compression': c.compression, 'compression_level': c.compression_level,
+                    'compression_workers': c.compression_workers, 'compressed': compressed_index}
+schedule_options = {'large_threshold': c.large_file_bytes, 'large_workers': c.large_file_workers,
+                    'limits': f.compile_device_limits(c.device_limits)}
+if c.durability not in ("none", "file", "batch", "end"):
+    raise ValueError("Durability must be one of none, file, batch, or end.")
+durability_options = {'durability': c.durability, 'sync_every': c.sync_every_operations}
+scan_settings = repr((list_exceptions + list_always_copy, c.copy_hidden_files, c.filesize_limit_bytes))
+run_state = repr((f.standardize_path_names(c.path_home), list_directories, scan_settings))
+
+# QUICK CHECK #
+
+if c.quick_check is not None and c.use_scan_manifest and not c.streaming_mode and not c.create_executable_only \
+        and len(list_always_copy) == 0:
+    if all(not (c.use_journal and os.path.isfile(destination['file_journal'])) and
+           f.check_unchanged_since_clean_run(destination['file_manifest'], run_state, paths_include=list_directories,
+                                             mode=c.quick_check, max_age=c.quick_check_max_seconds,
+                                             settings_files=[c.__file__, c.file_include, c.file_exclude],
+                                             workers=c.scan_workers)
+           for destination in destinations):
+        print("Nothing changed since the last run; skipping backup.")
+        sys.exit(0)
+
+# STREAMING MODE #
+
+if c.streaming_mode:
+    if c.use_snapshots or c.compare_contents or len(destinations) > 1:
+        raise ValueError("Streaming mode cannot be combined with use_snapshots, compare_contents, "
+                         "or more than one destination.")
+    results = f.stream_directory_backup(list_directories, c.path_home, destinations[0]['path'],
+                                        skip=list_exceptions, force=list_always_copy,
+                                        keep_hidden=c.copy_hidden_files, sizelimit=c.filesize_limit_bytes,
+                                        remove_nothing=c.prevent_file_removal,
+                                        overwrite_anything=c.overwrite_older_and_newer,
+                                        stop_if_warned=c.stop_if_warned, workers=c.copy_workers,
+                                        wait_to_run=c.pause_for_confirmation,
+                                        script_file=("~run_self_backup" + (".bat" if c.cmdtype == "dos" else ".sh")
+                                                     if c.create_executable_only else None),
+                                        cmdtype=c.cmdtype, delta_threshold=c.delta_threshold_bytes,
+                                        delta_block_size=c.delta_block_bytes, progress=c.show_progress,
+                                        fsync=c.durability == "file", **compress_options)
+    if not c.create_executable_only and len(compressed_index) > 0:
+        f.save_file_cache(destinations[0]['file_manifest'], 'compressed', compressed_index)
+    if not c.create_executable_only and c.durability != "none":
+        f.sync_filesystem(destinations[0]['path'])
+    f.mark_run_stage(metrics, 'stream', files=results['count_files'], operations=results['count_commands'])
+    commands_checks = f.check_directory_commands(results)
+    results_message = f.summarize_operation_results(results)
+    print('\n'.join(commands_checks['message'] + results_message))
+    if not c.create_executable_only and not (c.stop_if_warned and results['warning_flag']):
+        f.drop_datetime_log(destinations[0]['path'], contents=commands_checks['message'] + results_message,
+                            metrics=f.finish_run_metrics(metrics, results) if c.save_run_metrics else None)
+    sys.exit(0)
+
+# RESUME INTERRUPTED RUN #
+
+journal_header = {'path_home': f.standardize_path_names(c.path_home), 'settings': scan_settings,
+                  'use_snapshots': c.use_snapshots}
+resumed = False
+for destination in destinations:
+    file_manifest = destination['file_manifest']
+    file_journal = destination['file_journal']
+    journal_saved = f.load_operation_journal(file_journal) if c.use_journal else None
+    if journal_saved is not None and \
+            {key: journal_saved['header'].get(key) for key in journal_header} != journal_header:
+        print("Found a journal from an unfinished run with different settings; starting over.")
+        f.finish_operation_journal(None, file_journal, file_manifest)
+        journal_saved = None
+    if journal_saved is None or c.create_executable_only:
+        continue
+    operations_left = [operation for operation in journal_saved['operations']
+                       if operation not in journal_saved['done']]
+    print(f"Resuming unfinished run in {destination['path']}: "
+          f"{len(operations_left)} of {len(journal_saved['operations'])} operations left.")
+    manifest = f.load_scan_manifest(file_manifest, settings=scan_settings, pending=True)
+    f.remove_partial_files(operations_left)
+    if c.pause_for_confirmation:
+        input("Press enter to continue...")
+        f.mark_run_stage(metrics, 'confirm')
+    journal = open(file_journal, "a", encoding="utf8")
+    results = f.execute_directory_operations(operations_left, workers=c.copy_workers,
+                                             delta_threshold=c.delta_threshold_bytes,
+                                             delta_block_size=c.delta_block_bytes, progress=c.show_progress,
+                                             journal=journal, records=manifest['home'], **schedule_options,
+                                             **durability_options, **compress_options)
+    if c.durability == "end":
+        f.sync_filesystem(destination['path'])
+    f.mark_run_stage(metrics, 'resume', operations=results['count_completed'], bytes=results['bytes_copied'])
+    results_message = f.summarize_operation_results(results)
+    print('\n'.join(results_message))
+    operations_done = set(results['completed']) | journal_saved['done']
+    if c.use_scan_manifest:
+        records_dest = f.update_destination_records(manifest['dest'],
+                                                    [operation for operation in journal_saved['operations']
+                                                     if operation in operations_done],
+                                                    manifest['home'],
+                                                    rootpath=journal_saved['header'].get('path_snapshot'))
+        f.save_scan_manifest(file_manifest, manifest['home'], records_dest, settings=scan_settings)
+    if len(compressed_index) > 0:
+        f.update_compressed_index(compressed_index, list(operations_done))
+        f.save_file_cache(file_manifest, 'compressed',
+                          {path: entry for path, entry in compressed_index.items()
+                           if path.startswith(destination['path'] + '/')})
+    if c.use_snapshots:
+        f.prune_snapshots(destination['path'], keep_daily=c.snapshot_keep_daily,
+                          keep_weekly=c.snapshot_keep_weekly, workers=c.copy_workers)
+    f.finish_operation_journal(journal, file_journal, file_manifest)
+    f.drop_datetime_log(destination['path'], contents=["Resumed unfinished run."] + results_message,
+                        metrics=f.finish_run_metrics(metrics, results) if c.save_run_metrics else None)
+    resumed = True
+if resumed:
+    sys.exit(0)
 
 # SCAN COMPUTER #
 
-files_home = f.list_directory_files(list_directories)
-files_dest = f.list_directory_files(c.path_destination)
-files_all = f.list_possible_files(files_home + files_dest, c.path_home, c.path_destination,
-                                  skip=list_exceptions + list_always_copy, drop_nonexistent=True)
-details_home = f.build_directory_details(list(files_all.loc[files_all['in_home'], 'file_home']),
-                                         rootpath=files_all.loc[0, 'root_home'],
-                                         sizelimit=c.filesize_limit_bytes,
-                                         keep_hidden=c.copy_hidden_files)
-details_dest = f.build_directory_details(list(files_all.loc[files_all['in_dest'], 'file_dest']),
-                                         rootpath=files_all.loc[0, 'root_dest'],
-                                         sizelimit=c.filesize_limit_bytes,
-                                         keep_hidden=c.copy_hidden_files)
-
-# DEFINE ACTIONS
-
-details_all = f.join_directory_details(details_home, details_dest)
-if len(list_always_copy) > 0:
-    details_forced = f.define_forced_details(list_always_copy, c.path_home, c.path_destination)
-    if details_forced.shape[0] > 0:
-        details_all = details_all.append(details_forced).reset_index()
-commands_all = f.define_directory_commands(details_all, cmdtype=c.cmdtype,
-                                           remove_nothing=c.prevent_file_removal,
-                                           overwrite_anything=c.overwrite_older_and_newer)
-commands_checks = f.check_directory_commands(commands_all)
-print('\n'.join(commands_checks['message']))
+scan_exclude = f.compile_exclude_filter(list_exceptions + list_always_copy, c.path_home,
+                                        keep_hidden=c.copy_hidden_files, sizelimit=c.filesize_limit_bytes)
+for destination in destinations:
+    if c.use_snapshots:
+        destination['path_snapshot'] = f.define_snapshot_path(destination['path'])
+        destination['path_backup'] = (f.list_snapshots(destination['path']) or [destination['path_snapshot']])[-1]
+    else:
+        destination['path_snapshot'] = None
+        destination['path_backup'] = destination['path']
+    destination['manifest'] = f.load_scan_manifest(destination['file_manifest'] if c.use_scan_manifest else None,
+                                                   settings=scan_settings)
+    destination['records_dest'] = destination['manifest']['dest'] \
+        if destination['path_backup'] in destination['manifest']['dest'] else None
+destinations_scanned = [destination for destination in destinations if destination['records_dest'] is None]
+scan_counts = {}
+records_scanned = f.scan_directory_groups(
+    [(list_directories, destinations[0]['manifest']['home'], c.path_home, scan_exclude)] +
+    [(destination['path_backup'], None, destination['path_backup'], scan_exclude)
+     for destination in destinations_scanned], workers=c.scan_workers, counts=scan_counts)
+records_home = records_scanned[0]
+for destination, records_dest in zip(destinations_scanned, records_scanned[1:]):
+    destination['records_dest'] = records_dest
+f.mark_run_stage(metrics, 'scan', files=len(records_home) + sum(len(destination['records_dest'])
+                                                                for destination in destinations), **scan_counts)
+use_moves = c.detect_moves and not c.use_snapshots and not c.prevent_file_removal
+use_hash_cache = c.compare_contents or (use_moves and c.verify_moves) or c.verify_copies in ("sample", "full")
+hash_cache = {}
+if use_hash_cache:
+    for destination in destinations:
+        hash_cache.update(f.load_file_cache(destination['file_manifest'], 'hashes'))
+details_home = None
+for destination in destinations:
+    if len(destinations) > 1:
+        print(f"\nDestination {destination['path']}:")
+    path_backup = destination['path_backup']
+    path_snapshot = destination['path_snapshot']
+    if len(compressed_index) > 0:
+        destination['records_dest'] = f.apply_compressed_sizes(destination['records_dest'], compressed_index)
+    if len(destination['packed']) > 0:
+        destination['records_dest'] = f.apply_packed_records(destination['records_dest'], destination['packed'])
+    records_dest = destination['records_dest']
+    records_all = {**records_home, **records_dest}
+    files_home = list(records_home)
+    files_dest = list(records_dest)
+    files_all = f.list_possible_files(files_home + files_dest, c.path_home, path_backup,
+                                      skip=list_exceptions + list_always_copy, drop_nonexistent=True,
+                                      records=records_all)
+    if details_home is None:
+        details_home = f.build_directory_details(list(files_all.loc[files_all['in_home'], 'file_home']),
+                                                 rootpath=files_all.loc[0, 'root_home'],
+                                                 sizelimit=c.filesize_limit_bytes,
+                                                 keep_hidden=c.copy_hidden_files,
+                                                 records=records_all)
+    details_dest = f.build_directory_details(list(files_all.loc[files_all['in_dest'], 'file_dest']),
+                                             rootpath=files_all.loc[0, 'root_dest'],
+                                             sizelimit=c.filesize_limit_bytes,
+                                             keep_hidden=c.copy_hidden_files,
+                                             records=records_all)
+    f.mark_run_stage(metrics, 'details', files=files_all.shape[0])
+
+    # DEFINE ACTIONS
+
+    details_all = f.join_directory_details(details_home, details_dest)
+    if c.compare_contents:
+        details_all = f.compare_directory_contents(details_all, records_all, cache=hash_cache,
+                                                   algorithm=c.hash_algorithm, workers=c.hash_workers)
+    operations_moved = []
+    if use_moves:
+        details_all, operations_moved = f.detect_moved_files(details_all, records_all, verify=c.verify_moves,
+                                                             cache=hash_cache if use_hash_cache else None,
+                                                             algorithm=c.hash_algorithm, workers=c.hash_workers)
+    if len(list_always_copy) > 0:
+        details_forced = f.define_forced_details(list_always_copy, c.path_home, path_backup,
+                                                 records=records_all)
+        if details_forced.shape[0] > 0:
+            details_all = details_all.append(details_forced).reset_index()
+    f.mark_run_stage(metrics, 'compare', files=details_all.shape[0])
+    commands_all = f.define_directory_commands(details_all, cmdtype=c.cmdtype,
+                                               remove_nothing=c.prevent_file_removal or c.use_snapshots,
+                                               overwrite_anything=c.overwrite_older_and_newer)
+    if c.use_snapshots:
+        commands_all['operations'] = f.define_snapshot_operations(details_all, path_snapshot,
+                                                                  overwrite_anything=c.overwrite_older_and_newer)
+        commands_all['commands'] = f.format_directory_commands(commands_all['operations'], cmdtype=c.cmdtype)
+    elif len(operations_moved) > 0:
+        commands_all['operations'] = operations_moved + commands_all['operations']
+        commands_all['commands'] = f.format_directory_commands(commands_all['operations'], cmdtype=c.cmdtype)
+        commands_all['count_moves'] = len(operations_moved)
+    if c.optimize_plan:
+        commands_all['count_unoptimized'] = len(commands_all['operations'])
+        commands_all['operations'] = f.optimize_directory_operations(commands_all['operations'], records_home,
+                                                                     bulk=len(destinations) == 1
+                                                                     and c.pack_files_bytes is None)
+        commands_all['commands'] = f.format_directory_commands(commands_all['operations'], cmdtype=c.cmdtype)
+    if c.schedule_copies is not None:
+        commands_all['operations'] = f.schedule_directory_operations(commands_all['operations'], records_all,
+                                                                     order=c.schedule_copies)
+    commands_checks = f.check_directory_commands(commands_all)
+    print('\n'.join(commands_checks['message']))
+    f.mark_run_stage(metrics, 'plan', operations=len(commands_all['operations']))
+    destination['commands_all'] = commands_all
+    destination['commands_checks'] = commands_checks
 
 # APPLY COMMANDS
 
-if c.stop_if_warned and commands_checks['warning_flag']:
+commands_script = [command for destination in destinations for command in destination['commands_all']['commands']]
+if c.stop_if_warned and any(destination['commands_checks']['warning_flag'] for destination in destinations):
     print("Halting commands and saving execution script for review as ~check_self_backup.")
-    f.run_directory_commands(commands_all['commands'], cmdtype=c.cmdtype, tmpfile="~check_self_backup",
+    f.run_directory_commands(commands_script, cmdtype=c.cmdtype, tmpfile="~check_self_backup",
                              wait_to_run=c.pause_for_confirmation,
                              skip_execution=True, keep_script=True)
-else:
-    f.run_directory_commands(commands_all['commands'], cmdtype=c.cmdtype, tmpfile="~run_self_backup",
+elif c.create_executable_only:
+    f.run_directory_commands(commands_script, cmdtype=c.cmdtype, tmpfile="~run_self_backup",
                              wait_to_run=c.pause_for_confirmation,
-                             skip_execution=c.create_executable_only, keep_script=c.create_executable_only)
-    if not c.create_executable_only:
-        f.drop_datetime_log(c.path_destination, contents=commands_checks['message'])
+                             skip_execution=True, keep_script=True)
+else:
+    signatures = {} if c.delta_threshold_bytes is not None else None
+    journals = {}
+    results_packed = []
+    if c.pause_for_confirmation:
+        input("Press enter to continue...")
+        f.mark_run_stage(metrics, 'confirm')
+    for destination in destinations:
+        os.makedirs(destination['path'], exist_ok=True)
+        if c.delta_threshold_bytes is not None:
+            signatures.update(f.load_file_cache(destination['file_manifest'], 'signatures'))
+        if c.pack_files_bytes is not None or len(destination['packed']) > 0:
+            packing = f.pack_directory_operations(destination['commands_all']['operations'], records_home,
+                                                  destination['packed'], destination['path'],
+                                                  destination['folder_packs'], threshold=c.pack_files_bytes or 0,
+                                                  segment_size=c.pack_segment_bytes,
+                                                  fsync=c.durability in ("file", "batch"))
+            f.save_file_cache(destination['file_manifest'], 'packed', destination['packed'])
+            destination['commands_all']['operations'] = packing['operations']
+            results_packed.append(packing)
+        if c.use_journal:
+            f.save_scan_manifest(destination['file_manifest'], records_home, destination['records_dest'],
+                                 settings=scan_settings, pending=True)
+            journals[destination['path']] = f.start_operation_journal(
+                destination['file_journal'], destination['commands_all']['operations'],
+                header={**journal_header, 'path_snapshot': destination['path_snapshot']})
+    operations_all = [operation for destination in destinations
+                      for operation in destination['commands_all']['operations']]
+    results = f.execute_directory_operations(operations_all, workers=c.copy_workers,
+                                             delta_threshold=c.delta_threshold_bytes,
+                                             delta_block_size=c.delta_block_bytes, signatures=signatures,
+                                             progress=c.show_progress, journal=journals if c.use_journal else None,
+                                             records=records_home, fanout=len(destinations) > 1,
+                                             **schedule_options, **durability_options, **compress_options)
+    for packing in results_packed:
+        results['completed'] = packing['completed'] + results['completed']
+        results['count_completed'] += len(packing['completed'])
+        results['errors'] += packing['errors']
+        results['bytes_copied'] += packing['bytes_copied']
+    if c.durability == "end":
+        for destination in destinations:
+            f.sync_filesystem(destination['path'])
+    f.mark_run_stage(metrics, 'execute', operations=results['count_completed'], bytes=results['bytes_copied'])
+    results_message = f.summarize_operation_results(results)
+    print('\n'.join(results_message))
+    for destination in destinations:
+        destination['completed'] = [operation for operation in results['completed']
+                                    if operation[2] == destination['path'] or
+                                    operation[2].startswith(destination['path'] + '/')]
+        if len(compressed_index) > 0:
+            f.update_compressed_index(compressed_index, destination['completed'])
+    verification = None
+    if c.verify_copies is not None:
+        packed_all = {path: entry for destination in destinations for path, entry in destination['packed'].items()}
+        verification = f.verify_directory_copies(results['completed'], mode=c.verify_copies,
+                                                 sample_percent=c.verify_sample_percent, records=records_home,
+                                                 cache=hash_cache if use_hash_cache else None,
+                                                 algorithm=c.hash_algorithm, workers=c.hash_workers,
+                                                 compressed=compressed_index, packed=packed_all)
+        f.mark_run_stage(metrics, 'verify', operations=verification['count_checked'],
+                         bytes=verification['bytes_hashed'])
+        verification_message = f.summarize_verification_results(verification)
+        print('\n'.join(verification_message))
+        results_message = results_message + verification_message
+    for destination in destinations:
+        file_manifest = destination['file_manifest']
+        completed = destination['completed']
+        records_dest = f.update_destination_records(destination['records_dest'], completed, records_home,
+                                                    rootpath=destination['path_snapshot'])
+        if verification is not None and not verification['passed']:
+            records_dest = f.apply_verification_mismatches(
+                records_dest, [(operation, message) for operation, message in verification['mismatches']
+                               if operation[2].startswith(destination['path'] + '/')], packed=destination['packed'])
+            f.save_file_cache(file_manifest, 'packed', destination['packed'])
+        if c.use_snapshots:
+            f.prune_snapshots(destination['path'], keep_daily=c.snapshot_keep_daily,
+                              keep_weekly=c.snapshot_keep_weekly, workers=c.copy_workers)
+        if c.use_scan_manifest:
+            f.save_scan_manifest(file_manifest, records_home, records_dest, settings=scan_settings)
+            if (verification is None or verification['passed']) and \
+                    not any(operation[2].startswith(destination['path'] + '/') for operation, _ in results['errors']):
+                f.save_clean_run(file_manifest, run_state)
+        if c.delta_threshold_bytes is not None:
+            f.save_file_cache(file_manifest, 'signatures', signatures, records=records_dest)
+        if len(compressed_index) > 0:
+            f.save_file_cache(file_manifest, 'compressed', compressed_index, records=records_dest)
+        if len(destination['packed']) > 0 or c.pack_files_bytes is not None:
+            f.prune_packed_segments(destination['packed'], destination['folder_packs'])
+        if use_hash_cache:
+            f.update_hash_cache(hash_cache, completed, records_dest)
+            f.save_file_cache(file_manifest, 'hashes', hash_cache, records={**records_home, **records_dest})
+        if c.use_journal:
+            f.finish_operation_journal(journals[destination['path']], destination['file_journal'], file_manifest)
+    f.mark_run_stage(metrics, 'save')
+    metrics_run = f.finish_run_metrics(metrics, results, records_home) if c.save_run_metrics else None
+    if metrics_run is not None and verification is not None:
+        metrics_run['verification'] = verification
+    for destination in destinations:
+        f.drop_datetime_log(destination['path'], contents=destination['commands_checks']['message'] + results_message,
+                            metrics=metrics_run,
+                            prefix="Updated" if verification is None or verification['passed'] else "Failed")
+    if verification is not None and not verification['passed']:
+        sys.exit(1)
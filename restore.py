@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import config as c
+import functions as f
+
+# LOCATE FILES #
+
+if len(c.restore_paths) == 0:
+    raise ValueError("No files/folders to restore: list them in restore_paths or after restore.py.")
+path_home = f.standardize_path_names(c.path_home)
+path_destination = f.standardize_path_names(c.paths_destination[0])
+file_manifest = path_destination + "/" + c.file_manifest
+if c.use_snapshots:
+    snapshots = f.list_snapshots(path_destination)
+    if len(snapshots) == 0:
+        raise ValueError(f"No snapshots found in {path_destination}.")
+    path_backup = snapshots[-1]
+else:
+    path_backup = path_destination
+patterns = []
+for path in f.standardize_path_names(c.restore_paths):
+    path_full = path if path == path_home or path.startswith(path_home + "/") else path_home + "/" + path
+    patterns.append(path_backup + path_full[len(path_home):])
+prefixes = [re.split(r'[*?\[]', pattern)[0] for pattern in patterns]
+packed = f.load_file_cache(file_manifest, 'packed')
+compressed = f.load_file_cache(file_manifest, 'compressed')
+records = f.query_scan_manifest(file_manifest, prefixes)
+if len(records) == 0:
+    print(f"No records found in {file_manifest}, scanning {path_backup} instead.")
+    for pattern, prefix in zip(patterns, prefixes):
+        folder = pattern if prefix == pattern and os.path.isdir(pattern) else prefix.rsplit("/", 1)[0]
+        if os.path.isdir(folder):
+            records[folder] = f.build_file_record(folder, os.stat(folder))
+            records.update(f.scan_directory_records(folder, workers=c.scan_workers, rootpath=path_backup,
+                                                    exclude=f.compile_exclude_filter(None, path_backup)))
+    records = f.apply_compressed_sizes(records, compressed)
+    records = f.apply_packed_records(records, {path: entry for path, entry in packed.items()
+                                               if any(path.startswith(prefix) for prefix in prefixes)})
+records_selected = f.select_pattern_records(records, patterns)
+
+# RESTORE FILES #
+
+restore = f.define_restore_operations(records_selected, path_backup, path_home, overwrite=c.restore_overwrite)
+count_files = sum(1 for action, _, _ in restore['operations'] if action != 'mkdir')
+print(f"Restoring from {path_backup} to {path_home}:\n"
+      f"{len(records_selected)} files/folders found, {count_files} files and "
+      f"{len(restore['operations']) - count_files} folders to restore, {restore['count_unchanged']} already in home.")
+if len(restore['kept']) > 0:
+    print(f"{len(restore['kept'])} files/folders in home differ from the backup and are left alone:",
+          *restore['kept'][:20], sep="\n")
+if c.pause_for_confirmation and len(restore['operations']) > 0:
+    input("Press enter to continue...")
+results = f.restore_directory_files(restore['operations'], records=records_selected, workers=c.copy_workers,
+                                    packed=packed, compressed=compressed, progress=c.show_progress)
+print('\n'.join(f.summarize_operation_results(results)))
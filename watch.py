@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import config as c
+import functions as f
+
+c.report_settings()
+
+# LOAD FILES #
+
+list_directories = f.import_filelist(c.file_include)
+list_exceptions = f.import_filelist(c.file_exclude)
+list_always_copy = f.import_filelist(c.file_force)
+scan_settings = repr((list_exceptions + list_always_copy, c.copy_hidden_files, c.filesize_limit_bytes))
+
+# WATCH FOR CHANGES #
+
+if c.use_snapshots or c.compression is not None or c.pack_files_bytes is not None or len(c.paths_destination) > 1:
+    raise ValueError("Watch mode cannot be combined with use_snapshots, compression, pack_files_bytes, "
+                     "or more than one destination.")
+try:
+    f.watch_directory_backup(list_directories, c.path_home, c.paths_destination[0],
+                             skip=list_exceptions, force=list_always_copy,
+                             keep_hidden=c.copy_hidden_files, sizelimit=c.filesize_limit_bytes,
+                             remove_nothing=c.prevent_file_removal,
+                             overwrite_anything=c.overwrite_older_and_newer,
+                             stop_if_warned=c.stop_if_warned, workers=c.copy_workers,
+                             debounce=c.watch_debounce_seconds, max_delay=c.watch_max_delay_seconds,
+                             reconcile_every=c.watch_reconcile_seconds,
+                             dbfile=(f.standardize_path_names(c.paths_destination[0]) + "/" + c.file_manifest
+                                     if c.use_scan_manifest else None),
+                             settings=scan_settings,
+                             delta_threshold=c.delta_threshold_bytes, delta_block_size=c.delta_block_bytes)
+except KeyboardInterrupt:
+    print("Stopped watching.")